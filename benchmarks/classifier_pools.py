@@ -0,0 +1,130 @@
+"""
+Benchmark: latency of concurrent classify requests with the blocking steps in the classifier pools vs on the event loop.
+
+Mystem and Elasticsearch are replaced with stand-ins: lemmatization blocks the thread for --mystem-ms
+as a round trip through the Mystem pipe does, a search waits for --es-ms without blocking.
+Candidates are ranked by the real classifier. Clients send requests one after another,
+reported are latency percentiles and the worst stall of the event loop.
+
+    python -m benchmarks.classifier_pools --clients 32 --requests 50
+"""
+
+import argparse
+import asyncio
+import random
+import time
+import types
+
+import numpy as np
+
+from core.classifiers.jaccard_classifier import JaccardClassifier
+from core.classifiers.kosgu_classifier import KosguClassifier
+from core.classifiers.pools import ClassifierPools, ClassifierPoolsSettings
+
+
+class BlockingMystem:
+    """Returns the text as is after blocking for the time of a Mystem round trip"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def lemmatize(self, text: str) -> list[str]:
+        time.sleep(self.seconds)
+        return [text + "\n"]
+
+
+class SlowElastic:
+    """Answers multi-searches with the same etalons and answers after a non-blocking wait"""
+
+    def __init__(self, seconds: float, etalons: list[dict]):
+        self.seconds = seconds
+        self.etalons = etalons
+        self.answers = [{"templateId": doc["ID"], "templateText": f"ответ {doc['ID']}", "urls": []} for doc in etalons]
+
+    async def q_msearch(self, index: str, queries: list, size: int | None = None) -> list[list[dict]]:
+        await asyncio.sleep(self.seconds)
+        return [self.etalons if index == "clusters" else self.answers for _ in queries]
+
+
+def make_etalons(quantity: int, vocabulary: list[str], rnd: random.Random) -> list[dict]:
+    etalons = []
+    for i in range(quantity):
+        lem = " ".join(rnd.sample(vocabulary, rnd.randint(2, 8)))
+        etalons.append({"ID": i, "Cluster": lem, "LemCluster": lem, "ParentPubList": [1, 2, 3], "Topic": ""})
+    return etalons
+
+
+async def measure_lag(stop: asyncio.Event, lags: list[float]):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def load(classifier, texts: list[str], clients: int, requests: int) -> tuple[list[float], list[float]]:
+    latencies, lags = [], []
+
+    async def client(rnd: random.Random):
+        for _ in range(requests):
+            start = time.perf_counter()
+            try:
+                await classifier.classify(rnd.choice(texts), 1)
+            except Exception:
+                pass
+            latencies.append(time.perf_counter() - start)
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop, lags))
+    await asyncio.gather(*[client(random.Random(i)) for i in range(clients)])
+    stop.set()
+    await lag_task
+    return latencies, lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--classifier", choices=["jaccard", "kosgu"], default="kosgu")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--etalons", type=int, default=300, help="candidates ranked for every request")
+    parser.add_argument("--mystem-ms", type=float, default=3.0)
+    parser.add_argument("--es-ms", type=float, default=10.0)
+    parser.add_argument("--lemmatize-workers", type=int, default=4)
+    parser.add_argument("--scoring-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    vocabulary = [f"слово{i}" for i in range(200)]
+    etalons = make_etalons(args.etalons, vocabulary, rnd)
+    texts = [" ".join(rnd.sample(vocabulary, rnd.randint(3, 10))) for _ in range(1000)]
+    params = types.SimpleNamespace(
+        stopwords=[], score_threshold=0.1, es_clusters_index="clusters", es_answers_index="answers"
+    )
+    classifier_class = {"jaccard": JaccardClassifier, "kosgu": KosguClassifier}[args.classifier]
+    print(f"{classifier_class.__name__}: {args.clients} clients x {args.requests} requests, {args.etalons} candidates")
+
+    for enabled in (False, True):
+        settings = ClassifierPoolsSettings(
+            enabled=enabled, lemmatize_workers=args.lemmatize_workers, scoring_workers=args.scoring_workers
+        )
+        with ClassifierPools(settings) as pools:
+            classifier = classifier_class(
+                SlowElastic(args.es_ms / 1000, etalons),
+                BlockingMystem(args.mystem_ms / 1000),
+                params,
+                pools=pools,
+            )
+            start = time.perf_counter()
+            latencies, lags = asyncio.run(load(classifier, texts, args.clients, args.requests))
+            total = time.perf_counter() - start
+
+        latencies, lags = np.array(latencies) * 1000, np.array(lags) * 1000
+        print(
+            f"pools {'on ' if enabled else 'off'}: "
+            f"p50 {np.percentile(latencies, 50):.1f} ms, p99 {np.percentile(latencies, 99):.1f} ms, "
+            f"max loop stall {lags.max(initial=0):.1f} ms, {len(latencies) / total:.0f} requests/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
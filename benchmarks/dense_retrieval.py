@@ -0,0 +1,183 @@
+"""
+Benchmark of candidate retrieval for the SBERT classifiers: BM25 then rerank vs the dense IVF index.
+
+Etalons and queries are synthetic, Elasticsearch and the model are not needed. Etalons belong to topics:
+their vectors are close to the topic center and their words are drawn from the topic vocabulary.
+A query is a paraphrase of one etalon: its vector is close to the etalon, but it shares only some words with it,
+so BM25 misses part of the paraphrases. BM25 is computed in process, in production it also costs
+a request to Elasticsearch.
+
+Both paths take num_candidates candidates and rerank them by exact cosine as the classifier does.
+Reported are recall@k against exact dense search among the etalons of the pub, the share of queries
+whose source etalon is ranked first and the latency per query.
+
+    python -m benchmarks.dense_retrieval --etalons 50000 --queries 1000
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from core.ann_index import AnnIndex, AnnSettings
+from core.embeddings import EmbeddingsSettings, EtalonEmbeddings
+
+
+class SyntheticEtalons:
+    def __init__(self, args):
+        rng = np.random.default_rng(args.seed)
+        self.rng = rng
+        self.args = args
+        centers = self.normalize(rng.standard_normal((args.topics, args.dim)))
+        self.topics = rng.integers(0, args.topics, args.etalons)
+        self.vectors = self.normalize(
+            centers[self.topics] + args.spread * rng.standard_normal((args.etalons, args.dim))
+        )
+
+        # у каждой темы свой словарь, слова эталона берутся из него
+        self.vocabularies = rng.integers(0, args.vocabulary, (args.topics, args.topic_words))
+        self.tokens = [
+            list(rng.choice(self.vocabularies[topic], rng.integers(3, 9), replace=False)) for topic in self.topics
+        ]
+        self.texts = [" ".join(f"w{w}" for w in tokens) + f" e{i}" for i, tokens in enumerate(self.tokens)]
+        self.pubs = [rng.choice(args.pubs, rng.integers(1, 4), replace=False).tolist() for _ in range(args.etalons)]
+
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        return self.vectors[[int(text.rsplit(" e", 1)[1]) for text in texts]]
+
+    def queries(self) -> tuple[np.ndarray, np.ndarray, list[list[int]], list[int]]:
+        """Vectors, source etalons, words and pubs of the queries"""
+        args, rng = self.args, self.rng
+        sources = rng.integers(0, args.etalons, args.queries)
+        vectors = self.normalize(
+            self.vectors[sources] + args.paraphrase * rng.standard_normal((args.queries, args.dim))
+        )
+        words = []
+        for source in sources:
+            # часть слов берется из эталона, остальные - другие слова той же темы
+            own = [w for w in self.tokens[source] if rng.random() < args.overlap]
+            words.append(own + list(rng.choice(self.vocabularies[self.topics[source]], rng.integers(1, 4))))
+        pubs = [int(rng.choice(self.pubs[source])) for source in sources]
+        return vectors, sources, words, pubs
+
+
+class BM25:
+    """In-process BM25 over the etalon words, as the LemCluster field is scored by Elasticsearch"""
+
+    def __init__(self, tokens: list[list[int]], pubs: list[list[int]], k1: float = 1.2, b: float = 0.75):
+        self.k1, self.b = k1, b
+        self.lengths = np.array([len(t) for t in tokens], dtype=np.float32)
+        postings: dict[int, list[int]] = {}
+        for doc, words in enumerate(tokens):
+            for word in words:
+                postings.setdefault(int(word), []).append(doc)
+        self.postings = {word: np.array(docs) for word, docs in postings.items()}
+        self.idf = {
+            word: np.log(1 + (len(tokens) - len(docs) + 0.5) / (len(docs) + 0.5))
+            for word, docs in self.postings.items()
+        }
+        self.pub_docs: dict[int, set] = {}
+        for doc, doc_pubs in enumerate(pubs):
+            for pub in doc_pubs:
+                self.pub_docs.setdefault(int(pub), set()).add(doc)
+        self.pub_masks = {pub: np.isin(np.arange(len(tokens)), list(docs)) for pub, docs in self.pub_docs.items()}
+
+    def search(self, words: list[int], pub: int, size: int) -> np.ndarray:
+        scores = np.zeros(len(self.lengths), dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.lengths / self.lengths.mean())
+        for word in set(int(w) for w in words):
+            if (docs := self.postings.get(word)) is not None:
+                scores[docs] += self.idf[word] * (self.k1 + 1) / (1 + norm[docs])
+        scores[~self.pub_masks[pub]] = 0
+        matched = np.flatnonzero(scores)
+        return matched[np.argsort(-scores[matched], kind="stable")[:size]]
+
+
+def rerank(vectors: np.ndarray, query: np.ndarray, candidates: np.ndarray, k: int) -> np.ndarray:
+    scores = vectors[candidates] @ query
+    return candidates[np.argsort(-scores, kind="stable")[:k]]
+
+
+def evaluate(name: str, search, data: SyntheticEtalons, queries, truth: list[np.ndarray], k: int) -> dict:
+    vectors, sources, words, pubs = queries
+    latencies, recalls, first = [], [], 0
+    for i in range(len(sources)):
+        start = time.perf_counter()
+        found = rerank(data.vectors, vectors[i], search(vectors[i], words[i], pubs[i]), k)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len(set(found.tolist()) & set(truth[i].tolist())) / max(len(truth[i]), 1))
+        first += bool(len(found)) and found[0] == sources[i]
+    latencies = np.array(latencies) * 1000
+    return {
+        "method": name,
+        f"recall@{k}": round(float(np.mean(recalls)), 3),
+        "source_first": round(first / len(sources), 3),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--etalons", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--topics", type=int, default=500)
+    parser.add_argument("--pubs", type=int, default=20)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--topic-words", type=int, default=40)
+    parser.add_argument("--spread", type=float, default=0.08, help="scatter of etalons around the topic center")
+    parser.add_argument("--paraphrase", type=float, default=0.03, help="scatter of queries around the etalon")
+    parser.add_argument("--overlap", type=float, default=0.3, help="share of etalon words kept in the query")
+    parser.add_argument("--num-candidates", type=int, default=10)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    data = SyntheticEtalons(args)
+    queries = data.queries()
+    vectors, sources, words, pubs = queries
+    bm25 = BM25(data.tokens, data.pubs)
+
+    # точный поиск среди эталонов pub
+    truth = []
+    for i in range(args.queries):
+        candidates = np.array(sorted(bm25.pub_docs[pubs[i]]))
+        truth.append(rerank(data.vectors, vectors[i], candidates, args.k))
+    print(f"etalons: {args.etalons}, queries: {args.queries}, prepared in {time.perf_counter() - start:.1f} s")
+
+    results = [
+        evaluate("bm25+rerank", lambda v, w, p: bm25.search(w, p, args.num_candidates), data, queries, truth, args.k)
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = EtalonEmbeddings.build("synthetic", data.texts, data.encode, EmbeddingsSettings(dir=tmp_dir))
+        docs = [{"ID": i, "LemCluster": text, "ParentPubList": data.pubs[i]} for i, text in enumerate(data.texts)]
+        for quantize in (False, True):
+            settings = AnnSettings(dir=tmp_dir, quantize=quantize)
+            start = time.perf_counter()
+            ann_index = AnnIndex.build(f"synthetic-{quantize}", docs, store, settings)
+            build_seconds = time.perf_counter() - start
+            for nprobe in args.nprobe:
+
+                def search(vector, _, pub):
+                    found = ann_index.search(vector, pub, args.num_candidates, nprobe=nprobe)
+                    return np.array([doc["ID"] for doc in found], dtype=np.int64)
+
+                name = f"ivf {'int8' if quantize else 'fp16'} nprobe={nprobe}"
+                results.append(
+                    {**evaluate(name, search, data, queries, truth, args.k), "build_s": round(build_seconds, 1)}
+                )
+
+    for result in results:
+        print("  ".join(f"{key}: {value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Microbenchmark: removal of stopword phrases with the prefix tree matcher vs the former regex alternation.
+
+Mystem is not needed: stopwords and texts are normalized the same way as before lemmatization,
+which is enough to compare the cost of matching.
+
+    python -m benchmarks.stopwords_matcher --texts 20000
+"""
+import argparse
+import random
+import re
+import time
+
+from core.text_preprocessing.lemmatizer import TextLemmatizer
+from core.text_preprocessing.stopwords_matcher import StopwordsMatcher, read_stopwords
+
+
+def regex_remove(pattern: re.Pattern, tokens: list[str]) -> list[str]:
+    return pattern.sub(" ", " ".join(tokens)).split()
+
+
+def make_texts(stopwords: list[list[str]], quantity: int, seed: int = 0) -> list[list[str]]:
+    rnd = random.Random(seed)
+    vocabulary = [token for phrase in stopwords for token in phrase] + [f"слово{i}" for i in range(2000)]
+    texts = []
+    for _ in range(quantity):
+        tokens = [rnd.choice(vocabulary) for _ in range(rnd.randint(5, 40))]
+        for _ in range(rnd.randint(0, 3)):
+            position = rnd.randint(0, len(tokens))
+            tokens[position:position] = rnd.choice(stopwords)
+        texts.append(tokens)
+    return texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--texts", type=int, default=20000)
+    parser.add_argument("--files", nargs="+", default=["greetings_stopwords.csv", "stopwords.csv"])
+    args = parser.parse_args()
+
+    phrases = [TextLemmatizer._normalize_text(sw).split() for sw in read_stopwords(tuple(args.files))]
+    phrases = [phrase for phrase in phrases if phrase]
+    texts = make_texts(phrases, args.texts)
+
+    start = time.perf_counter()
+    pattern = re.compile("|".join([r"\b" + " ".join(phrase) + r"\b" for phrase in phrases]))
+    regex_build = time.perf_counter() - start
+    start = time.perf_counter()
+    regex_results = [regex_remove(pattern, tokens) for tokens in texts]
+    regex_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher = StopwordsMatcher(phrases)
+    trie_build = time.perf_counter() - start
+    start = time.perf_counter()
+    trie_results = [matcher.remove(tokens) for tokens in texts]
+    trie_time = time.perf_counter() - start
+
+    differ = sum(1 for x, y in zip(regex_results, trie_results) if x != y)
+    print(f"phrases: {len(phrases)}, texts: {len(texts)}, tokens: {sum(len(t) for t in texts)}")
+    print(f"regex: build {regex_build * 1000:.1f} ms, match {regex_time * 1000:.1f} ms")
+    print(f"trie:  build {trie_build * 1000:.1f} ms, match {trie_time * 1000:.1f} ms")
+    print(f"speedup: {regex_time / trie_time:.1f}x, texts with different result: {differ}")
+
+
+if __name__ == "__main__":
+    main()
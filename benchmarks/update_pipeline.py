@@ -0,0 +1,336 @@
+"""
+Offline benchmark of UpdateService without MS SQL and Elasticsearch.
+
+SyntheticDataFetcher generates rows for every SysID from statistics_parameters.json,
+InMemoryElasticClient keeps documents in memory and sleeps to simulate bulk latency.
+Results are written to benchmarks/results/ as JSON, so runs on different commits can be compared:
+
+    python -m benchmarks.update_pipeline --rows 2000 --words 12
+    python -m benchmarks.update_pipeline --compare benchmarks/results/<previous>.json
+"""
+import argparse
+import asyncio
+import fnmatch
+import json
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from core.elastic.client import BulkStats
+from core.mssql import ROW
+from core.settings import PROJECT_ROOT_DIR
+from core.utils.other import chunks
+
+RESULTS_DIR = os.path.join(PROJECT_ROOT_DIR, "benchmarks", "results")
+
+WORDS = (
+    "налог ндс декларация отчет сотрудник отпуск больничный взнос страховой договор аренда счет фактура "
+    "акт сверка зарплата премия увольнение прием касса банк выписка учет основной средство амортизация"
+).split()
+
+
+class StageTimings:
+    """Accumulates time spent in every stage of the pipeline."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def add(self, stage: str, seconds: float):
+        self.seconds[stage] += seconds
+        self.calls[stage] += 1
+
+    def wrap(self, stage: str, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+
+        return timed
+
+
+class SyntheticDataFetcher:
+    """Stand-in for SQLDataFetcher with generated rows."""
+
+    def __init__(self, timings: StageTimings, rows_per_sys: int, words: int, latency: float = 0.0, seed: int = 0):
+        self.timings = timings
+        self.rows_per_sys = rows_per_sys
+        self.words = words
+        self.latency = latency
+        self.seed = seed
+        self.watermarks = {}
+        self.full_diffs = {}
+
+    def generate(self, sys_id: int) -> list[ROW]:
+        rnd = random.Random(self.seed * 1000 + sys_id)
+        rows = []
+        for i in range(self.rows_per_sys):
+            template_id = sys_id * 100000 + i // 5
+            rows.append(
+                ROW(
+                    sys_id,
+                    template_id,
+                    " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(max(self.words // 2, 1), self.words))),
+                    16 if i % 3 else 7,
+                    template_id + 1,
+                    [rnd.randint(1, 300) for _ in range(3)],
+                    86,
+                    template_id + 2,
+                    1,
+                    "тема",
+                    "подтема",
+                    f"Документ {template_id}",
+                    " ".join(rnd.choice(WORDS) for _ in range(self.words)),
+                )
+            )
+        return rows
+
+    def _fetch(self, sys_id: int) -> list[ROW]:
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        rows = self.generate(sys_id)
+        self.timings.add("fetch", time.perf_counter() - start)
+        return rows
+
+    def get_rows(self, sys_id: int, date: str) -> list[ROW]:
+        return self._fetch(sys_id)
+
+    def get_changed_rows(self, sys_id: int, date: str, since: str) -> tuple[list, list]:
+        return self._fetch(sys_id), []
+
+    def iter_rows(self, sys_id: int, date: str, batch_size: int):
+        yield from chunks(self._fetch(sys_id), batch_size)
+
+    def iter_systems_rows(self, sys_ids: list[int], date: str, batch_size: int):
+        time.sleep(self.latency)
+        for sys_id in sorted(sys_ids):
+            for rows in chunks(self.generate(sys_id), batch_size):
+                yield sys_id, rows
+
+    def set_watermark(self, sys_id, date: str) -> None:
+        self.watermarks[str(sys_id)] = date
+
+    def set_full_diff(self, sys_id, date: str) -> None:
+        self.full_diffs[str(sys_id)] = date
+
+    def save_watermarks(self) -> None:
+        pass
+
+
+class _Indices:
+    def __init__(self, client: "InMemoryElasticClient"):
+        self.client = client
+
+    async def refresh(self, index: str) -> None:
+        pass
+
+    async def exists(self, index: str) -> bool:
+        return index in self.client.docs or index in self.client.aliases
+
+
+class InMemoryElasticClient:
+    """Stand-in for ElasticClient: a bulk sink that keeps documents in memory and simulates request latency."""
+
+    def __init__(self, timings: StageTimings, chunk_size: int = 500, latency: float = 0.005):
+        self.timings = timings
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.docs: dict[str, dict[str, dict]] = defaultdict(dict)
+        self.aliases: dict[str, str] = {}
+        self.indices = _Indices(self)
+        self.bulk_docs = 0
+        self.bulk_bytes = 0
+        self.bulk_requests = 0
+
+    def resolve(self, index: str) -> str:
+        return self.aliases.get(index, index)
+
+    async def _bulk(self, actions: list[tuple[str, dict, str | None]]) -> int:
+        start = time.perf_counter()
+        payload = "\n".join(json.dumps(doc, ensure_ascii=False, default=str) for _, doc, _ in actions)
+        await asyncio.sleep(self.latency)
+        for index, doc, _id in actions:
+            index = self.resolve(index)
+            self.docs[index][_id or str(len(self.docs[index]))] = doc
+        self.bulk_docs += len(actions)
+        self.bulk_bytes += len(payload.encode("utf-8"))
+        self.bulk_requests += 1
+        self.timings.add("bulk", time.perf_counter() - start)
+        return len(payload.encode("utf-8"))
+
+    async def add_docs(self, index_name: str, docs: list[dict], id_field: str | None = None, **kwargs) -> BulkStats:
+        stats = BulkStats(docs=len(docs))
+        for docs_chunk in chunks(docs, self.chunk_size):
+            actions = [(index_name, doc, doc[id_field] if id_field else None) for doc in docs_chunk]
+            stats.bytes += await self._bulk(actions)
+        return stats
+
+    async def stream_docs(self, docs, id_field: str | None = None, **kwargs) -> BulkStats:
+        stats, actions = BulkStats(), []
+        async for index_name, doc in docs:
+            actions.append((index_name, doc, doc[id_field] if id_field else None))
+            if len(actions) == self.chunk_size:
+                stats.bytes += await self._bulk(actions)
+                stats.docs, actions = stats.docs + len(actions), []
+        if actions:
+            stats.bytes += await self._bulk(actions)
+            stats.docs += len(actions)
+        return stats
+
+    async def create_generation(self, alias: str, *args, **kwargs) -> str:
+        index = f"{alias}-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        self.docs[index] = {}
+        return index
+
+    @asynccontextmanager
+    async def bulk_load_mode(self, *indexes: str):
+        yield
+
+    async def switch_alias(self, alias: str, index: str) -> None:
+        self.aliases[alias] = index
+
+    async def switch_aliases(self, targets: dict[str, str]) -> None:
+        self.aliases.update(targets)
+
+    async def alias_targets(self, alias: str) -> list[str]:
+        return [self.aliases[alias]] if alias in self.aliases else []
+
+    async def generations(self, alias: str) -> list[str]:
+        return sorted(index for index in self.docs if fnmatch.fnmatch(index, f"{alias}-*"))
+
+    async def prune_generations(self, alias: str, keep: int) -> None:
+        generations = await self.generations(alias)
+        for index in generations[: max(len(generations) - keep, 0)]:
+            if index != self.aliases.get(alias):
+                del self.docs[index]
+
+    async def delete_index(self, index: str) -> None:
+        self.docs.pop(index, None)
+
+    async def q_delete(self, index: str, query) -> None:
+        await asyncio.sleep(self.latency)
+
+    async def delete_docs(self, index_name: str, ids: list[str]) -> None:
+        for _id in ids:
+            self.docs[self.resolve(index_name)].pop(_id, None)
+
+    async def scan_ids(self, index: str, query) -> set[str]:
+        return set(self.docs[self.resolve(index)])
+
+    async def close(self) -> None:
+        pass
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def benchmark(args) -> dict:
+    from pymystem3 import Mystem
+
+    from core.text_preprocessing.mystem_pool import MystemPool
+    from update import UpdateService
+
+    timings = StageTimings()
+    es_client = InMemoryElasticClient(timings, latency=args.bulk_latency)
+    db_conn = SyntheticDataFetcher(timings, args.rows, args.words, latency=args.fetch_latency)
+
+    mystem = MystemPool(args.mystem_processes) if args.mystem_processes > 1 else Mystem()
+    with tempfile.TemporaryDirectory() as snapshots_dir:
+        service = UpdateService(es_client, db_conn, mystem)
+        service.settings.single_query = args.single_query
+        service.snapshot_settings.dir = snapshots_dir
+        service.update_data_with_lemmas = timings.wrap("lemmatize", service.update_data_with_lemmas)
+        service.answers_create = timings.wrap("answers", service.answers_create)
+
+        start = time.perf_counter()
+        await service.run()
+        wall = time.perf_counter() - start
+
+        # перестроение индексов из снимка, записанного при загрузке, без MS SQL и лемматизации
+        rebuild_timings = StageTimings()
+        rebuild_service = UpdateService(
+            InMemoryElasticClient(rebuild_timings, latency=args.bulk_latency),
+            SyntheticDataFetcher(rebuild_timings, 0, args.words),
+            mystem,
+        )
+        rebuild_service.snapshot_settings.dir = snapshots_dir
+        start = time.perf_counter()
+        await rebuild_service.run(offline="complete")
+        rebuild_wall = time.perf_counter() - start
+
+    return {
+        "commit": git_commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "params": vars(args),
+        "wall_seconds": wall,
+        "snapshot_rebuild_seconds": rebuild_wall,
+        "stages": {
+            stage: {"seconds": timings.seconds[stage], "calls": timings.calls[stage]}
+            for stage in sorted(timings.seconds)
+        },
+        "docs": es_client.bulk_docs,
+        "bulk_requests": es_client.bulk_requests,
+        "bulk_bytes": es_client.bulk_bytes,
+        "docs_per_second": es_client.bulk_docs / wall if wall else 0.0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "metrics": service.metrics.summary(),
+    }
+
+
+def report(result: dict, previous: dict | None = None):
+    def line(name: str, value: float, old: float | None):
+        delta = f"  ({value / old:.2f}x of previous)" if old else ""
+        print(f"{name:<24}{value:>12.2f}{delta}")
+
+    previous = previous or {}
+    print(f"commit {result['commit']}, {result['docs']} docs in {result['bulk_requests']} bulk requests")
+    line("wall, s", result["wall_seconds"], previous.get("wall_seconds"))
+    line("rebuild from snapshot, s", result["snapshot_rebuild_seconds"], previous.get("snapshot_rebuild_seconds"))
+    for stage, values in result["stages"].items():
+        line(f"{stage}, s", values["seconds"], previous.get("stages", {}).get(stage, {}).get("seconds"))
+    line("docs/s", result["docs_per_second"], previous.get("docs_per_second"))
+    line("bulk, MB", result["bulk_bytes"] / 2**20, previous.get("bulk_bytes", 0) / 2**20 or None)
+    line("peak RSS, MB", result["peak_rss_mb"], previous.get("peak_rss_mb"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000, help="rows per SysID")
+    parser.add_argument("--words", type=int, default=12, help="max words in generated texts")
+    parser.add_argument("--fetch-latency", type=float, default=0.05, help="simulated MS SQL query time, s")
+    parser.add_argument("--bulk-latency", type=float, default=0.005, help="simulated bulk request time, s")
+    parser.add_argument("--mystem-processes", type=int, default=1, help="Mystem pool size, 1 for one Mystem")
+    parser.add_argument("--single-query", action="store_true", help="read all systems with one query")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as prev_f:
+            previous = json.load(prev_f)
+    del args.compare
+
+    result = asyncio.run(benchmark(args))
+    report(result, previous)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    file_path = os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{result['commit']}.json")
+    with open(file_path, "w", encoding="utf-8") as res_f:
+        json.dump(result, res_f, ensure_ascii=False, indent=4)
+    print(f"saved to {file_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import datetime
+from functools import partial
+from typing import Callable
+
+import numpy as np
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from core.elastic.client import ElasticClient
+from core.embeddings import EtalonEmbeddings, read_etalons
+from core.settings import ANN_DIR
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+DOCS_FILE = "docs.json"
+# поля эталона, которые нужны классификаторам вместо выдачи ES
+DOC_FIELDS = ["ID", "Cluster", "LemCluster", "ShortAnswerText", "ParentPubList"]
+
+
+class AnnSettings(BaseSettings):
+    """Dense etalon retrieval index settings."""
+
+    model_config = SettingsConfigDict(env_file_encoding="utf-8", env_prefix="ann_", extra="ignore")
+
+    dir: str = ANN_DIR
+    # число списков IVF, по умолчанию 4 * sqrt(числа эталонов)
+    lists: int | None = None
+    # сколько ближайших списков просматривается при поиске
+    nprobe: int = 16
+    # векторы в int8 с масштабом на строку: в 2 раза компактнее float16, точность ранжирования почти та же
+    quantize: bool = True
+    train_sample: int = 100_000
+    train_iterations: int = 10
+    keep: int = 2
+    # как часто классификатор сверяет построенный плотный индекс с текущим поколением индекса эталонов, в секундах
+    check_interval: float = 60.0
+
+
+def _kmeans(vectors: np.ndarray, lists: int, iterations: int, seed: int = 0) -> np.ndarray:
+    """Spherical k-means: centroids of normalized vectors by cosine similarity"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        norms = np.linalg.norm(sums, axis=1)
+        # пустой список сохраняет прежний центроид
+        filled = norms > 0
+        centroids[filled] = sums[filled] / norms[filled, None]
+    return centroids
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 65536) -> np.ndarray:
+    return np.concatenate(
+        [
+            np.argmax(vectors[i : i + chunk].astype(np.float32) @ centroids.T, axis=1)
+            for i in range(0, len(vectors), chunk)
+        ]
+        or [np.empty(0, dtype=np.int64)]
+    )
+
+
+class AnnIndex:
+    """
+    Inverted file index over the etalon embeddings of one clusters index.
+
+    Etalons are grouped into lists by the nearest centroid; a query is compared with the centroids and then
+    only with the etalons of the nprobe nearest lists. Etalons of a pub are marked in a bitmap per pub,
+    so the pub filter is a bit test for the scanned rows. Vectors are stored in int8 with a scale per row
+    or in float16, all arrays are memory-mapped. Etalons are a copy of one generation of the clusters index,
+    the generation is recorded in the meta, so readers can tell when the alias has been switched away from it.
+    """
+
+    def __init__(self, path: str, meta: dict, arrays: dict[str, np.ndarray], docs: list[list], nprobe: int):
+        self.path = path
+        self.meta = meta
+        self.centroids = arrays["centroids"]
+        self.offsets = arrays["offsets"]
+        self.vectors = arrays["vectors"]
+        self.scales = arrays.get("scales")
+        self.pubs = {int(pub): i for i, pub in enumerate(arrays["pubs"])}
+        self.pub_bits = arrays["pub_bits"]
+        self.docs = docs
+        self.nprobe = nprobe
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    @property
+    def generation(self) -> list[str] | None:
+        """Indexes the etalons were read from, None for indexes built before generations were recorded"""
+        return self.meta.get("generation")
+
+    @staticmethod
+    def versions(index: str, settings: AnnSettings | None = None) -> list[str]:
+        """Paths of complete versions of the index, oldest first."""
+        settings = settings or AnnSettings()
+        index_dir = os.path.join(settings.dir, index)
+        if not os.path.isdir(index_dir):
+            return []
+        paths = [os.path.join(index_dir, name) for name in sorted(os.listdir(index_dir))]
+        return [path for path in paths if os.path.exists(os.path.join(path, META_FILE))]
+
+    @classmethod
+    def open(cls, index: str, settings: AnnSettings | None = None) -> "AnnIndex | None":
+        """The newest version of the index or None if it is not built."""
+        settings = settings or AnnSettings()
+        if not (versions := cls.versions(index, settings)):
+            return None
+        path = versions[-1]
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as m_f:
+            meta = json.load(m_f)
+        with open(os.path.join(path, DOCS_FILE), "r", encoding="utf-8") as d_f:
+            docs = json.load(d_f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in meta["arrays"]}
+        ann_index = cls(path, meta, arrays, docs, settings.nprobe)
+        logger.info("dense index of %s: %i etalons in %i lists from %s", index, len(ann_index), meta["lists"], path)
+        return ann_index
+
+    def search(self, query: np.ndarray, pub_id: int, k: int, nprobe: int | None = None) -> list[dict]:
+        """Up to k etalons of the pub most similar to the normalized query vector, best first"""
+        if (pub := self.pubs.get(int(pub_id))) is None or not len(self.docs):
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists])
+
+        # биты упакованы np.packbits: старший бит байта - первая строка
+        bits = self.pub_bits[pub]
+        rows = rows[(bits[rows >> 3] >> (7 - (rows & 7))) & 1 == 1]
+        if not len(rows):
+            return []
+
+        scores = self.vectors[rows].astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales[rows]
+        top = np.argpartition(-scores, min(k, len(rows)) - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [{**dict(zip(DOC_FIELDS, self.docs[rows[i]])), "score": float(scores[i])} for i in top]
+
+    @classmethod
+    def build(
+        cls,
+        index: str,
+        docs: list[dict],
+        store: EtalonEmbeddings,
+        settings: AnnSettings | None = None,
+        generation: list[str] | None = None,
+    ) -> "AnnIndex":
+        """
+        Writes a new version of the index for the etalons with vectors in the embeddings store.
+
+        :param generation: indexes behind the alias the etalons were read from.
+        """
+        settings = settings or AnnSettings()
+        start = time.perf_counter()
+
+        rows = store.rows([doc.get("LemCluster", "") for doc in docs])
+        if skipped := int((rows < 0).sum()):
+            logger.warning("%i etalons of %s have no embeddings and are not indexed", skipped, index)
+        docs = [doc for doc, row in zip(docs, rows) if row >= 0]
+        vectors = np.asarray(store.vectors[rows[rows >= 0]], dtype=np.float32)
+
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), settings.train_sample), replace=False)]
+        lists = max(min(settings.lists or int(4 * np.sqrt(len(docs))), len(sample)), 1)
+        centroids = _kmeans(sample, lists, settings.train_iterations) if len(docs) else np.zeros((1, store.meta["dim"]))
+        assign = _assign(vectors, centroids)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+        vectors, docs = vectors[order], [docs[i] for i in order]
+
+        arrays = {"centroids": centroids.astype(np.float32), "offsets": offsets.astype(np.int64)}
+        if settings.quantize:
+            scales = np.abs(vectors).max(axis=1) / 127 if len(vectors) else np.empty(0)
+            scales[scales == 0] = 1.0
+            arrays["vectors"] = np.round(vectors / scales[:, None]).astype(np.int8)
+            arrays["scales"] = scales.astype(np.float32)
+        else:
+            arrays["vectors"] = vectors.astype(np.float16)
+
+        pub_rows: dict[int, list[int]] = {}
+        for row, doc in enumerate(docs):
+            pubs = doc["ParentPubList"] if isinstance(doc["ParentPubList"], list) else [doc["ParentPubList"]]
+            for pub in pubs:
+                pub_rows.setdefault(int(pub), []).append(row)
+        arrays["pubs"] = np.array(sorted(pub_rows), dtype=np.int64)
+        arrays["pub_bits"] = np.zeros((len(pub_rows), (len(docs) + 7) // 8), dtype=np.uint8)
+        for i, pub in enumerate(arrays["pubs"]):
+            mask = np.zeros(len(docs), dtype=bool)
+            mask[pub_rows[int(pub)]] = True
+            arrays["pub_bits"][i] = np.packbits(mask)
+
+        path = os.path.join(settings.dir, index, datetime.now().strftime("%Y%m%d%H%M%S%f"))
+        os.makedirs(path)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        with open(os.path.join(path, DOCS_FILE), "w", encoding="utf-8") as d_f:
+            json.dump([[doc.get(field) for field in DOC_FIELDS] for doc in docs], d_f, ensure_ascii=False)
+        meta = {
+            "index": index,
+            "generation": sorted(generation) if generation is not None else None,
+            "embeddings": store.path,
+            "docs": len(docs),
+            "lists": len(centroids),
+            "quantized": settings.quantize,
+            "arrays": list(arrays),
+        }
+        # meta.json пишется последним: без него версия считается незаконченной
+        with open(os.path.join(path, f"{META_FILE}.tmp"), "w", encoding="utf-8") as m_f:
+            json.dump(meta, m_f, ensure_ascii=False, indent=4)
+        os.replace(os.path.join(path, f"{META_FILE}.tmp"), os.path.join(path, META_FILE))
+
+        versions = cls.versions(index, settings)
+        for old in versions[: max(len(versions) - settings.keep, 0)]:
+            shutil.rmtree(old, ignore_errors=True)
+
+        logger.info(
+            "dense index of %s built in %s: %i etalons, %i lists in %.1f s",
+            index,
+            path,
+            len(docs),
+            len(centroids),
+            time.perf_counter() - start,
+        )
+        return cls.open(index, settings)
+
+
+async def live_generation(es_client: ElasticClient, index: str) -> list[str]:
+    """Indexes the alias points to, the name itself for a concrete index"""
+    return sorted(await es_client.alias_targets(index)) or [index]
+
+
+async def build_etalon_indexes(
+    es_client: ElasticClient,
+    indexes: list[str],
+    model_name: str,
+    encode: Callable[[list[str]], np.ndarray],
+    dense: bool = True,
+) -> EtalonEmbeddings:
+    """
+    Builds the etalon embeddings store of the model and, with `dense`, the dense indexes of the clusters indexes.
+
+    Etalons are read from the indexes the aliases point to at the moment, and the dense index records them,
+    so it is not used after the alias is switched to a newer generation. `encode` must return normalized vectors.
+    """
+    generations, etalons = {}, {}
+    for index in indexes:
+        generations[index] = await live_generation(es_client, index)
+        etalons[index] = await read_etalons(es_client, ",".join(generations[index]), DOC_FIELDS)
+
+    loop = asyncio.get_running_loop()
+    texts = [doc["LemCluster"] for docs in etalons.values() for doc in docs if doc.get("LemCluster")]
+    store = await loop.run_in_executor(None, EtalonEmbeddings.build, model_name, texts, encode)
+    if dense:
+        for index, docs in etalons.items():
+            await loop.run_in_executor(None, partial(AnnIndex.build, index, docs, store, generation=generations[index]))
+    return store
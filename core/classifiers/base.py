@@ -1,23 +1,243 @@
+import logging
 from abc import ABC, abstractmethod
 
 from pymystem3 import Mystem
 
+from core.classifiers.context import RequestContext
+from core.classifiers.pools import ClassifierPools
+from core.classifiers.scheduler import InferenceScheduler
+from core.elastic.answers_table import AnswersTable
 from core.elastic.client import ElasticClient
+from core.elastic.queries import BaseQuery, Bool, Match, Terms
+from core.exceptions import AnswerNotFound, AppException, ClassifierException, ESResponseEmpty
 from core.schemas import SearchResponse
+from core.text_preprocessing.lemma_cache import LemmaCache
 from core.text_preprocessing.lemmatizer import TextLemmatizer
+from core.text_preprocessing.mystem_pool import MystemPool
+from core.utils.other import resolve_answer_text
+
+logger = logging.getLogger(__name__)
+
+# кандидат после ранжирования: (ID эталона, текст эталона для ответа, оценка)
+Candidate = tuple[int | str, str, float | bool]
 
 
 class Classifier(ABC):
-    def __init__(self, es_client: ElasticClient, mystem: Mystem, params):
+    """
+    Base classifier: lemmatizes texts and classifies them in batches.
+
+    Classifiers answering from the indexes derive from CandidatesClassifier, classifiers with their own data
+    define classify_many.
+    """
+
+    algorithm: str = ""
+
+    def __init__(
+        self,
+        es_client: ElasticClient,
+        mystem: Mystem | MystemPool,
+        params,
+        lemma_cache: LemmaCache | None = None,
+        answers_table: AnswersTable | None = None,
+        pools: ClassifierPools | None = None,
+    ):
         self.es_client = es_client
         self.params = params
+        # блокирующие шаги выполняются в пулах процесса, чтобы не останавливать event loop
+        self.pools = pools or ClassifierPools.shared()
 
-        self.lemmatizer = TextLemmatizer(mystem=mystem)
+        if answers_table is not None and answers_table.index != self.params.es_answers_index:
+            logger.warning(
+                "answers table of %s is not used by %s: it answers from %s",
+                answers_table.index,
+                type(self).__name__,
+                self.params.es_answers_index,
+            )
+            answers_table = None
+        self.answers_table = answers_table
+
+        self.lemmatizer = TextLemmatizer(mystem=mystem, cache=lemma_cache)
         self.lemmatizer.add_stopwords(stopwords=self.params.stopwords)
 
+    async def classify(self, text: str, pub_id: int, context: RequestContext | None = None) -> SearchResponse:
+        (result,) = await self.classify_many([(text, pub_id)], context)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
     @abstractmethod
-    async def classify(self, text: str, pub_id: int) -> SearchResponse:
-        pass
+    async def classify_many(
+        self, requests: list[tuple[str, int]], context: RequestContext | None = None
+    ) -> list[SearchResponse | AppException]:
+        """
+        Classifies a batch of (text, pub_id).
+
+        Results are in the order of requests, a text that wasn't classified gets the exception instead
+        of the response. Lemmas found by previous classifiers of the scenario are taken from the context.
+        """
+
+    def tokenize_many(self, texts: list[str], context: RequestContext | None = None) -> list[list[str]]:
+        """Lemmatized tokens without stopwords for every text, all texts go to Mystem at once"""
+        # тексты передаются в Mystem одной строкой через перевод строки, поэтому переводы строк внутри текстов
+        # заменяются пробелами, как и при обращении к кэшу лемм
+        texts = [" ".join(text.split("\n")) for text in texts]
+        if context is not None:
+            return context.tokenize(self.lemmatizer, texts)
+        return self.lemmatizer.tokenization(texts)
+
+
+class CandidatesClassifier(Classifier, ABC):
+    """
+    Classifier answering from the indexes.
+
+    It finds candidate etalons in the clusters index, ranks them and returns the answer of the first ranked
+    candidate that has one for the pub. Subclasses define ranking and may change the candidates query.
+    """
+
+    async def classify_many(
+        self, requests: list[tuple[str, int]], context: RequestContext | None = None
+    ) -> list[SearchResponse | AppException]:
+        """
+        Classifies a batch of (text, pub_id).
+
+        Texts are lemmatized with one Mystem call, candidates and answers are searched with multi-search requests,
+        so the number of round trips doesn't grow with the batch. Results are in the order of requests,
+        a text that wasn't classified gets the exception instead of the response. Lemmas and candidates found
+        by previous classifiers of the scenario are taken from the context.
+        """
+        if not requests:
+            return []
+        texts, pub_ids = zip(*requests)
+        tokens_lists = await self.pools.run("lemmatize", self.tokenize_many, list(texts), context)
+        tokens_strs = [" ".join(tokens) for tokens in tokens_lists]
+
+        etalons_search_results = await self.search_candidates(tokens_strs, list(pub_ids), context)
+
+        results: list[SearchResponse | AppException | None] = [None] * len(requests)
+        to_rank = []
+        for i, etalons in enumerate(etalons_search_results):
+            if etalons:
+                to_rank.append(i)
+            else:
+                results[i] = ESResponseEmpty(f"ES didn't find anything for text '''{tokens_strs[i]}'''")
+
+        to_answer = {}
+        ranked = await self.rank_many([(tokens_strs[i], pub_ids[i], etalons_search_results[i]) for i in to_rank])
+        for i, candidates in zip(to_rank, ranked):
+            if isinstance(candidates, Exception):
+                results[i] = candidates
+            else:
+                to_answer[i] = candidates
+
+        answers = await self.find_answers({i: (pub_ids[i], candidates) for i, candidates in to_answer.items()})
+        for i in to_answer:
+            if i not in answers:
+                results[i] = AnswerNotFound(f"didn't find anything for text '''{tokens_strs[i]}'''")
+                continue
+            (_, etalon_text, score), answer = answers[i]
+            results[i] = SearchResponse(
+                templateId=answer["templateId"],
+                templateText=resolve_answer_text(answer, pub_ids[i]),
+                etalon_text=etalon_text,
+                algorithm=self.algorithm,
+                score=score,
+            )
+        return results
+
+    @property
+    def candidates_size(self) -> int | None:
+        """How many candidates to search for, max_hits of the client by default"""
+        return None
+
+    async def search_candidates(
+        self, tokens_strs: list[str], pub_ids: list[int], context: RequestContext | None = None
+    ) -> list[list[dict]]:
+        """Candidate etalons for every text, searched in the clusters index with one multi-search request"""
+        queries = [self.candidates_query(tokens_str, pub_id) for tokens_str, pub_id in zip(tokens_strs, pub_ids)]
+        if context is not None:
+            return await context.search(self.es_client, self.params.es_clusters_index, queries, self.candidates_size)
+        return await self.es_client.q_msearch(
+            index=self.params.es_clusters_index, queries=queries, size=self.candidates_size
+        )
+
+    def candidates_query(self, tokens_str: str, pub_id: int) -> BaseQuery:
+        """
+        Query for candidate etalons in the clusters index: etalons of the pub ranked by BM25 over LemCluster.
+        Classifiers with the same query share candidates in a scenario.
+        """
+        return Bool([Match("LemCluster", tokens_str), Match("ParentPubList", pub_id)])
+
+    def answers_query(self, template_ids: list[int | str], pub_id: int) -> BaseQuery:
+        """Query for the answers of the templates in the answers index"""
+        return Bool([Terms("templateId", list(dict.fromkeys(template_ids))), Match("pubId", pub_id)])
+
+    @abstractmethod
+    async def rank_many(self, batch: list[tuple[str, int, list[dict]]]) -> list[list[Candidate] | ClassifierException]:
+        """
+        Ranks candidates of several (tokens_str, pub_id, etalons) texts.
+
+        For every text returns the candidates to answer with, best first, or ClassifierException
+        if none is good enough.
+        """
+
+    async def find_answers(self, ranked: dict[int, tuple[int, list[Candidate]]]) -> dict[int, tuple[Candidate, dict]]:
+        """
+        The first ranked candidate with an answer and the answer for every text.
+
+        Texts are keyed by their position in the batch. Answers are taken from the answers table if it is loaded,
+        otherwise the answers of all candidates of all texts are searched with one terms query per text
+        in one multi-search request.
+        """
+        if self.answers_table is not None and self.answers_table.ready:
+            return self.find_answers_in_table(ranked)
+
+        keys = [i for i, (_, candidates) in ranked.items() if candidates]
+        answers_search_results = await self.es_client.q_msearch(
+            index=self.params.es_answers_index,
+            queries=[self.answers_query([c[0] for c in ranked[i][1]], ranked[i][0]) for i in keys],
+        )
+
+        found = {}
+        for i, answers in zip(keys, answers_search_results):
+            by_template = {}
+            for answer in answers:
+                by_template.setdefault(str(answer["templateId"]), answer)
+            for candidate in ranked[i][1]:
+                if (answer := by_template.get(str(candidate[0]))) is not None:
+                    found[i] = (candidate, answer)
+                    break
+        return found
+
+    def find_answers_in_table(
+        self, ranked: dict[int, tuple[int, list[Candidate]]]
+    ) -> dict[int, tuple[Candidate, dict]]:
+        found = {}
+        for i, (pub_id, candidates) in ranked.items():
+            for candidate in candidates:
+                if (answer := self.answers_table.get(candidate[0], pub_id)) is not None:
+                    found[i] = (candidate, answer)
+                    break
+        return found
+
+
+class RankingClassifier(CandidatesClassifier, ABC):
+    """Classifier ranking candidates of every text on its own in the scoring pool."""
+
+    @abstractmethod
+    def rank(self, tokens_str: str, pub_id: int, etalons: list[dict]) -> list[Candidate]:
+        """Candidates to answer with, best first. Raises ClassifierException if none is good enough."""
+
+    async def rank_many(self, batch: list[tuple[str, int, list[dict]]]) -> list[list[Candidate] | ClassifierException]:
+        return await self.pools.run("scoring", self.rank_each, batch)
+
+    def rank_each(self, batch: list[tuple[str, int, list[dict]]]) -> list[list[Candidate] | ClassifierException]:
+        ranked = []
+        for tokens_str, pub_id, etalons in batch:
+            try:
+                ranked.append(self.rank(tokens_str, pub_id, etalons))
+            except ClassifierException as err:
+                ranked.append(err)
+        return ranked
 
 
 class ModelMixin(ABC):
@@ -33,4 +253,12 @@ class ModelMixin(ABC):
 
 
 class ClassifierWithModel(ModelMixin, Classifier, ABC):
-    pass
+    """
+    Classifier with models. Inference runs through the scheduler, so concurrent requests are batched together
+    and the event loop isn't blocked.
+    """
+
+    def __init__(self, *args, scheduler: InferenceScheduler | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # по умолчанию модели всех классификаторов выполняются одним планировщиком процесса
+        self.scheduler = scheduler or InferenceScheduler.shared()
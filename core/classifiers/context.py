@@ -0,0 +1,60 @@
+import json
+
+from core.elastic.client import ElasticClient
+from core.elastic.queries import BaseQuery
+from core.text_preprocessing.lemmatizer import TextLemmatizer
+
+
+class RequestContext:
+    """
+    Preprocessing and candidates shared by the classifiers of a scenario for one incoming message.
+
+    The service creates a context per message and passes it to every classifier of the scenario. Texts are sent
+    to Mystem once, every classifier applies its own synonyms and stopwords to the same lemmas. Candidates are
+    kept per index and query, so classifiers with the same candidates query for the text and pub get them
+    from one search; a classifier asking for fewer candidates gets the top of a larger list.
+    A context is used by one scenario at a time and isn't shared between threads.
+    """
+
+    def __init__(self):
+        self.lemmas: dict[str, list[str]] = {}
+        # (конфигурация лемматизатора, текст) -> токены без стоп-слов
+        self.tokens: dict[tuple[str, str], list[str]] = {}
+        # (индекс, запрос) -> (сколько кандидатов запрошено, кандидаты)
+        self.candidates: dict[tuple[str, str], tuple[int, list[dict]]] = {}
+        self.lemmatized = 0
+        self.searched = 0
+
+    def tokenize(self, lemmatizer: TextLemmatizer, texts: list[str]) -> list[list[str]]:
+        """Same as lemmatizer.tokenization, texts already lemmatized for the message are not sent to Mystem"""
+        if missing := [text for text in dict.fromkeys(texts) if text not in self.lemmas]:
+            self.lemmas.update(zip(missing, lemmatizer.lemmatize_texts(missing)))
+            self.lemmatized += len(missing)
+
+        fingerprint = lemmatizer.fingerprint
+        if missing := [text for text in dict.fromkeys(texts) if (fingerprint, text) not in self.tokens]:
+            filtered = lemmatizer.filter_lemmas([self.lemmas[text] for text in missing])
+            self.tokens.update(((fingerprint, text), tokens) for text, tokens in zip(missing, filtered))
+        return [list(self.tokens[(fingerprint, text)]) for text in texts]
+
+    async def search(
+        self, es_client: ElasticClient, index: str, queries: list[BaseQuery], size: int | None = None
+    ) -> list[list[dict]]:
+        """Same as es_client.q_msearch, queries already searched for the message with enough hits are not sent"""
+        size = size or es_client.conf.max_hits
+        keys = [(index, json.dumps(query.to_dict(), sort_keys=True, ensure_ascii=False)) for query in queries]
+
+        def found(key: tuple[str, str]) -> bool:
+            # выдача меньше запрошенной - это все документы, подходящие под запрос
+            return key in self.candidates and (
+                self.candidates[key][0] >= size or len(self.candidates[key][1]) < self.candidates[key][0]
+            )
+
+        missing = {key: query for key, query in zip(keys, queries) if not found(key)}
+        if missing:
+            # при ошибке поиска q_msearch бросает исключение и в контекст ничего не попадает,
+            # следующий классификатор сценария повторит запрос
+            results = await es_client.q_msearch(index=index, queries=list(missing.values()), size=size)
+            self.candidates.update((key, (size, docs)) for key, docs in zip(missing, results))
+            self.searched += len(missing)
+        return [list(self.candidates[key][1][:size]) for key in keys]
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Literal, TypeVar
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from core.text_preprocessing.mystem_pool import MystemPoolSettings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+Pool = Literal["lemmatize", "scoring"]
+
+
+class ClassifierPoolsSettings(BaseSettings):
+    """Settings of the pools running blocking steps of classification."""
+
+    model_config = SettingsConfigDict(env_file_encoding="utf-8", env_prefix="classifier_pools_", extra="ignore")
+
+    # без пулов шаги выполняются прямо в event loop, как раньше
+    enabled: bool = True
+    # потоков лемматизации, по умолчанию по числу процессов Mystem в пуле
+    lemmatize_workers: int | None = None
+    # потоков для ранжирования кандидатов и плотного поиска
+    scoring_workers: int = 4
+
+
+class ClassifierPools:
+    """
+    Bounded thread pools for the blocking steps of classification, shared by all classifiers of the process.
+
+    Lemmatization waits for the Mystem pipe and scoring runs regular expressions and NumPy, so a slow request
+    doesn't stop the others on the event loop. The number of workers of a pool limits how many steps of the kind
+    run at once, the rest wait in the pool queue. Model inference goes through the inference scheduler.
+    """
+
+    _shared: "ClassifierPools | None" = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, settings: ClassifierPoolsSettings | None = None):
+        self.settings = settings or ClassifierPoolsSettings()
+        self.workers: dict[str, int] = {
+            "lemmatize": max(self.settings.lemmatize_workers or MystemPoolSettings().size or os.cpu_count() or 1, 1),
+            "scoring": max(self.settings.scoring_workers, 1),
+        }
+        self._executors: dict[str, ThreadPoolExecutor] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls) -> "ClassifierPools":
+        """The pools of the process, created at the first call"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _executor(self, pool: Pool) -> ThreadPoolExecutor:
+        with self._lock:
+            if pool not in self._executors:
+                self._executors[pool] = ThreadPoolExecutor(max_workers=self.workers[pool], thread_name_prefix=pool)
+                logger.info("%s pool with %i threads", pool, self.workers[pool])
+            return self._executors[pool]
+
+    async def run(self, pool: Pool, func: Callable[..., T], *args) -> T:
+        """Result of func(*args) computed in the pool"""
+        if not self.settings.enabled:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor(pool), func, *args)
+
+    def close(self):
+        with self._lock:
+            executors, self._executors = self._executors, {}
+        for executor in executors.values():
+            executor.shutdown(wait=True)
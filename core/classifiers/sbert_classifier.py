@@ -1,67 +1,213 @@
 import logging
 import os
+import time
+from abc import ABC
+from itertools import chain
+from typing import Callable
 
+import numpy as np
 import torch
 from sentence_transformers import SentenceTransformer
-from sentence_transformers.util import cos_sim
 
-from core.classifiers.base import ClassifierWithModel
-from core.elastic.queries import Bool, Match
-from core.exceptions import ScoreTooLow
-from core.schemas import SearchResponse
+from core.ann_index import AnnIndex, AnnSettings, live_generation
+from core.classifiers.base import Candidate, CandidatesClassifier, ClassifierWithModel
+from core.classifiers.context import RequestContext
+from core.embeddings import EtalonEmbeddings
+from core.exceptions import ClassifierException, ScoreTooLow
 from core.settings import MODELS_DIR
 
 logger = logging.getLogger(__name__)
 
-
-class SBERTClassifier(ClassifierWithModel):
-    models_names = ["all_sys_paraphrase.transformers"]
-
-    def load_models(self):
-        self.models["all_sys_paraphrase.transformers"] = SentenceTransformer(
-            str(os.path.join(MODELS_DIR, "all_sys_paraphrase.transformers")),
-            device="cuda" if torch.cuda.is_available() else "cpu",
+SBERT_MODEL = "all_sys_paraphrase.transformers"
+# сколько векторов запросов хранится между поиском кандидатов и ранжированием
+MAX_QUERY_VECTORS = 10_000
+
+
+def open_embeddings(model: SentenceTransformer, model_name: str) -> EtalonEmbeddings | None:
+    """Etalon embeddings store of the model if it is built and matches the model"""
+    store = EtalonEmbeddings.open(model_name)
+    if store is not None and store.meta["dim"] != model.get_sentence_embedding_dimension():
+        logger.warning("etalon embeddings in %s don't match the model %s, they are not used", store.path, model_name)
+        return None
+    return store
+
+
+def batch_similarities(
+    encode: Callable[[list[str]], np.ndarray],
+    queries: list[str],
+    candidates: list[list[str]],
+    store: EtalonEmbeddings | None = None,
+    query_vectors: dict[str, np.ndarray] | None = None,
+) -> list[list]:
+    """
+    Cosine similarities of every query to its candidates.
+
+    Vectors of candidates are taken from the etalon embeddings store and vectors of queries from query_vectors,
+    the rest are encoded in one batched pass. `encode` must return normalized vectors.
+    """
+    if not queries:
+        return []
+    query_vectors = query_vectors or {}
+    distinct = list(dict.fromkeys(chain.from_iterable(candidates)))
+    rows = store.rows(distinct) if store is not None else np.full(len(distinct), -1)
+    stored = rows >= 0
+
+    new_queries = (query for query in queries if query not in query_vectors)
+    to_encode = list(dict.fromkeys(chain(new_queries, (text for text, row in zip(distinct, rows) if row < 0))))
+    positions = {text: i for i, text in enumerate(to_encode)}
+    encoded = encode(to_encode) if to_encode else []
+
+    def vector(text: str) -> np.ndarray:
+        return query_vectors[text] if text not in positions else encoded[positions[text]]
+
+    candidate_vectors = np.empty((len(distinct), len(vector(queries[0]))), dtype=np.float32)
+    if stored.any():
+        candidate_vectors[stored] = store.vectors[rows[stored]]
+    if not stored.all():
+        candidate_vectors[~stored] = encoded[[positions[text] for text, row in zip(distinct, rows) if row < 0]]
+
+    index = {text: i for i, text in enumerate(distinct)}
+    return [
+        (candidate_vectors[[index[text] for text in texts_]] @ vector(query)).tolist()
+        for query, texts_ in zip(queries, candidates)
+    ]
+
+
+class SentenceEmbeddingClassifier(ClassifierWithModel, CandidatesClassifier, ABC):
+    """
+    Common part of the classifiers ranking candidates with the SBERT model.
+
+    Candidates are found with BM25 in the clusters index or, with `retrieval: ann` in the classifier params,
+    in the dense index of etalon embeddings without a request to Elasticsearch. The dense index is used only
+    while the alias points to the generation it was built from, otherwise candidates are searched in ES
+    until an index of the live generation is built.
+    """
+
+    # ключ модели SBERT в self.models
+    sbert_key: str = SBERT_MODEL
+    embeddings: EtalonEmbeddings | None = None
+    ann_index: AnnIndex | None = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # векторы запросов, посчитанные при поиске кандидатов, используются при ранжировании
+        self._query_vectors: dict[str, np.ndarray] = {}
+        self.ann_settings = AnnSettings()
+        # последняя открытая версия плотного индекса, используется, только если построена из текущего поколения
+        self._ann_latest: AnnIndex | None = None
+        self._ann_checked_at = float("-inf")
+
+    @property
+    def dense_retrieval(self) -> bool:
+        return self.params.model_extra.get("retrieval", "bm25") == "ann"
+
+    def load_embeddings(self):
+        """Opens the etalon embeddings store and the dense index, the SBERT model must be loaded"""
+        self.embeddings = open_embeddings(self.models[self.sbert_key], SBERT_MODEL)
+        if self.dense_retrieval:
+            self._ann_latest = AnnIndex.open(self.params.es_clusters_index, self.ann_settings)
+            if self._ann_latest is None:
+                logger.warning(
+                    "dense index of %s is not built, candidates are searched in ES", self.params.es_clusters_index
+                )
+
+    async def live_ann_index(self) -> AnnIndex | None:
+        """
+        The dense index built from the generation the alias points to, None if there is no such index.
+
+        The generation is checked once per check_interval, a newer version of the index is opened when it appears.
+        """
+        if not self.dense_retrieval or time.monotonic() - self._ann_checked_at < self.ann_settings.check_interval:
+            return self.ann_index
+        first_check = self._ann_checked_at == float("-inf")
+        self._ann_checked_at = time.monotonic()
+
+        index = self.params.es_clusters_index
+        versions = AnnIndex.versions(index, self.ann_settings)
+        if versions and (self._ann_latest is None or self._ann_latest.path != versions[-1]):
+            self._ann_latest = await self.pools.run("scoring", AnnIndex.open, index, self.ann_settings)
+
+        generation = await live_generation(self.es_client, index)
+        live = self._ann_latest if self._ann_latest is not None and self._ann_latest.generation == generation else None
+        if live is None and self._ann_latest is not None and (self.ann_index is not None or first_check):
+            logger.warning(
+                "dense index %s is built from %s, not from %s: candidates are searched in ES",
+                self._ann_latest.path,
+                self._ann_latest.generation,
+                generation,
+            )
+        self.ann_index = live
+        return live
+
+    @property
+    def candidates_size(self) -> int | None:
+        return self.params.num_candidates
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """Normalized SBERT vectors of the texts, runs in the scheduler worker"""
+        return self.models[self.sbert_key].encode(
+            texts, batch_size=64, show_progress_bar=False, normalize_embeddings=True
         )
 
-    async def classify(self, text: str, pub_id: int) -> SearchResponse:
-        tokens_str = " ".join(self.lemmatizer.tokenization([text])[0])
-
-        etalons_search_result = await self.es_client.q_search(
-            index=self.params.es_clusters_index,
-            query=Bool([Match("LemCluster", tokens_str), Match("ParentPubList", pub_id)]),
+    def score_candidates(self, items: list[tuple[str, list[str], np.ndarray | None]]) -> list[list]:
+        """Similarities for (query, candidates, query vector if known) items, runs in the scheduler worker"""
+        return batch_similarities(
+            self.encode,
+            [query for query, _, _ in items],
+            [candidates for _, candidates, _ in items],
+            self.embeddings,
+            {query: vector for query, _, vector in items if vector is not None},
         )
 
-        results_tuples = [
-            (d["ID"], d["Cluster"], d["LemCluster"]) for d in etalons_search_result[: self.params.num_candidates]
+    async def search_candidates(
+        self, tokens_strs: list[str], pub_ids: list[int], context: RequestContext | None = None
+    ) -> list[list[dict]]:
+        if (ann_index := await self.live_ann_index()) is None:
+            return await super().search_candidates(tokens_strs, pub_ids, context)
+
+        vectors = await self.scheduler.run(self.encode, tokens_strs)
+        if len(self._query_vectors) > MAX_QUERY_VECTORS:
+            self._query_vectors.clear()
+        self._query_vectors.update(zip(tokens_strs, vectors))
+        return await self.pools.run("scoring", self.ann_search, ann_index, vectors, pub_ids)
+
+    def ann_search(self, ann_index: AnnIndex, vectors: list[np.ndarray], pub_ids: list[int]) -> list[list[dict]]:
+        return [
+            ann_index.search(vector, pub_id, self.params.num_candidates) for vector, pub_id in zip(vectors, pub_ids)
         ]
 
-        text_emb = self.models["all_sys_paraphrase.transformers"].encode(
-            tokens_str, batch_size=64, show_progress_bar=False
-        )
-
-        ids, ets, lm_ets = zip(*results_tuples)
-        candidate_embs = self.models["all_sys_paraphrase.transformers"].encode(
-            lm_ets, batch_size=64, show_progress_bar=False
+    async def similarities(self, queries: list[str], candidates: list[list[str]]) -> list[list]:
+        # векторы запросов передаются в воркер вместе с запросами, словарь меняется только в event loop
+        return await self.scheduler.run(
+            self.score_candidates,
+            [(query, texts, self._query_vectors.get(query)) for query, texts in zip(queries, candidates)],
         )
 
-        scores = cos_sim(text_emb, candidate_embs)
-        scores_list = [score.item() for score in scores[0]]
-
-        the_best_result = sorted(list(zip(ids, ets, lm_ets, scores_list)), key=lambda x: x[3], reverse=True)[0]
-        logger.info("Best result from BERT: %s", the_best_result)
 
-        if the_best_result[3] < self.params.score_threshold:
-            raise ScoreTooLow(f"score {the_best_result[3]} is too low for text '''{tokens_str}'''")
+class SBERTClassifier(SentenceEmbeddingClassifier):
+    algorithm = "Sbert"
+    models_names = ["all_sys_paraphrase.transformers"]
 
-        found_answers = await self.es_client.q_search(
-            index=self.params.es_answers_index,
-            query=Bool([Match("templateId", the_best_result[0]), Match("pubId", pub_id)]),
+    def load_models(self):
+        self.models["all_sys_paraphrase.transformers"] = SentenceTransformer(
+            str(os.path.join(MODELS_DIR, "all_sys_paraphrase.transformers")),
+            device="cuda" if torch.cuda.is_available() else "cpu",
         )
+        self.load_embeddings()
 
-        return SearchResponse(
-            templateId=the_best_result[0],
-            templateText=str(found_answers[0]["templateText"]),
-            etalon_text=the_best_result[2],
-            algorithm="Sbert",
-            score=the_best_result[3],
+    async def rank_many(self, batch: list[tuple[str, int, list[dict]]]) -> list[list[Candidate] | ClassifierException]:
+        similarities = await self.similarities(
+            [tokens_str for tokens_str, _, _ in batch],
+            [[d["LemCluster"] for d in etalons] for _, _, etalons in batch],
         )
+
+        ranked = []
+        for (tokens_str, _, etalons), scores_list in zip(batch, similarities):
+            the_best_result, score = max(zip(etalons, scores_list), key=lambda x: x[1])
+            logger.info("Best result from BERT: %s", (the_best_result["ID"], the_best_result["LemCluster"], score))
+
+            if score < self.params.score_threshold:
+                ranked.append(ScoreTooLow(f"score {score} is too low for text '''{tokens_str}'''"))
+            else:
+                ranked.append([(the_best_result["ID"], the_best_result["LemCluster"], score)])
+        return ranked
@@ -4,51 +4,89 @@ import re
 
 import torch
 from sentence_transformers import SentenceTransformer
-from sentence_transformers.util import cos_sim
 from transformers import T5Tokenizer, T5ForConditionalGeneration
 
-from core.classifiers.base import ClassifierWithModel
-from core.elastic.queries import Bool, Match
-from core.exceptions import ScoreTooLow
-from core.schemas import SearchResponse
+from core.classifiers.base import Candidate
+from core.classifiers.sbert_classifier import SentenceEmbeddingClassifier
+from core.exceptions import ClassifierException, ConfigError, ScoreTooLow
 from core.settings import MODELS_DIR
+from core.utils.other import chunks
 
 logger = logging.getLogger(__name__)
 
+# ответ T5, при котором эталон подходит к запросу
+T5_TRUE = "Правда"
+# токен, сигмоида логита которого на первом шаге декодера сравнивается с t5_score
+T5_SCORE_TOKEN = 2
+T5_BATCH_SIZE = 16
 
-class SBERTT5Classifier(ClassifierWithModel):
+
+class SBERTT5Classifier(SentenceEmbeddingClassifier):
     """Модуль с классификатором, состоящим из Сберта с валидацией Т5"""
 
+    algorithm = "SbertT5"
     models_names = ["all_sys_paraphrase.transformers", "models_bss", "ruT5-large"]
+    sbert_key = "sbert-model"
+    # токен T5_TRUE, с которым сравнивается первый токен ответа при валидации одним шагом декодера
+    t5_true_token: int | None = None
+
+    @property
+    def t5_validation(self) -> str:
+        return self.params.model_extra.get("t5_validation", "generate")
 
     def load_models(self):
         self.models["sbert-model"] = SentenceTransformer(
             str(os.path.join(MODELS_DIR, "all_sys_paraphrase.transformers")),
             device="cuda" if torch.cuda.is_available() else "cpu",
         )
+        self.load_embeddings()
         self.models["t5-tokenizer"] = T5Tokenizer.from_pretrained(str(os.path.join(MODELS_DIR, "ruT5-large")))
         self.models["t5-model"] = T5ForConditionalGeneration.from_pretrained(
             str(os.path.join(MODELS_DIR, "models_bss"))
         ).to("cuda" if torch.cuda.is_available() else "cpu")
 
-    def sbert_ranging(self, lem_query: str, score: float, candidates: list):
-        text_emb = self.models["sbert-model"].encode(lem_query)
-        ids, ets, lm_ets, answs = zip(*candidates)
-        candidate_embs = self.models["sbert-model"].encode(lm_ets)
-        scores = cos_sim(text_emb, candidate_embs)
-        scores_list = [score.item() for score in scores[0]]
-        the_best_result = sorted(list(zip(ids, ets, lm_ets, answs, scores_list)), key=lambda x: x[4], reverse=True)[0]
-        logger.info("sbert_ranging the_best_result score = %s", the_best_result[4])
-
-        if the_best_result[4] < score:
-            raise ScoreTooLow(
-                f"sbert_ranging the_best_result score = {the_best_result[4]} is too low for text {lem_query}"
-            )
+        if self.t5_validation == "single_step":
+            # один шаг декодера видит только первый токен ответа
+            true_tokens = self.models["t5-tokenizer"].encode(T5_TRUE, add_special_tokens=False)
+            if len(true_tokens) != 1:
+                raise ConfigError(
+                    f"t5_validation single_step needs '{T5_TRUE}' to be one token of the T5 tokenizer, "
+                    f"got {true_tokens}"
+                )
+            self.t5_true_token = true_tokens[0]
+
+    async def sbert_ranging(self, lem_queries: list[str], score: float, candidates: list[list], top_k: int = 1) -> list:
+        """
+        Up to top_k best SBERT candidates with a score not below `score` for every query, best first,
+        or ScoreTooLow. Candidates are scored with one batched pass.
+        """
+        similarities = await self.similarities(
+            lem_queries, [[lm_et for _, _, lm_et, _ in cands] for cands in candidates]
+        )
 
-        return the_best_result
+        results = []
+        for lem_query, cands, scores_list in zip(lem_queries, candidates, similarities):
+            ids, ets, lm_ets, answs = zip(*cands)
+            ranged = sorted(zip(ids, ets, lm_ets, answs, scores_list), key=lambda x: -x[4])
+            the_best_result = ranged[0]
+            logger.info("sbert_ranging the_best_result score = %s", the_best_result[4])
+
+            if the_best_result[4] < score:
+                results.append(
+                    ScoreTooLow(
+                        f"sbert_ranging the_best_result score = {the_best_result[4]} is too low for text {lem_query}"
+                    )
+                )
+            else:
+                results.append([result for result in ranged[:top_k] if result[4] >= score])
+        return results
+
+    @staticmethod
+    def t5_input(query: str, answer: str) -> str:
+        return query + " Document: " + answer + " Relevant: "
 
     def t5_validate(self, query: str, answer: str, score: float):
-        text = query + " Document: " + answer + " Relevant: "
+        text = self.t5_input(query, answer)
         input_ids = (
             self.models["t5-tokenizer"]
             .encode(text, return_tensors="pt")
@@ -74,38 +112,91 @@ class SBERTT5Classifier(ClassifierWithModel):
             early_stopping=True,
         )
         sigmoid_0 = torch.sigmoid(outputs_logits.scores[0][0])
-        t5_score = sigmoid_0[2].item()
+        t5_score = sigmoid_0[T5_SCORE_TOKEN].item()
         val_str = re.sub("</s>", "", outputs_decode)
         logger.info("t5_validate answer is %s with score = %s", val_str, t5_score)
-        return val_str == "Правда" and t5_score >= score
-
-    async def classify(self, text: str, pub_id: int) -> SearchResponse:
-        tokens_str = " ".join(self.lemmatizer.tokenization([text])[0])
-
-        etalons_search_result = await self.es_client.q_search(
-            index=self.params.es_clusters_index,
-            query=Bool([Match("LemCluster", tokens_str), Match("ParentPubList", pub_id)]),
-        )
-
-        results_tuples = [
-            (d["ID"], d["Cluster"], d["LemCluster"], d["ShortAnswerText"])
-            for d in etalons_search_result[: self.params.num_candidates]
-        ]
-
-        sbert_the_best_result = self.sbert_ranging(tokens_str, self.params.model_extra["sbert_score"], results_tuples)
-
-        if not self.t5_validate(tokens_str, sbert_the_best_result[3], self.params.model_extra["t5_score"]):
-            raise ScoreTooLow(f"mouse didn't validate answer for input text {text}")
-
-        found_answers = await self.es_client.q_search(
-            index=self.params.es_answers_index,
-            query=Bool([Match("templateId", sbert_the_best_result[0]), Match("pubId", pub_id)]),
+        return val_str == T5_TRUE and t5_score >= score
+
+    def t5_validate_each(self, items: list[tuple[str, str, float]]) -> list[bool]:
+        """t5_validate for (query, answer, score) items, runs in the scheduler worker"""
+        return [self.t5_validate(query, answer, score) for query, answer, score in items]
+
+    def t5_validate_many(self, items: list[tuple[str, str, float]]) -> list[bool]:
+        """
+        Validates (query, answer, score) items with one encoder pass and one decoder step per batch,
+        runs in the scheduler worker.
+
+        The verdict is the most probable first token, as on the first step of the greedy decoding in t5_validate,
+        and the score is the sigmoid of the logit t5_validate reads, so the t5_score threshold keeps its meaning.
+        """
+        tokenizer, model = self.models["t5-tokenizer"], self.models["t5-model"]
+
+        verdicts = []
+        for batch in chunks(items, self.params.model_extra.get("t5_batch_size", T5_BATCH_SIZE)):
+            inputs = tokenizer(
+                [self.t5_input(query, answer) for query, answer, _ in batch], return_tensors="pt", padding=True
+            ).to(model.device)
+            decoder_input_ids = torch.full(
+                (len(batch), 1), model.config.decoder_start_token_id, dtype=torch.long, device=model.device
+            )
+            with torch.inference_mode():
+                logits = model(**inputs, decoder_input_ids=decoder_input_ids).logits[:, 0, :]
+            tokens = logits.argmax(dim=-1).tolist()
+            t5_scores = torch.sigmoid(logits[:, T5_SCORE_TOKEN]).tolist()
+
+            for (_, _, score), token, t5_score in zip(batch, tokens, t5_scores):
+                logger.info("t5_validate answer is %s with score = %s", tokenizer.decode([token]), t5_score)
+                verdicts.append(token == self.t5_true_token and t5_score >= score)
+        return verdicts
+
+    async def rank_many(self, batch: list[tuple[str, int, list[dict]]]) -> list[list[Candidate] | ClassifierException]:
+        """
+        Validates the best SBERT candidates with T5.
+
+        With `t5_validation: generate` (default) candidates are validated with generation round by round,
+        the n-th candidates of the texts without an accepted one in the n-th round. With `t5_validation: single_step`
+        the top `t5_top_k` candidates of all texts are validated together and every accepted one is returned
+        in SBERT order, so the next accepted candidate answers when the best one has no answer.
+        """
+        top_k = self.params.model_extra.get("t5_top_k", 1)
+        t5_score = self.params.model_extra["t5_score"]
+        sbert_results = await self.sbert_ranging(
+            [tokens_str for tokens_str, _, _ in batch],
+            self.params.model_extra["sbert_score"],
+            [
+                [(d["ID"], d["Cluster"], d["LemCluster"], d["ShortAnswerText"]) for d in etalons]
+                for _, _, etalons in batch
+            ],
+            top_k,
         )
+        validated = [results if isinstance(results, ClassifierException) else [] for results in sbert_results]
+        pending = [i for i, results in enumerate(sbert_results) if not isinstance(results, ClassifierException)]
 
-        return SearchResponse(
-            templateId=sbert_the_best_result[0],
-            templateText=str(found_answers[0]["templateText"]),
-            etalon_text=sbert_the_best_result[1],
-            algorithm="SbertT5",
-            score=sbert_the_best_result[4],
-        )
+        if self.t5_validation == "single_step":
+            pairs = [(i, result) for i in pending for result in sbert_results[i]]
+            verdicts = await self.scheduler.run(
+                self.t5_validate_many, [(batch[i][0], result[3], t5_score) for i, result in pairs]
+            )
+            for (i, result), verdict in zip(pairs, verdicts):
+                if verdict:
+                    validated[i].append(result)
+        else:
+            for n in range(top_k):
+                pending = [i for i in pending if n < len(sbert_results[i])]
+                verdicts = await self.scheduler.run(
+                    self.t5_validate_each, [(batch[i][0], sbert_results[i][n][3], t5_score) for i in pending]
+                )
+                for i, verdict in zip(pending, verdicts):
+                    if verdict:
+                        validated[i].append(sbert_results[i][n])
+                pending = [i for i, verdict in zip(pending, verdicts) if not verdict]
+
+        ranked = []
+        for (tokens_str, _, _), results in zip(batch, validated):
+            if isinstance(results, ClassifierException):
+                ranked.append(results)
+            elif not results:
+                ranked.append(ScoreTooLow(f"mouse didn't validate answer for input text {tokens_str}"))
+            else:
+                ranked.append([(result[0], result[1], result[4]) for result in results])
+        return ranked
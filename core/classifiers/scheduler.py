@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable
+
+from prometheus_client import Gauge, Histogram
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = Gauge("inference_queue_depth", "Inference requests waiting for a batch", ["scheduler"])
+BATCH_SIZE = Histogram(
+    "inference_batch_size",
+    "Items in one inference batch",
+    ["scheduler", "task"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+BATCH_SECONDS = Histogram("inference_batch_seconds", "Time of one inference batch", ["scheduler", "task"])
+
+
+class InferenceSchedulerSettings(BaseSettings):
+    """Model inference scheduler settings."""
+
+    model_config = SettingsConfigDict(env_file_encoding="utf-8", env_prefix="inference_", extra="ignore")
+
+    # без планировщика модели выполняются прямо в event loop, как раньше
+    enabled: bool = True
+    # сколько элементов набирается в одну пачку
+    max_batch_size: int = 64
+    # сколько ждать, пока пачка наберется, после первого запроса в ней, в секундах
+    max_latency: float = 0.005
+
+
+@dataclass
+class _Request:
+    task: Callable[[list], list]
+    items: list
+    future: Future = field(default_factory=Future)
+
+
+class InferenceScheduler:
+    """
+    Runs model inference in a dedicated worker thread with dynamic micro-batching.
+
+    A task is a function of a list of items returning a list of results in the same order, like encoding texts.
+    Requests of concurrent coroutines to the same task are merged into one call up to max_batch_size items
+    or until max_latency passes after the first of them, the results are split back and returned as awaitables.
+    A request larger than max_batch_size is run as one batch. The worker is a thread rather than a process:
+    models are shared without copying and torch releases the GIL during inference.
+    """
+
+    _shared: "InferenceScheduler | None" = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, name: str = "models", settings: InferenceSchedulerSettings | None = None):
+        self.name = name
+        self.settings = settings or InferenceSchedulerSettings()
+        self._queue: queue.SimpleQueue[_Request | None] = queue.SimpleQueue()
+        self._queue_depth = QUEUE_DEPTH.labels(scheduler=name)
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @classmethod
+    def shared(cls) -> "InferenceScheduler":
+        """The scheduler of the process, created at the first call"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def run(self, task: Callable[[list], list], items: list) -> list:
+        """Results of the task for the items, computed in the worker together with concurrent requests"""
+        if not items:
+            return []
+        if not self.settings.enabled:
+            return task(items)
+        return await asyncio.wrap_future(self.submit(task, items))
+
+    def submit(self, task: Callable[[list], list], items: list) -> Future:
+        """Queues the items for the task. Bound methods of the same object are the same task."""
+        request = _Request(task, list(items))
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"inference scheduler {self.name} is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name=f"inference-{self.name}", daemon=True)
+                self._thread.start()
+                logger.info(
+                    "inference scheduler %s: batches up to %i items, %.3f s to collect",
+                    self.name,
+                    self.settings.max_batch_size,
+                    self.settings.max_latency,
+                )
+            self._queue_depth.inc()
+            self._queue.put(request)
+        return request.future
+
+    def _work(self):
+        # запросы других задач, пришедшие во время сбора пачки, ждут следующих пачек в порядке поступления
+        deferred: deque[_Request] = deque()
+        stopping = False
+        while deferred or not stopping:
+            if deferred:
+                first = deferred.popleft()
+            elif (first := self._queue.get()) is None:
+                break
+            batch, size = [first], len(first.items)
+
+            for request in list(deferred):
+                if request.task == first.task and size + len(request.items) <= self.settings.max_batch_size:
+                    deferred.remove(request)
+                    batch.append(request)
+                    size += len(request.items)
+
+            deadline = time.monotonic() + self.settings.max_latency
+            while not stopping and size < self.settings.max_batch_size:
+                try:
+                    request = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                elif request.task == first.task and size + len(request.items) <= self.settings.max_batch_size:
+                    batch.append(request)
+                    size += len(request.items)
+                else:
+                    deferred.append(request)
+
+            self._queue_depth.dec(len(batch))
+            self._run_batch(first.task, batch)
+
+    def _run_batch(self, task: Callable[[list], list], batch: list[_Request]):
+        # запросы, которые уже не ждут, например после отмены корутины, не выполняются
+        if not (batch := [request for request in batch if request.future.set_running_or_notify_cancel()]):
+            return
+        size = sum(len(request.items) for request in batch)
+        task_name = getattr(task, "__name__", type(task).__name__)
+        BATCH_SIZE.labels(scheduler=self.name, task=task_name).observe(size)
+        start = time.perf_counter()
+        try:
+            results = task([item for request in batch for item in request.items])
+            if len(results) != size:
+                raise ValueError(f"task {task_name} returned {len(results)} results for {size} items")
+        except Exception as err:
+            for request in batch:
+                request.future.set_exception(err)
+            return
+        finally:
+            BATCH_SECONDS.labels(scheduler=self.name, task=task_name).observe(time.perf_counter() - start)
+
+        offset = 0
+        for request in batch:
+            request.future.set_result(list(results[offset : offset + len(request.items)]))
+            offset += len(request.items)
+
+    def close(self):
+        """Finishes queued requests and stops the worker"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if (thread := self._thread) is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
@@ -10,7 +10,8 @@ from gensim.models import TfidfModel
 from gensim.similarities import MatrixSimilarity
 
 from core.classifiers.base import ClassifierWithModel
-from core.exceptions import ScoreTooLow
+from core.classifiers.context import RequestContext
+from core.exceptions import AppException, ScoreTooLow
 from core.schemas import SearchResponse
 from core.settings import DATA_DIR
 
@@ -50,22 +51,38 @@ class TFIDFClassifier(ClassifierWithModel):
             l: a for l, a in set((lb, ans) for lb, ans in zip(etalons_df["label"], etalons_df["templateText"]))
         }
 
-    async def classify(self, text: str, pub_id: int) -> SearchResponse:
-        tokens = self.lemmatizer.tokenization([text])
-
-        in_corpus = self.dictionary.doc2bow(tokens[0])
-        in_vector = self.models["tfidf"][in_corpus]
-        sims = self.index[in_vector]
-        tfidf_tuples = [(num, scr) for num, scr in enumerate(list(sims), start=1) if scr >= self.params.score_threshold]
-        if not tfidf_tuples:
-            raise ScoreTooLow(f"scores are too low for text '''{text}'''")
-
-        tfidf_best = sorted(tfidf_tuples, key=lambda x: x[1], reverse=True)[0]
-
-        return SearchResponse(
-            templateId=tfidf_best[0],
-            templateText=self.answers[tfidf_best[0]],
-            etalon_text="",
-            algorithm="TFIDF",
-            score=tfidf_best[1],
-        )
+    def similarities(self, tokens_lists: list[list[str]]) -> list:
+        """Similarities of the texts to all groups, runs in the scheduler worker"""
+        in_vectors = [self.models["tfidf"][self.dictionary.doc2bow(tokens)] for tokens in tokens_lists]
+        return list(self.index[in_vectors])
+
+    async def classify_many(
+        self, requests: list[tuple[str, int]], context: RequestContext | None = None
+    ) -> list[SearchResponse | AppException]:
+        """Classifies a batch of texts, similarities of all texts are computed with one matrix product"""
+        if not requests:
+            return []
+        texts = [text for text, _ in requests]
+        tokens_lists = await self.pools.run("lemmatize", self.tokenize_many, texts, context)
+
+        results = []
+        for text, sims in zip(texts, await self.scheduler.run(self.similarities, tokens_lists)):
+            tfidf_tuples = [
+                (num, scr) for num, scr in enumerate(list(sims), start=1) if scr >= self.params.score_threshold
+            ]
+            if not tfidf_tuples:
+                results.append(ScoreTooLow(f"scores are too low for text '''{text}'''"))
+                continue
+
+            tfidf_best = sorted(tfidf_tuples, key=lambda x: x[1], reverse=True)[0]
+
+            results.append(
+                SearchResponse(
+                    templateId=tfidf_best[0],
+                    templateText=self.answers[tfidf_best[0]],
+                    etalon_text="",
+                    algorithm="TFIDF",
+                    score=tfidf_best[1],
+                )
+            )
+        return results
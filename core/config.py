@@ -1,6 +1,5 @@
 import os
 
-import pandas as pd
 import yaml
 from pydantic import field_validator, BaseModel, Extra
 from pydantic_settings import BaseSettings
@@ -8,6 +7,7 @@ from pydantic_settings import BaseSettings
 from core.classifiers import classifier_classes
 from core.exceptions import ConfigError
 from core.settings import CONFIG_FILE, MAPPING_FILE, DATA_DIR
+from core.text_preprocessing.stopwords_matcher import read_stopwords
 from core.utils.other import read_json
 
 
@@ -34,12 +34,7 @@ class ClassifierParams(BaseModel, extra=Extra.allow):
     @property
     def stopwords(self) -> list[str]:
         """Read stopwords from files"""
-        stopwords = []
-        for file_name in self.stopwords_files:
-            file_path = os.path.join(DATA_DIR, file_name)
-            stopwords_df = pd.read_csv(str(file_path), sep="\t")
-            stopwords.extend(stopwords_df["stopwords"].tolist())
-        return stopwords
+        return list(read_stopwords(tuple(self.stopwords_files or [])))
 
     @field_validator("class_name")
     def validate_class_name(cls, value):
@@ -119,12 +114,7 @@ class UpdateServiceConfig(BaseModel):
     @property
     def stopwords(self) -> list[str]:
         """Read stopwords from files"""
-        stopwords = []
-        for file_name in self.stopwords_files:
-            file_path = os.path.join(DATA_DIR, file_name)
-            stopwords_df = pd.read_csv(file_path, sep="\t")
-            stopwords.extend(stopwords_df["stopwords"].tolist())
-        return stopwords
+        return list(read_stopwords(tuple(self.stopwords_files or [])))
 
 
 classifiers_conf = ClassifiersConfig()
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from core.elastic.client import ElasticClient
+
+logger = logging.getLogger(__name__)
+
+# поля ответа, которые нужны классификаторам
+FIELDS = ["templateId", "pubId", "templateText", "urls"]
+
+
+class AnswersTableSettings(BaseSettings):
+    """In-process answers table settings."""
+
+    model_config = SettingsConfigDict(env_file_encoding="utf-8", env_prefix="answers_table_", extra="ignore")
+
+    enabled: bool = True
+    # как часто проверяется, не изменился ли индекс ответов или его поколение, в секундах
+    refresh_interval: float = 60.0
+    page_size: int = 10_000
+    keep_alive: str = "2m"
+
+
+def _key(template_id, pub_id) -> int | tuple[str, str]:
+    """Packs (templateId, pubId) into one int64, ids that don't fit are kept as strings"""
+    try:
+        template_id, pub_id = int(template_id), int(pub_id)
+    except (TypeError, ValueError):
+        return str(template_id), str(pub_id)
+    if 0 <= template_id < 2**31 and 0 <= pub_id < 2**32:
+        return template_id << 32 | pub_id
+    return str(template_id), str(pub_id)
+
+
+@dataclass(frozen=True)
+class AnswersData:
+    """Answers of one generation of the index. It is never changed, a new generation gets a new object."""
+
+    generation: tuple[str, ...]
+    # сколько раз документы индекса менялись к моменту загрузки
+    writes: int
+    # упакованные ключи по возрастанию и номера записей для них
+    keys: np.ndarray
+    rows: np.ndarray
+    # ключи, которые не упаковываются в int64
+    overflow: dict[tuple[str, str], int]
+    # (templateId, номер текста, ссылки по pubId): одна запись на документ, тексты не повторяются
+    records: list[tuple]
+    texts: list[str]
+
+    def row(self, template_id, pub_id) -> int | None:
+        key = _key(template_id, pub_id)
+        if isinstance(key, tuple):
+            return self.overflow.get(key)
+        pos = int(np.searchsorted(self.keys, key))
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return int(self.rows[pos])
+        return None
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.rows.nbytes + sum(len(text.encode("utf-8")) for text in self.texts)
+
+
+class _AnswersBuilder:
+    """Collects answer documents page by page and builds AnswersData, runs outside the event loop"""
+
+    def __init__(self):
+        self.keys, self.rows, self.overflow, self.records = [], [], {}, []
+        self.texts, self.text_ids, self.urls_ids = [], {}, {}
+
+    def add(self, docs: list[dict]):
+        for doc in docs:
+            text = str(doc["templateText"])
+            if (text_id := self.text_ids.get(text)) is None:
+                text_id = self.text_ids[text] = len(self.texts)
+                self.texts.append(text)
+            urls = doc.get("urls") or []
+            urls = self.urls_ids.setdefault(json.dumps(urls, sort_keys=True), urls)
+            self.records.append((doc["templateId"], text_id, urls))
+
+            pubs = doc["pubId"] if isinstance(doc["pubId"], list) else [doc["pubId"]]
+            for pub_id in pubs:
+                key = _key(doc["templateId"], pub_id)
+                if isinstance(key, tuple):
+                    self.overflow.setdefault(key, len(self.records) - 1)
+                else:
+                    self.keys.append(key)
+                    self.rows.append(len(self.records) - 1)
+
+    def build(self, generation: tuple[str, ...], writes: int) -> AnswersData:
+        keys_array = np.array(self.keys, dtype=np.int64)
+        rows_array = np.array(self.rows, dtype=np.int32)
+        order = np.argsort(keys_array, kind="stable")
+        # при повторе ключа остается первый документ
+        keys_array, first = np.unique(keys_array[order], return_index=True)
+        rows_array = rows_array[order][first]
+        return AnswersData(generation, writes, keys_array, rows_array, self.overflow, self.records, self.texts)
+
+
+class AnswersTable:
+    """
+    Answers of the answers index in memory, keyed by (templateId, pubId).
+
+    The index changes only when the update job runs, so the table is loaded once with a point in time
+    and reloaded in the background when the alias points to another generation or the index has new writes.
+    A compact answer shared by several pubs is stored once. While the table isn't loaded, readers fall back
+    to Elasticsearch.
+    """
+
+    def __init__(self, es_client: ElasticClient, index: str, settings: AnswersTableSettings | None = None):
+        self.es_client = es_client
+        self.index = index
+        self.settings = settings or AnswersTableSettings()
+        self._data: AnswersData | None = None
+        self._task: asyncio.Task | None = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    @property
+    def ready(self) -> bool:
+        return self._data is not None
+
+    @property
+    def generation(self) -> tuple[str, ...]:
+        return self._data.generation if self._data is not None else ()
+
+    def __len__(self) -> int:
+        return len(self._data.keys) + len(self._data.overflow) if self._data is not None else 0
+
+    def get(self, template_id, pub_id) -> dict | None:
+        """The answer document for the pub or None if there is no answer or the table isn't loaded"""
+        data = self._data
+        if data is None or (row := data.row(template_id, pub_id)) is None:
+            return None
+        template_id, text, urls = data.records[row]
+        return {"templateId": template_id, "templateText": data.texts[text], "urls": urls}
+
+    async def current_state(self) -> tuple[tuple[str, ...], int]:
+        """
+        Indexes the name points to and the number of writes to them.
+
+        A full update switches the alias to a new generation, a delta update writes to the live one.
+        Write counters start from zero after restarts of nodes, then the table is just reloaded once more.
+        """
+        generation = tuple(sorted(await self.es_client.alias_targets(self.index))) or (self.index,)
+        stats = await self.es_client.indices.stats(index=",".join(generation), metric="indexing")
+        writes = sum(
+            stats["indices"][index]["primaries"]["indexing"]["index_total"]
+            + stats["indices"][index]["primaries"]["indexing"]["delete_total"]
+            for index in generation
+        )
+        return generation, writes
+
+    async def load(self):
+        """Reads all answers of the current generation and replaces the table"""
+        start = time.perf_counter()
+        generation, writes = await self.current_state()
+
+        # страницы разбираются и таблица строится в потоке, в event loop только заменяется ссылка на нее
+        loop = asyncio.get_running_loop()
+        builder = _AnswersBuilder()
+        async for docs in self._scan():
+            await loop.run_in_executor(None, builder.add, docs)
+        data = await loop.run_in_executor(None, builder.build, generation, writes)
+
+        self._data = data
+        logger.info(
+            "answers table for %s loaded from %s: %i answers, %i texts, %i bytes in %.1f s",
+            self.index,
+            ",".join(generation),
+            len(self),
+            len(data.texts),
+            data.nbytes,
+            time.perf_counter() - start,
+        )
+
+    async def _scan(self):
+        """Pages of answer documents of the point in time"""
+        pit = await self.es_client.open_point_in_time(index=self.index, keep_alive=self.settings.keep_alive)
+        pit_id = pit["id"]
+        try:
+            search_after = None
+            while True:
+                response = await self.es_client.search(
+                    pit={"id": pit_id, "keep_alive": self.settings.keep_alive},
+                    sort=["_shard_doc"],
+                    size=self.settings.page_size,
+                    search_after=search_after,
+                    source=FIELDS,
+                )
+                pit_id = response.get("pit_id", pit_id)
+                hits = response["hits"]["hits"]
+                if hits:
+                    yield [hit["_source"] for hit in hits]
+                if len(hits) < self.settings.page_size:
+                    break
+                search_after = hits[-1]["sort"]
+        finally:
+            await self.es_client.close_point_in_time(id=pit_id)
+
+    async def refresh(self) -> bool:
+        """Reloads the table if the alias was switched to another generation or the index was changed"""
+        if self.ready and await self.current_state() == (self._data.generation, self._data.writes):
+            return False
+        await self.load()
+        return True
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.settings.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as err:
+                # таблица предыдущего поколения продолжает работать
+                logger.error("failed to refresh answers table for %s: %s", self.index, err)
+
+    async def start(self):
+        """Loads the table and starts background refreshes. A failed load leaves readers on Elasticsearch."""
+        if not self.settings.enabled:
+            return
+        try:
+            await self.load()
+        except Exception as err:
+            logger.error("failed to load answers table for %s: %s", self.index, err)
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
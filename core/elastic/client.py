@@ -1,11 +1,20 @@
+import asyncio
 import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import AsyncIterable, AsyncIterator
 
-from elasticsearch import AsyncElasticsearch
-from elasticsearch.helpers import async_bulk
+from elasticsearch import ApiError, AsyncElasticsearch
+from elasticsearch.helpers import async_bulk, async_scan
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from core.elastic.mappings import IndexDefinition
 from core.elastic.queries import BaseQuery
-from core.exceptions import ESResponseEmpty
+from core.exceptions import ESResponseEmpty, ESSearchError
+from core.utils.other import chunks
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +31,19 @@ class ElasticSettings(BaseSettings):
 
     max_hits: int = 300
     chunk_size: int = 500
+    # количество запросов в одном _msearch
+    msearch_max_searches: int = 100
+
+    # загрузка документов: пачки ограничены размером тела запроса, несколько запросов идут одновременно,
+    # документы, отклоненные из-за переполнения очереди (429), отправляются повторно с растущей паузой
+    bulk_max_bytes: int = 5 * 2**20
+    bulk_max_docs: int = 10_000
+    bulk_concurrency: int = 4
+    bulk_max_retries: int = 8
+    bulk_initial_backoff: float = 0.5
+    bulk_max_backoff: float = 30.0
+    http_compress: bool = False
+    forcemerge_timeout: int = 1800
 
     chat_history_index: str = "chat_history"
     results_index: str = "results"
@@ -34,6 +56,31 @@ class ElasticSettings(BaseSettings):
         return None
 
 
+# сколько отклоненных документов сохраняется в BulkStats для отчета
+MAX_FAILED_REPORTED = 100
+
+
+@dataclass
+class BulkStats:
+    """Result of a bulk load."""
+
+    docs: int = 0
+    errors: int = 0
+    bytes: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+    failed: list[dict] = field(default_factory=list)
+
+    @property
+    def docs_per_second(self) -> float:
+        return self.docs / self.seconds if self.seconds else 0.0
+
+    def add_failed(self, item: dict):
+        self.errors += 1
+        if len(self.failed) < MAX_FAILED_REPORTED:
+            self.failed.append(item)
+
+
 class ElasticClient(AsyncElasticsearch):
     """Elasticsearch client."""
 
@@ -45,25 +92,260 @@ class ElasticClient(AsyncElasticsearch):
             request_timeout=100,
             max_retries=10,
             retry_on_timeout=True,
+            http_compress=self.conf.http_compress,
             *args,
             **kwargs,
         )
 
-    async def create_index(self, index: str) -> None:
-        """Creates the index if one does not exist."""
-        if not await self.indices.exists(index=index):
+    async def create_index(self, index: str, definition: IndexDefinition | None = None) -> None:
+        """Creates the index if one does not exist, with mappings and settings of the definition if it is given."""
+        if await self.indices.exists(index=index):
+            return
+        if definition is None:
             await self.indices.create(index=index)
+        else:
+            await self.indices.create(index=index, mappings=definition.mappings, settings=definition.settings)
 
     async def delete_index(self, index: str) -> None:
         """Deletes the index if one exists."""
         if await self.indices.exists(index=index):
             await self.indices.delete(index=index)
 
-    async def add_docs(self, index_name: str, docs: list[dict]):
-        """Adds documents to the index."""
-        _gen = ({"_index": index_name, "_source": doc} for doc in docs)
-        await async_bulk(self, _gen, chunk_size=self.conf.chunk_size, stats_only=True)
-        logger.info("added %i documents to index %s", len(docs), index_name)
+    async def alias_targets(self, alias: str) -> list[str]:
+        """Returns names of the indexes the alias points to."""
+        if not await self.indices.exists_alias(name=alias):
+            return []
+        response = await self.indices.get_alias(name=alias)
+        return list(response.keys())
+
+    async def generations(self, alias: str) -> list[str]:
+        """Returns versioned indexes built for the alias, oldest first."""
+        response = await self.indices.get(index=f"{alias}-*", allow_no_indices=True)
+        return sorted(response.keys())
+
+    async def create_generation(self, alias: str, definition: IndexDefinition | None = None) -> str:
+        """Creates a new versioned index for the alias. It gets no traffic until the alias is switched to it."""
+        index = f"{alias}-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        await self.create_index(index, definition)
+        logger.info("created index %s for alias %s", index, alias)
+        return index
+
+    async def mapping_drift(self, index: str, definition: IndexDefinition) -> dict[str, list[str]]:
+        """Returns differences of mappings from the definition for every index behind the name."""
+        response = await self.indices.get_mapping(index=index)
+        drift = {name: definition.drift(values["mappings"]) for name, values in response.items()}
+        return {name: differences for name, differences in drift.items() if differences}
+
+    async def switch_alias(self, alias: str, index: str) -> None:
+        """Atomically points the alias to the index."""
+        await self.switch_aliases({alias: index})
+
+    async def switch_aliases(self, targets: dict[str, str]) -> None:
+        """
+        Atomically points every alias to its index in one request, so readers never see a mix of generations.
+
+        A concrete index left with the alias name (before aliases were introduced) is dropped in the same request.
+        """
+        actions = []
+        for alias, index in targets.items():
+            removes = [{"remove": {"index": old, "alias": alias}} for old in await self.alias_targets(alias)]
+            if not removes and await self.indices.exists(index=alias):
+                removes.append({"remove_index": {"index": alias}})
+            actions += removes + [{"add": {"index": index, "alias": alias}}]
+        await self.indices.update_aliases(actions=actions)
+        for alias, index in targets.items():
+            logger.info("alias %s switched to index %s", alias, index)
+
+    async def rollback_alias(self, alias: str) -> str | None:
+        """Points the alias back to the generation built before the current one."""
+        live = await self.alias_targets(alias)
+        previous = [index for index in await self.generations(alias) if live and index < min(live)]
+        if not previous:
+            logger.warning("no previous generation to roll alias %s back to", alias)
+            return None
+        await self.switch_alias(alias, previous[-1])
+        return previous[-1]
+
+    async def prune_generations(self, alias: str, keep: int) -> None:
+        """Deletes old generations of the alias, keeping the newest `keep` ones and any the alias points to."""
+        live = set(await self.alias_targets(alias))
+        generations = await self.generations(alias)
+        for index in generations[: max(len(generations) - keep, 0)]:
+            if index not in live:
+                await self.delete_index(index)
+                logger.info("pruned index %s of alias %s", index, alias)
+
+    @asynccontextmanager
+    async def bulk_load_mode(self, *indexes: str):
+        """
+        Tunes the indexes for a bulk load: no refreshes and no replicas until the block exits.
+
+        Then the previous settings are restored, and if the load succeeded the indexes are refreshed and force-merged.
+        """
+        index = ",".join(indexes)
+        load_settings = {"refresh_interval": "-1", "number_of_replicas": 0}
+        response = await self.indices.get_settings(index=index, name=[f"index.{key}" for key in load_settings])
+        previous = {
+            name: {key: values["settings"].get("index", {}).get(key) for key in load_settings}
+            for name, values in response.items()
+        }
+        await self.indices.put_settings(index=index, settings={"index": load_settings})
+        try:
+            yield
+        finally:
+            # отсутствующие значения (None) сбрасываются к значениям по умолчанию
+            for name, settings in previous.items():
+                await self.indices.put_settings(index=name, settings={"index": settings})
+        await self.indices.refresh(index=index)
+        await self.options(request_timeout=self.conf.forcemerge_timeout).indices.forcemerge(
+            index=index, max_num_segments=1
+        )
+        logger.info("indexes %s are refreshed and force-merged after bulk load", index)
+
+    async def _chunks(self, actions: AsyncIterable[tuple[dict, dict]], stats: BulkStats) -> AsyncIterator[list]:
+        """Serializes actions and groups them into chunks limited by payload size and documents quantity."""
+        serializer = self.transport.serializers.get_serializer("application/json")
+        chunk, chunk_bytes = [], 0
+        async for header, doc in actions:
+            lines = serializer.dumps(header) + b"\n" + serializer.dumps(doc) + b"\n"
+            full = chunk_bytes + len(lines) > self.conf.bulk_max_bytes or len(chunk) == self.conf.bulk_max_docs
+            if chunk and full:
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append((header, lines))
+            chunk_bytes += len(lines)
+            stats.bytes += len(lines)
+        if chunk:
+            yield chunk
+
+    async def _send_chunk(self, chunk: list[tuple[dict, bytes]], stats: BulkStats):
+        """Sends one bulk request, documents rejected with 429 are resent after a growing pause."""
+        backoff = self.conf.bulk_initial_backoff
+        for attempt in range(self.conf.bulk_max_retries + 1):
+            try:
+                response = await self.bulk(operations=[lines for _, lines in chunk])
+                items = [next(iter(item.values())) for item in response["items"]]
+            except ApiError as err:
+                if err.status_code != 429:
+                    raise
+                items = [{"status": 429, "error": str(err)}] * len(chunk)
+
+            rejected = []
+            for (header, lines), item in zip(chunk, items):
+                status = item.get("status", 500)
+                if 200 <= status < 300:
+                    stats.docs += 1
+                elif status == 429 and attempt < self.conf.bulk_max_retries:
+                    rejected.append((header, lines))
+                else:
+                    stats.add_failed({**header["index"], "status": status, "error": item.get("error")})
+                    logger.error("failed to index document %s: %s", header["index"], item.get("error"))
+            if not rejected:
+                return
+
+            chunk = rejected
+            stats.retries += 1
+            pause = min(backoff, self.conf.bulk_max_backoff) * random.uniform(0.5, 1.0)
+            logger.warning("%i documents rejected, retrying in %.1fs", len(chunk), pause)
+            await asyncio.sleep(pause)
+            backoff *= 2
+
+    async def _bulk(self, actions: AsyncIterable[tuple[dict, dict]]) -> BulkStats:
+        """Sends actions with several concurrent bulk requests."""
+        stats = BulkStats()
+        start = time.perf_counter()
+        queue = asyncio.Queue(maxsize=self.conf.bulk_concurrency)
+
+        async def produce():
+            async for chunk in self._chunks(actions, stats):
+                await queue.put(chunk)
+            for _ in range(self.conf.bulk_concurrency):
+                await queue.put(None)
+
+        async def consume():
+            while (chunk := await queue.get()) is not None:
+                await self._send_chunk(chunk, stats)
+
+        tasks = [asyncio.create_task(produce())]
+        tasks += [asyncio.create_task(consume()) for _ in range(self.conf.bulk_concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        stats.seconds = time.perf_counter() - start
+        return stats
+
+    @staticmethod
+    def _action(index_name: str, doc: dict, id_field: str | None) -> tuple[dict, dict]:
+        header = {"_index": index_name}
+        if id_field:
+            header["_id"] = doc[id_field]
+        return {"index": header}, doc
+
+    async def add_docs(self, index_name: str, docs: list[dict], id_field: str | None = None) -> BulkStats:
+        """
+        Adds documents to the index.
+
+        :param id_field: document field used as `_id`, so that documents with the same value are overwritten.
+        """
+
+        async def _gen():
+            for doc in docs:
+                yield self._action(index_name, doc, id_field)
+
+        stats = await self._bulk(_gen())
+        logger.info(
+            "added %i documents to index %s in %.1fs (%.0f docs/s), %i failed",
+            stats.docs,
+            index_name,
+            stats.seconds,
+            stats.docs_per_second,
+            stats.errors,
+        )
+        return stats
+
+    async def stream_docs(self, docs: AsyncIterable[tuple[str, dict]], id_field: str | None = None) -> BulkStats:
+        """
+        Adds documents from an async iterable of (index name, document) pairs.
+
+        Documents are pulled from the iterable chunk by chunk, so only a few chunks are held in memory.
+        """
+
+        async def _gen():
+            async for index_name, doc in docs:
+                yield self._action(index_name, doc, id_field)
+
+        stats = await self._bulk(_gen())
+        logger.info(
+            "added %i documents in %.1fs (%.0f docs/s), %i failed",
+            stats.docs,
+            stats.seconds,
+            stats.docs_per_second,
+            stats.errors,
+        )
+        return stats
+
+    async def delete_docs(self, index_name: str, ids: list[str]):
+        """Deletes documents from the index by their ids."""
+        _gen = ({"_op_type": "delete", "_index": index_name, "_id": _id} for _id in ids)
+        await async_bulk(self, _gen, chunk_size=self.conf.chunk_size, stats_only=True, raise_on_error=False)
+        logger.info("deleted %i documents from index %s", len(ids), index_name)
+
+    async def scan_ids(self, index: str, query: BaseQuery) -> set[str]:
+        """Returns ids of all documents matching the query."""
+        return {
+            hit["_id"] async for hit in async_scan(self, index=index, query={"query": query.to_dict()}, _source=False)
+        }
+
+    async def scan_sources(self, index: str, query: BaseQuery, fields: list[str]) -> list[dict]:
+        """Returns the given source fields of all documents matching the query."""
+        return [
+            hit["_source"]
+            async for hit in async_scan(self, index=index, query={"query": query.to_dict()}, _source=fields)
+        ]
 
     async def q_search(self, index: str, query: BaseQuery, size: int = None) -> list:
         """Searches for query in the index and returns a search result."""
@@ -77,6 +359,34 @@ class ElasticClient(AsyncElasticsearch):
         if not (hits := response["hits"]["hits"]):
             raise ESResponseEmpty(f"ES didn't find anything for query {query.to_dict()} in {index} index")
 
+        return self._docs(hits)
+
+    async def q_msearch(self, index: str, queries: list[BaseQuery], size: int = None) -> list[list]:
+        """
+        Searches for several queries in the index with multi-search requests.
+
+        Returns search results in the order of queries; a query without hits gets an empty list instead of
+        ESResponseEmpty. If any query fails, ESSearchError is raised, so a failure isn't taken for no hits.
+        """
+        results = []
+        for batch in chunks(queries, self.conf.msearch_max_searches):
+            searches = []
+            for query in batch:
+                searches += [{}, {"query": query.to_dict(), "size": size or self.conf.max_hits}]
+            response = await self.msearch(index=index, searches=searches)
+
+            errors = [(query, item["error"]) for query, item in zip(batch, response["responses"]) if "error" in item]
+            if errors:
+                query, error = errors[0]
+                raise ESSearchError(
+                    f"{len(errors)} of {len(batch)} searches in {index} index failed, "
+                    f"first for query {query.to_dict()}: {error}"
+                )
+            results += [self._docs(item["hits"]["hits"]) for item in response["responses"]]
+        return results
+
+    @staticmethod
+    def _docs(hits: list[dict]) -> list[dict]:
         return [
             {
                 **d["_source"],
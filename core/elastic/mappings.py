@@ -0,0 +1,91 @@
+from dataclasses import dataclass
+
+# меняется при любом изменении маппингов или настроек ниже; индексы старой версии перестраиваются полным обновлением
+MAPPINGS_VERSION = 1
+
+# LemCluster уже лемматизирован, приведен к нижнему регистру и очищен от пунктуации,
+# поэтому достаточно разбить его по пробелам; запросы классификаторов проходят тот же лемматизатор
+SETTINGS = {
+    "codec": "best_compression",
+    "analysis": {"analyzer": {"lemmas": {"type": "custom", "tokenizer": "whitespace"}}},
+}
+
+# идентификаторы и списки pubId только фильтруются, поэтому keyword: term-запросы по нему дешевле, чем по числам
+ID = {"type": "keyword"}
+LEMMAS = {"type": "text", "analyzer": "lemmas", "index_options": "freqs"}
+# поля только для отображения, хранятся в _source
+DISPLAY_TEXT = {"type": "text", "index": False}
+DISPLAY_NUMBER = {"type": "long", "index": False, "doc_values": False}
+
+
+@dataclass(frozen=True)
+class IndexDefinition:
+    """Mappings and settings of one kind of index."""
+
+    kind: str
+    properties: dict
+    version: int = MAPPINGS_VERSION
+
+    @property
+    def mappings(self) -> dict:
+        # неизвестные поля остаются в _source, но не индексируются
+        return {"dynamic": False, "_meta": {"kind": self.kind, "version": self.version}, "properties": self.properties}
+
+    @property
+    def settings(self) -> dict:
+        return SETTINGS
+
+    def drift(self, mappings: dict) -> list[str]:
+        """Differences of mappings of a live index from the definition."""
+        differences = []
+        version = mappings.get("_meta", {}).get("version")
+        if version != self.version:
+            differences.append(f"version {version} instead of {self.version}")
+
+        live = mappings.get("properties", {})
+        for name, expected in self.properties.items():
+            actual = live.get(name)
+            if actual is None:
+                differences.append(f"{name}: not mapped")
+            elif any(actual.get(key) != value for key, value in expected.items()):
+                differences.append(f"{name}: {actual} instead of {expected}")
+        differences += [f"{name}: unexpected field" for name in live.keys() - self.properties.keys()]
+        return differences
+
+
+CLUSTERS = IndexDefinition(
+    "clusters",
+    {
+        "SysID": ID,
+        "ID": ID,
+        "Cluster": DISPLAY_TEXT,
+        "LemCluster": LEMMAS,
+        "ParentModuleID": DISPLAY_NUMBER,
+        "ParentID": DISPLAY_NUMBER,
+        "ParentPubList": ID,
+        "ParentPubListSys": DISPLAY_NUMBER,
+        "ChildBlockModuleID": DISPLAY_NUMBER,
+        "ChildBlockID": DISPLAY_NUMBER,
+        "ModuleID": DISPLAY_NUMBER,
+        # КОСГУ ищет эталоны по фразе в Topic
+        "Topic": {"type": "text"},
+        "Subtopic": DISPLAY_TEXT,
+        "DocName": DISPLAY_TEXT,
+        "LemDocName": LEMMAS,
+        "ShortAnswerText": DISPLAY_TEXT,
+        "LemShortAnswerText": LEMMAS,
+        "ContentHash": ID,
+    },
+)
+
+ANSWERS = IndexDefinition(
+    "answers",
+    {
+        "SysID": ID,
+        "pubId": ID,
+        "templateId": ID,
+        "templateText": DISPLAY_TEXT,
+        "urls": {"type": "object", "enabled": False},
+        "ContentHash": ID,
+    },
+)
@@ -23,6 +23,23 @@ class MatchPhrase(Match):
         return {"match_phrase": {self.field: self.value}}
 
 
+@dataclass
+class Terms(BaseQuery):
+    field: str
+    values: list
+
+    def to_dict(self):
+        return {"terms": {self.field: list(self.values)}}
+
+
+@dataclass
+class Exists(BaseQuery):
+    field: str
+
+    def to_dict(self):
+        return {"exists": {"field": self.field}}
+
+
 @dataclass
 class MatchAll(BaseQuery):
     def to_dict(self):
@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import datetime
+from typing import Callable, Literal
+
+import numpy as np
+from elasticsearch.helpers import async_scan
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from core.elastic.client import ElasticClient
+from core.settings import DATA_DIR, EMBEDDINGS_DIR
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+KEYS_FILE = "keys.npy"
+VECTORS_FILE = "vectors.npy"
+
+
+class EmbeddingsSettings(BaseSettings):
+    """Etalon embeddings store settings."""
+
+    model_config = SettingsConfigDict(env_file_encoding="utf-8", env_prefix="embeddings_", extra="ignore")
+
+    enabled: bool = True
+    dir: str = EMBEDDINGS_DIR
+    # float16 вдвое компактнее, точности для косинусной близости хватает
+    dtype: Literal["float16", "float32"] = "float16"
+    batch_size: int = 256
+    # сколько последних версий хранилища хранить
+    keep: int = 2
+
+
+def text_key(text: str) -> int:
+    """Stable 63-bit key of a lemmatized text"""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little") >> 1
+
+
+class EtalonEmbeddings:
+    """
+    Normalized embeddings of lemmatized etalons, one row per distinct LemCluster.
+
+    Rows are keyed by the hash of the text rather than by document id, so equal etalons of different systems
+    share a row and the store stays valid for any generation of the indexes. The matrix is memory-mapped:
+    processes of the service share it through the page cache. Texts missing from the store are encoded
+    by the caller.
+    """
+
+    def __init__(self, path: str, meta: dict, keys: np.ndarray, vectors: np.ndarray):
+        self.path = path
+        self.meta = meta
+        self.keys = keys
+        self.vectors = vectors
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @staticmethod
+    def versions(model_name: str, settings: EmbeddingsSettings | None = None) -> list[str]:
+        """Paths of complete versions of the store for the model, oldest first."""
+        settings = settings or EmbeddingsSettings()
+        model_dir = os.path.join(settings.dir, model_name)
+        if not os.path.isdir(model_dir):
+            return []
+        paths = [os.path.join(model_dir, name) for name in sorted(os.listdir(model_dir))]
+        return [path for path in paths if os.path.exists(os.path.join(path, META_FILE))]
+
+    @classmethod
+    def open(cls, model_name: str, settings: EmbeddingsSettings | None = None) -> "EtalonEmbeddings | None":
+        """The newest version of the store for the model or None if there is none."""
+        settings = settings or EmbeddingsSettings()
+        if not settings.enabled or not (versions := cls.versions(model_name, settings)):
+            return None
+        path = versions[-1]
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as m_f:
+            meta = json.load(m_f)
+        store = cls(
+            path,
+            meta,
+            np.load(os.path.join(path, KEYS_FILE)),
+            np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r"),
+        )
+        logger.info("etalon embeddings of %s: %i texts from %s", model_name, len(store), path)
+        return store
+
+    def rows(self, texts: list[str]) -> np.ndarray:
+        """Rows of the texts in the matrix, -1 for texts not in the store"""
+        if not len(self.keys):
+            return np.full(len(texts), -1)
+        keys = np.fromiter((text_key(text) for text in texts), dtype=np.int64, count=len(texts))
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[positions] == keys, positions, -1)
+
+    @classmethod
+    def build(
+        cls,
+        model_name: str,
+        texts: list[str],
+        encode: Callable[[list[str]], np.ndarray],
+        settings: EmbeddingsSettings | None = None,
+    ) -> "EtalonEmbeddings":
+        """
+        Writes a new version of the store with the texts.
+
+        Vectors of texts already in the previous version are copied, only new texts are encoded.
+        `encode` must return normalized vectors.
+        """
+        settings = settings or EmbeddingsSettings()
+        start = time.perf_counter()
+        texts = sorted(set(texts), key=text_key)
+        keys = np.fromiter((text_key(text) for text in texts), dtype=np.int64, count=len(texts))
+
+        previous = cls.open(model_name, settings)
+        found = previous.rows(texts) if previous is not None else np.full(len(texts), -1)
+        missing, reused = np.flatnonzero(found < 0), np.flatnonzero(found >= 0)
+
+        path = os.path.join(settings.dir, model_name, datetime.now().strftime("%Y%m%d%H%M%S%f"))
+        os.makedirs(path)
+        np.save(os.path.join(path, KEYS_FILE), keys)
+
+        # матрица пишется сразу в файл, размерность известна из предыдущей версии или после первой пачки
+        vectors = None
+
+        def allocate(dim: int) -> np.ndarray:
+            return np.lib.format.open_memmap(
+                os.path.join(path, VECTORS_FILE), mode="w+", dtype=settings.dtype, shape=(len(texts), dim)
+            )
+
+        if previous is not None:
+            vectors = allocate(previous.vectors.shape[1])
+            vectors[reused] = previous.vectors[found[reused]]
+        for i in range(0, len(missing), settings.batch_size):
+            batch = missing[i : i + settings.batch_size]
+            encoded = np.asarray(encode([texts[j] for j in batch]), dtype=np.float32)
+            if vectors is None:
+                vectors = allocate(encoded.shape[1])
+            vectors[batch] = encoded
+        if vectors is None:
+            vectors = allocate(0)
+        vectors.flush()
+
+        meta = {"model": model_name, "dtype": settings.dtype, "texts": len(texts), "dim": int(vectors.shape[1])}
+        # meta.json пишется последним: без него версия считается незаконченной
+        with open(os.path.join(path, f"{META_FILE}.tmp"), "w", encoding="utf-8") as m_f:
+            json.dump(meta, m_f, ensure_ascii=False, indent=4)
+        os.replace(os.path.join(path, f"{META_FILE}.tmp"), os.path.join(path, META_FILE))
+
+        versions = cls.versions(model_name, settings)
+        for old in versions[: max(len(versions) - settings.keep, 0)]:
+            shutil.rmtree(old, ignore_errors=True)
+
+        logger.info(
+            "etalon embeddings of %s built in %s: %i texts, %i encoded, %i reused in %.1f s",
+            model_name,
+            path,
+            len(texts),
+            len(missing),
+            len(reused),
+            time.perf_counter() - start,
+        )
+        return cls.open(model_name, settings)
+
+
+async def read_etalons(es_client: ElasticClient, index: str, fields: list[str]) -> list[dict]:
+    """Etalons of the index with the fields"""
+    query = {"query": {"match_all": {}}}
+    return [hit["_source"] async for hit in async_scan(es_client, index=index, query=query, _source=fields)]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from sentence_transformers import SentenceTransformer
+
+    from core.ann_index import build_etalon_indexes
+
+    with open(os.path.join(DATA_DIR, "statistics_parameters.json"), "r", encoding="utf-8") as st_f:
+        stat_prmtrs = json.load(st_f)
+
+    parser = argparse.ArgumentParser(description="Расчет эмбеддингов эталонов для SBERT классификаторов")
+    parser.add_argument("--model", required=True, help="путь к модели SentenceTransformer")
+    parser.add_argument(
+        "--index",
+        action="append",
+        help="индексы эталонов, по умолчанию индексы эталонов и приветствий",
+    )
+    parser.add_argument("--ann", action="store_true", help="построить индексы для плотного поиска эталонов")
+    args = parser.parse_args()
+
+    model = SentenceTransformer(args.model)
+    es = ElasticClient()
+    indexes = args.index or [stat_prmtrs["clusters_index_name"], stat_prmtrs["greetings_index_name"]]
+
+    async def main():
+        try:
+            await build_etalon_indexes(
+                es,
+                indexes,
+                os.path.basename(os.path.normpath(args.model)),
+                lambda batch: model.encode(batch, batch_size=64, show_progress_bar=False, normalize_embeddings=True),
+                dense=args.ann,
+            )
+        finally:
+            await es.close()
+
+    asyncio.run(main())
@@ -15,6 +15,18 @@ class ESResponseEmpty(AppException):
     pass
 
 
+class ESSearchError(AppException):
+    pass
+
+
+class SnapshotError(AppException):
+    pass
+
+
+class BulkLoadError(AppException):
+    pass
+
+
 class ScoreTooLow(ClassifierException):
     pass
 
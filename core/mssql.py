@@ -1,9 +1,26 @@
+import json
 import logging
+import os
+import queue
+import threading
+import time
 from collections import namedtuple
+from contextlib import contextmanager
+from itertools import groupby
+from operator import attrgetter
+from typing import Iterator
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pymssql import connect
 
+from core.settings import FULL_DIFFS_FILE, WATERMARKS_FILE
+
+FAST_ANSWERS_QUERY = "SELECT * FROM StatisticsRAW.[search].FastAnswer_RBD WHERE "
+# строки, действующие на дату
+ACTIVE_CONDITION = "(ParentBegDate <= %s AND ParentEndDate IS NULL OR ParentBegDate <= %s AND ParentEndDate >= %s)"
+# строки, которые начали или перестали действовать между двумя датами
+CHANGED_CONDITION = "(ParentBegDate > %s AND ParentBegDate <= %s OR ParentEndDate >= %s AND ParentEndDate < %s)"
+
 ROW = namedtuple(
     "ROW",
     "SysID, ID, Cluster, ParentModuleID, ParentID, ParentPubList, "
@@ -26,73 +43,224 @@ class MSSQLSettings(BaseSettings):
     database: str = "master"
     as_dict: bool = True
     charset: str = "cp1251"
+    # сколько соединений держится открытыми для параллельных запросов
+    pool_size: int = 4
 
 
 class SQLDataFetcher:
-    """Class for getting data from MS Server with specific SQL Query."""
+    """
+    Class for getting data from MS Server with specific SQL Query.
+
+    Connections are kept in a pool and reused, every connection is used by one thread at a time.
+    """
 
     def __init__(self):
-        self.ms_set = MSSQLSettings().model_dump()
+        settings = MSSQLSettings()
+        self.ms_set = settings.model_dump(exclude={"pool_size"})
+        self.watermarks = self.load_dates(WATERMARKS_FILE)
+        self.full_diffs = self.load_dates(FULL_DIFFS_FILE)
+
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(settings.pool_size)
+
+    @staticmethod
+    def load_dates(file_name: str) -> dict[str, str]:
+        """Dates by SysID saved in file_name."""
+        if not os.path.exists(file_name):
+            return {}
+        with open(file_name, "r", encoding="utf-8") as dates_f:
+            return json.load(dates_f)
+
+    def save_watermarks(self) -> None:
+        """Saves dates of the last successful update and of the last comparison with all active rows."""
+        for file_name, dates in ((WATERMARKS_FILE, self.watermarks), (FULL_DIFFS_FILE, self.full_diffs)):
+            with open(file_name, "w", encoding="utf-8") as dates_f:
+                json.dump(dates, dates_f, ensure_ascii=False, indent=4)
+
+    def set_watermark(self, sys_id: int, date: str) -> None:
+        self.watermarks[str(sys_id)] = date
+
+    def set_full_diff(self, sys_id: int, date: str) -> None:
+        self.full_diffs[str(sys_id)] = date
 
     def establish_connection(self):
         """Establish connection to MS SQL Server."""
         try:
-            conn = connect(**self.ms_set)
+            return connect(**self.ms_set)
         except Exception as e:
             logger.error(e)
-        return conn
+            raise
+
+    @contextmanager
+    def connection(self):
+        """Connection from the pool, a connection that failed is closed instead of being returned."""
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self.establish_connection()
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            self._idle.put(conn)
+
+    def close(self) -> None:
+        """Closes idle connections of the pool."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    @staticmethod
+    def build_query(sys_id: int, date: str, since: str | None = None) -> tuple[str, tuple]:
+        """
+        Query and its parameters for the rows of sys_id valid on date.
+
+        :param since: If given, only rows whose validity changed after this date are selected:
+            rows that became valid and rows that expired. Rows edited in place keep their dates and aren't selected.
+        """
+        if since is None:
+            return FAST_ANSWERS_QUERY + "SysID = %d AND " + ACTIVE_CONDITION, (int(sys_id), date, date, date)
+        return FAST_ANSWERS_QUERY + "SysID = %d AND " + CHANGED_CONDITION, (int(sys_id), since, date, since, date)
+
+    @staticmethod
+    def build_systems_query(sys_ids: list[int], date: str) -> tuple[str, tuple]:
+        """One query for the rows of all systems valid on date, ordered by SysID."""
+        placeholders = ", ".join(["%d"] * len(sys_ids))
+        query = FAST_ANSWERS_QUERY + f"SysID IN ({placeholders}) AND " + ACTIVE_CONDITION + " ORDER BY SysID"
+        return query, (*[int(x) for x in sys_ids], date, date, date)
 
-    def fetch_from_db(self, sys_id: int, date: str):
+    def fetch_from_db(self, sys_id: int, date: str, since: str | None = None):
         """
         Fetch data from the database for a given sys_id and date.
 
         :param sys_id: An integer representing the sys_id.
         :param date: A string representing the date.
+        :param since: If given, only rows whose validity changed after this date are fetched.
 
         :return: A list of rows fetched from the database.
         """
-        today_str = "'" + str(date) + "'"
-        query = (
-            "SELECT * FROM StatisticsRAW.[search].FastAnswer_RBD  "
-            "WHERE SysID = {} AND (ParentBegDate <= {} AND ParentEndDate IS NULL "
-            "OR ParentBegDate <= {} AND  ParentEndDate >= {})".format(sys_id, today_str, today_str, today_str)
-        )
-
-        conn = self.establish_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(query)
+        start = time.perf_counter()
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(*self.build_query(sys_id, date, since))
             data_from_db = cursor.fetchall()
+        logger.info("Fetched %s rows for SysID %s in %.2fs", len(data_from_db), sys_id, time.perf_counter() - start)
 
         return data_from_db
 
-    def get_rows(self, sys_id: int, date: str) -> list:
-        """
-        Parsing rows from DB and returning list of unique tuples with etalons and list of tuples with data for answers
-        """
+    def parse_rows(self, data_from_db: list[dict]) -> list[ROW]:
         rows = []
-        data_from_db = self.fetch_from_db(sys_id, date)
         for row in data_from_db:
             try:
-                parent_pub_list = [int(pb) for pb in row["ParentPubList"].split(",") if pb != ""]
-                rows.append(
-                    ROW(
-                        row["SysID"],
-                        row["ID"],
-                        row["Cluster"],
-                        row["ParentModuleID"],
-                        row["ParentID"],
-                        parent_pub_list,
-                        row["ChildBlockModuleID"],
-                        row["ChildBlockID"],
-                        row["ModuleID"],
-                        row["Topic"],
-                        row["Subtopic"],
-                        row["DocName"],
-                        row["ShortAnswerText"],
-                    )
-                )
-
+                rows.append(self.parse_row(row))
             except ValueError as err:
                 logger.exception("Parsing %s with row: %s", err, row)
+        return rows
+
+    def iter_rows(self, sys_id: int, date: str, batch_size: int) -> Iterator[list[ROW]]:
+        """Yields parsed rows in batches of batch_size, so the whole system is never held in memory."""
+        quantity, start = 0, time.perf_counter()
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(*self.build_query(sys_id, date))
+            while data_from_db := cursor.fetchmany(batch_size):
+                rows = self.parse_rows(data_from_db)
+                quantity += len(rows)
+                if rows:
+                    yield rows
+        logger.info(
+            "Unique etalons tuples rows quantity is %s for SysID %s, fetched in %.2fs",
+            quantity,
+            sys_id,
+            time.perf_counter() - start,
+        )
+
+    def iter_systems_rows(self, sys_ids: list[int], date: str, batch_size: int) -> Iterator[tuple[int, list[ROW]]]:
+        """
+        Reads rows of all systems with one query and yields (SysID, rows) batches.
+
+        The rows are streamed from the server ordered by SysID, so systems come one after another
+        and a batch never mixes systems.
+        """
+        quantities, started = {}, {}
+        start = time.perf_counter()
+
+        def log_system(sys_id):
+            logger.info(
+                "Unique etalons tuples rows quantity is %s for SysID %s, fetched in %.2fs",
+                quantities[sys_id],
+                sys_id,
+                time.perf_counter() - started[sys_id],
+            )
+
+        current = None
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(*self.build_systems_query(sys_ids, date))
+            while data_from_db := cursor.fetchmany(batch_size):
+                for sys_id, rows in groupby(self.parse_rows(data_from_db), key=attrgetter("SysID")):
+                    if sys_id != current:
+                        if current is not None:
+                            log_system(current)
+                        current, started[sys_id], quantities[sys_id] = sys_id, time.perf_counter(), 0
+                    rows = list(rows)
+                    quantities[sys_id] += len(rows)
+                    yield sys_id, rows
+        if current is not None:
+            log_system(current)
+        logger.info("Fetched %s systems with one query in %.2fs", len(quantities), time.perf_counter() - start)
+
+    @staticmethod
+    def parse_row(row: dict) -> ROW:
+        """Converts a row from DB into ROW tuple."""
+        parent_pub_list = [int(pb) for pb in row["ParentPubList"].split(",") if pb != ""]
+        return ROW(
+            row["SysID"],
+            row["ID"],
+            row["Cluster"],
+            row["ParentModuleID"],
+            row["ParentID"],
+            parent_pub_list,
+            row["ChildBlockModuleID"],
+            row["ChildBlockID"],
+            row["ModuleID"],
+            row["Topic"],
+            row["Subtopic"],
+            row["DocName"],
+            row["ShortAnswerText"],
+        )
+
+    def get_rows(self, sys_id: int, date: str) -> list:
+        """
+        Parsing rows from DB and returning list of unique tuples with etalons and list of tuples with data for answers
+        """
+        rows = self.parse_rows(self.fetch_from_db(sys_id, date))
         logger.info("Unique etalons tuples rows quantity is %s for SysID %s", len(rows), sys_id)
         return rows
+
+    def get_changed_rows(self, sys_id: int, date: str, since: str) -> tuple[list, list]:
+        """
+        Returns rows whose validity changed between `since` and `date`:
+        the ones valid on `date` and the ones that expired.
+        """
+        active_rows, expired_rows = [], []
+        for row in self.fetch_from_db(sys_id, date, since):
+            try:
+                parsed = self.parse_row(row)
+            except ValueError as err:
+                logger.exception("Parsing %s with row: %s", err, row)
+                continue
+            end_date = row["ParentEndDate"]
+            if str(row["ParentBegDate"])[:10] <= date and (end_date is None or str(end_date)[:10] >= date):
+                active_rows.append(parsed)
+            else:
+                expired_rows.append(parsed)
+        logger.info(
+            "Changed rows for SysID %s since %s: %s active, %s expired",
+            sys_id,
+            since,
+            len(active_rows),
+            len(expired_rows),
+        )
+        return active_rows, expired_rows
@@ -10,10 +10,16 @@ from core.utils.logger import UnixSocketHandler, setup_logging
 
 PROJECT_ROOT_DIR = Path(__file__).parent.parent
 DATA_DIR = os.path.join(PROJECT_ROOT_DIR, "data")
-# MODELS_DIR = os.path.join(DATA_DIR, "models")
+MODELS_DIR = os.path.join(DATA_DIR, "models")
 
 # CONFIG_FILE = os.path.join(PROJECT_ROOT_DIR, "classifiers_config.yml")
 MAPPING_FILE = os.path.join(DATA_DIR, "sys_pub_mappings.json")
+WATERMARKS_FILE = os.path.join(DATA_DIR, "watermarks.json")
+FULL_DIFFS_FILE = os.path.join(DATA_DIR, "full_diffs.json")
+LEMMA_CACHE_FILE = os.path.join(DATA_DIR, "lemma_cache.sqlite")
+SNAPSHOTS_DIR = os.path.join(DATA_DIR, "snapshots")
+EMBEDDINGS_DIR = os.path.join(DATA_DIR, "embeddings")
+ANN_DIR = os.path.join(DATA_DIR, "ann")
 ENV_FILE = os.path.join(PROJECT_ROOT_DIR, ".env")
 
 print("PROJECT_ROOT_DIR:", PROJECT_ROOT_DIR)
@@ -0,0 +1,186 @@
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+from datetime import datetime
+from typing import Iterator
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from core.elastic.mappings import MAPPINGS_VERSION
+from core.exceptions import SnapshotError
+from core.settings import SNAPSHOTS_DIR
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+CLUSTERS, ANSWERS = "clusters", "answers"
+
+
+class SnapshotSettings(BaseSettings):
+    """Prepared corpus snapshots settings."""
+
+    model_config = SettingsConfigDict(env_file_encoding="utf-8", env_prefix="snapshot_", extra="ignore")
+
+    enabled: bool = True
+    dir: str = SNAPSHOTS_DIR
+    # сколько последних снимков хранить
+    keep: int = 2
+    compresslevel: int = 1
+
+
+class ShardWriter:
+    """Writes documents of one system into a temporary file, which becomes the shard on commit."""
+
+    def __init__(self, snapshot: "CorpusSnapshot", sys_id: str):
+        self.snapshot = snapshot
+        self.sys_id = sys_id
+        self.path = snapshot.shard_path(sys_id)
+        self.counts = {CLUSTERS: 0, ANSWERS: 0}
+        self._file = gzip.open(f"{self.path}.tmp", "wt", encoding="utf-8", compresslevel=snapshot.compresslevel)
+
+    def write(self, clusters: list[dict], answers: list[dict]):
+        for kind, docs in ((CLUSTERS, clusters), (ANSWERS, answers)):
+            for doc in docs:
+                self._file.write(json.dumps([kind, doc], ensure_ascii=False, default=str) + "\n")
+            self.counts[kind] += len(docs)
+
+    def commit(self):
+        self._file.close()
+        os.replace(f"{self.path}.tmp", self.path)
+        self.snapshot.add_system(self.sys_id, self.counts)
+
+    def discard(self):
+        self._file.close()
+        os.remove(f"{self.path}.tmp")
+
+
+class CorpusSnapshot:
+    """
+    Prepared MS SQL data of one update run: lemmatized clusters and generated answers.
+
+    Every system is stored in its own gzip JSONL shard and listed in the manifest when the shard is complete,
+    so a failed run can be resumed from the systems already prepared, and the indexes can be rebuilt
+    without MS SQL. The manifest is marked complete when the run that made the snapshot has switched the aliases.
+    A snapshot is reused only with the same preparation parameters.
+    """
+
+    def __init__(self, path: str, manifest: dict, compresslevel: int = 1):
+        self.path = path
+        self.manifest = manifest
+        self.compresslevel = compresslevel
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, params: dict, date: str, settings: SnapshotSettings | None = None) -> "CorpusSnapshot":
+        settings = settings or SnapshotSettings()
+        path = os.path.join(settings.dir, datetime.now().strftime("%Y%m%d%H%M%S%f"))
+        os.makedirs(path)
+        manifest = {"date": date, "params": params, "version": MAPPINGS_VERSION, "complete": False, "systems": {}}
+        snapshot = cls(path, manifest, settings.compresslevel)
+        snapshot.save_manifest()
+        logger.info("snapshot of prepared data: %s", path)
+        return snapshot
+
+    @classmethod
+    def open(cls, path: str, settings: SnapshotSettings | None = None) -> "CorpusSnapshot":
+        settings = settings or SnapshotSettings()
+        try:
+            with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as m_f:
+                manifest = json.load(m_f)
+        except (OSError, ValueError) as err:
+            raise SnapshotError(f"Can't read snapshot {path}: {err}") from err
+        return cls(path, manifest, settings.compresslevel)
+
+    @classmethod
+    def all(cls, settings: SnapshotSettings | None = None) -> list[str]:
+        """Paths of all snapshots, oldest first."""
+        settings = settings or SnapshotSettings()
+        if not os.path.isdir(settings.dir):
+            return []
+        paths = [os.path.join(settings.dir, name) for name in sorted(os.listdir(settings.dir))]
+        return [path for path in paths if os.path.exists(os.path.join(path, MANIFEST_FILE))]
+
+    @classmethod
+    def latest(cls, params: dict, complete: bool, settings: SnapshotSettings | None = None) -> "CorpusSnapshot | None":
+        """The newest complete or incomplete snapshot made with the same parameters."""
+        for path in reversed(cls.all(settings)):
+            snapshot = cls.open(path, settings)
+            if snapshot.matches(params) and snapshot.complete == complete:
+                return snapshot
+        return None
+
+    @classmethod
+    def interrupted(cls, params: dict, settings: SnapshotSettings | None = None) -> "CorpusSnapshot | None":
+        """The snapshot of the last run if that run didn't finish and was made with the same parameters."""
+        paths = cls.all(settings)
+        if not paths:
+            return None
+        snapshot = cls.open(paths[-1], settings)
+        if snapshot.complete or not snapshot.matches(params):
+            return None
+        return snapshot
+
+    @classmethod
+    def prune(cls, settings: SnapshotSettings | None = None):
+        """Deletes old snapshots, keeping the newest ones."""
+        settings = settings or SnapshotSettings()
+        paths = cls.all(settings)
+        for path in paths[: max(len(paths) - settings.keep, 0)]:
+            shutil.rmtree(path, ignore_errors=True)
+            logger.info("pruned snapshot %s", path)
+
+    @property
+    def date(self) -> str:
+        return self.manifest["date"]
+
+    @property
+    def complete(self) -> bool:
+        return self.manifest.get("complete", False)
+
+    def matches(self, params: dict) -> bool:
+        return self.manifest["params"] == params and self.manifest["version"] == MAPPINGS_VERSION
+
+    @property
+    def systems(self) -> set[str]:
+        """Systems with complete shards."""
+        return set(self.manifest["systems"])
+
+    def shard_path(self, sys_id: str) -> str:
+        return os.path.join(self.path, f"{sys_id}.jsonl.gz")
+
+    def save_manifest(self):
+        file_path = os.path.join(self.path, MANIFEST_FILE)
+        with open(f"{file_path}.tmp", "w", encoding="utf-8") as m_f:
+            json.dump(self.manifest, m_f, ensure_ascii=False, indent=4)
+        os.replace(f"{file_path}.tmp", file_path)
+
+    def add_system(self, sys_id: str, counts: dict[str, int]):
+        with self._lock:
+            self.manifest["systems"][sys_id] = counts
+            self.save_manifest()
+
+    def mark_complete(self):
+        with self._lock:
+            self.manifest["complete"] = True
+            self.save_manifest()
+
+    def writer(self, sys_id: str) -> ShardWriter:
+        return ShardWriter(self, sys_id)
+
+    def read(self, sys_id: str, batch_size: int) -> Iterator[tuple[list[dict], list[dict]]]:
+        """Yields clusters and answers of the system batch by batch."""
+        if sys_id not in self.manifest["systems"]:
+            raise SnapshotError(f"Snapshot {self.path} has no data for SysID {sys_id}")
+        batch = {CLUSTERS: [], ANSWERS: []}
+        with gzip.open(self.shard_path(sys_id), "rt", encoding="utf-8") as s_f:
+            for line in s_f:
+                kind, doc = json.loads(line)
+                batch[kind].append(doc)
+                if len(batch[CLUSTERS]) + len(batch[ANSWERS]) == batch_size:
+                    yield batch[CLUSTERS], batch[ANSWERS]
+                    batch = {CLUSTERS: [], ANSWERS: []}
+        if batch[CLUSTERS] or batch[ANSWERS]:
+            yield batch[CLUSTERS], batch[ANSWERS]
@@ -0,0 +1,130 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from core.settings import LEMMA_CACHE_FILE
+from core.utils.other import chunks
+
+logger = logging.getLogger(__name__)
+
+# ограничение sqlite на количество параметров в одном запросе
+SQLITE_MAX_VARIABLES = 900
+
+
+class LemmaCacheSettings(BaseSettings):
+    """Lemmatization cache settings."""
+
+    model_config = SettingsConfigDict(env_file_encoding="utf-8", env_prefix="lemma_cache_", extra="ignore")
+
+    path: str = LEMMA_CACHE_FILE
+    max_entries: int = 1_000_000
+    # как часто время использования найденных записей пишется в базу, в секундах
+    touch_interval: float = 60.0
+
+
+class LemmaCache:
+    """
+    Disk-backed cache of lemmatization results shared across update runs and classifiers.
+
+    Values are keyed by a hash of the normalized text and of the lemmatizer configuration (stopwords, synonyms).
+    When the cache grows over `max_entries`, the least recently used entries are evicted.
+    Reads only collect the found keys in memory, their use time is written once per `touch_interval`
+    and before every write, so a read doesn't commit.
+    """
+
+    def __init__(self, path: str | None = None, max_entries: int | None = None):
+        settings = LemmaCacheSettings()
+        self.path = path or settings.path
+        self.max_entries = max_entries or settings.max_entries
+        self.touch_interval = settings.touch_interval
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS lemmas (key TEXT PRIMARY KEY, tokens TEXT, used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS lemmas_used ON lemmas (used)")
+        self.conn.commit()
+        self._size = self.conn.execute("SELECT COUNT(*) FROM lemmas").fetchone()[0]
+        # ключи, найденные после последней записи времени использования
+        self._touched: set[str] = set()
+        self._touched_at = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str, fingerprint: str) -> str:
+        return hashlib.sha1(f"{fingerprint}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[str]]:
+        """Returns cached tokens for the keys found in the cache."""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for keys_chunk in chunks(unique_keys, SQLITE_MAX_VARIABLES):
+                placeholders = ",".join("?" * len(keys_chunk))
+                rows = self.conn.execute(f"SELECT key, tokens FROM lemmas WHERE key IN ({placeholders})", keys_chunk)
+                found.update((key, tokens.split()) for key, tokens in rows)
+
+            self._touched.update(found)
+            if time.monotonic() - self._touched_at >= self.touch_interval:
+                self._flush_touched()
+                self.conn.commit()
+
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items: dict[str, list[str]]) -> None:
+        """Stores tokens in the cache and evicts old entries if the cache is full."""
+        now = time.time()
+        with self._lock:
+            # время использования обновляется до вытеснения, чтобы не вытеснить недавно прочитанные записи
+            self._flush_touched()
+            changes_before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO lemmas (key, tokens, used) VALUES (?, ?, ?)",
+                ((key, " ".join(tokens), now) for key, tokens in items.items()),
+            )
+            self._size += self.conn.total_changes - changes_before
+
+            if self._size > self.max_entries:
+                excess = self._size - self.max_entries
+                self.conn.execute(
+                    "DELETE FROM lemmas WHERE key IN (SELECT key FROM lemmas ORDER BY used LIMIT ?)", (excess,)
+                )
+                self._size -= excess
+                logger.info("lemma cache: evicted %i entries", excess)
+            self.conn.commit()
+
+    def _flush_touched(self) -> None:
+        """Writes the use time of the keys read since the previous flush, the caller holds the lock and commits."""
+        now = time.time()
+        for keys_chunk in chunks(list(self._touched), SQLITE_MAX_VARIABLES):
+            placeholders = ",".join("?" * len(keys_chunk))
+            self.conn.execute(f"UPDATE lemmas SET used = ? WHERE key IN ({placeholders})", [now, *keys_chunk])
+        self._touched.clear()
+        self._touched_at = time.monotonic()
+
+    def log_stats(self) -> None:
+        """Logs hit/miss counters collected since the previous call and resets them."""
+        total = self.hits + self.misses
+        logger.info(
+            "lemma cache: %i hits, %i misses (hit rate %.1f%%), %i entries",
+            self.hits,
+            self.misses,
+            100 * self.hits / total if total else 0.0,
+            self._size,
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touched()
+            self.conn.commit()
+        self.conn.close()
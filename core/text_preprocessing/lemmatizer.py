@@ -1,20 +1,49 @@
+import hashlib
+import json
 import logging
 import operator
 import re
+import threading
+import weakref
+from contextlib import nullcontext
 from itertools import groupby
 
 from pymystem3 import Mystem
 
+from core.text_preprocessing.lemma_cache import LemmaCache
+from core.text_preprocessing.mystem_pool import MystemPool
+from core.text_preprocessing.stopwords_matcher import StopwordsMatcher
+
 logger = logging.getLogger(__name__)
 
+# Mystem отвечает через pipe на один запрос за раз, поэтому лемматизаторы с общим Mystem
+# из разных потоков обращаются к нему под одной блокировкой; MystemPool сам раздает запросы процессам
+_mystem_locks: "weakref.WeakKeyDictionary[Mystem, threading.Lock]" = weakref.WeakKeyDictionary()
+_mystem_locks_lock = threading.Lock()
+
+
+def _mystem_lock(mystem: Mystem | MystemPool):
+    if isinstance(mystem, MystemPool):
+        return nullcontext()
+    with _mystem_locks_lock:
+        return _mystem_locks.setdefault(mystem, threading.Lock())
+
 
 class TextLemmatizer:
-    def __init__(self, mystem: Mystem):
+    # лемматизированные стоп-слова и построенный по ним матчер общие для всех экземпляров
+    # с одинаковым набором стоп-слов
+    _shared_stopwords: dict[tuple[str, ...], tuple[list[str], StopwordsMatcher]] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, mystem: Mystem | MystemPool, cache: LemmaCache | None = None):
         self._stopwords = []
         self._synonyms = []
-        self.stopwords_patterns = re.compile("")
+        self.stopwords_matcher = StopwordsMatcher([])
+        self._fingerprint = ""
 
         self.mystem = mystem
+        self._mystem_lock = _mystem_lock(mystem)
+        self.cache = cache
 
     @staticmethod
     def _group_by_value(asc_dsc: list):
@@ -27,26 +56,67 @@ class TextLemmatizer:
     def _preprocess_text(text: str) -> str:
         return re.sub(r"[^\w\n\s]", " ", text)
 
+    @classmethod
+    def _normalize_text(cls, text: str) -> str:
+        """Text as it is seen by Mystem, used as a cache key"""
+        return " ".join(cls._preprocess_text(text).lower().split())
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the stop words and synonyms, tokenization results are the same for the same fingerprint"""
+        return self._fingerprint
+
+    def _update_fingerprint(self):
+        config = ["trie", self._stopwords, [(asc, pattern.pattern) for asc, pattern in self._synonyms]]
+        self._fingerprint = hashlib.sha1(json.dumps(config, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _cached(self, texts: list[str], fingerprint: str, compute) -> list[list[str]]:
+        """Takes results from the cache and computes only the missing ones"""
+        if self.cache is None:
+            return compute(texts)
+
+        normalized = [self._normalize_text(tx) for tx in texts]
+        keys = [self.cache.make_key(tx, fingerprint) for tx in normalized]
+        found = self.cache.get_many(keys)
+
+        missing = {key: tx for key, tx in zip(keys, normalized) if key not in found}
+        if missing:
+            computed = dict(zip(missing.keys(), compute(list(missing.values()))))
+            self.cache.put_many(computed)
+            found.update(computed)
+
+        return [found[key] for key in keys]
+
     def lemmatize_text(self, text: str) -> str:
         """Lemmatization for text. It returns lemmatized text"""
 
         text_ = self._preprocess_text(text)
-        lm_text = "".join(self.mystem.lemmatize(text_.lower())).strip()
+        with self._mystem_lock:
+            lm_text = "".join(self.mystem.lemmatize(text_.lower())).strip()
 
         return lm_text
 
     def lemmatize_texts(self, texts: list[str]) -> list[list[str]]:
         """Lemmatization for texts in list. It returns list with lemmatized texts"""
 
+        return self._cached(texts, "lemmas", self._lemmatize_texts)
+
+    def _lemmatize_texts(self, texts: list[str]) -> list[list[str]]:
         text_ = self._preprocess_text("\n".join(texts))
-        lm_texts = "".join(self.mystem.lemmatize(text_.lower()))
+        with self._mystem_lock:
+            lm_texts = "".join(self.mystem.lemmatize(text_.lower()))
         return [lm_tx.split() for lm_tx in lm_texts.split("\n")][:-1]
 
     def add_stopwords(self, stopwords: list[str]):
         """adding stop words into class"""
 
-        self._stopwords = [" ".join(x) for x in self.lemmatize_texts(stopwords)]
-        self.stopwords_patterns = re.compile("|".join([r"\b" + tx + r"\b" for tx in self._stopwords]))
+        key = tuple(stopwords)
+        with self._shared_lock:
+            if key not in self._shared_stopwords:
+                lemmatized = self.lemmatize_texts(list(stopwords))
+                self._shared_stopwords[key] = ([" ".join(x) for x in lemmatized], StopwordsMatcher(lemmatized))
+        self._stopwords, self.stopwords_matcher = self._shared_stopwords[key]
+        self._update_fingerprint()
 
     def add_synonyms(self, synonyms: list[str]):
         """adding stop words into class"""
@@ -56,20 +126,25 @@ class TextLemmatizer:
         syns_dct = dict(self._group_by_value(list(zip(lm_ascs, dscs))))
         for asc in syns_dct:
             self._synonyms.append((asc, re.compile("|".join([r"\b" + w + r"\b" for w in syns_dct[asc]]))))
+        self._update_fingerprint()
 
     def tokenization(self, texts: list[str]) -> list[list[str]]:
         """list of texts lemmatization with stop words deleting"""
 
-        lemm_texts = self.lemmatize_texts(texts)
+        return self._cached(texts, self._fingerprint, self._tokenization)
+
+    def _tokenization(self, texts: list[str]) -> list[list[str]]:
+        return self.filter_lemmas(self._lemmatize_texts(texts))
+
+    def filter_lemmas(self, lemm_texts: list[list[str]]) -> list[list[str]]:
+        """Synonyms replacement and stop words deleting for texts lemmatized by lemmatize_texts"""
         if self._synonyms:
             lem_texts_union = "\n".join([" ".join(lm_tx) for lm_tx in lemm_texts])
             for syn_pair in self._synonyms:
                 lem_texts_union = syn_pair[1].sub(syn_pair[0], lem_texts_union)
-            if self._stopwords:
-                return [self.stopwords_patterns.sub(" ", l_tx).split() for l_tx in lem_texts_union.split("\n")]
-            return [l_tx.split() for l_tx in lem_texts_union.split("\n")]
+            lemm_texts = [l_tx.split() for l_tx in lem_texts_union.split("\n")]
 
-        if self._stopwords:
-            return [self.stopwords_patterns.sub(" ", " ".join(l_tx)).split() for l_tx in lemm_texts]
+        if self.stopwords_matcher:
+            return [self.stopwords_matcher.remove(l_tx) for l_tx in lemm_texts]
 
         return lemm_texts
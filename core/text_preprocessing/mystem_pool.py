@@ -0,0 +1,84 @@
+import logging
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from pymystem3 import Mystem
+
+logger = logging.getLogger(__name__)
+
+
+class MystemPoolSettings(BaseSettings):
+    """Mystem processes pool settings."""
+
+    model_config = SettingsConfigDict(env_file_encoding="utf-8", env_prefix="mystem_pool_", extra="ignore")
+
+    # количество процессов Mystem, по умолчанию по числу ядер
+    size: int | None = None
+    # текст делится между процессами, только если на каждый приходится хотя бы столько строк
+    min_shard_lines: int = 200
+
+
+class MystemPool:
+    """
+    Several Mystem processes behind the Mystem interface.
+
+    Mystem analyzes input line by line, so a multiline text is split into contiguous shards of lines,
+    the shards are lemmatized by different processes at the same time and the results are concatenated
+    in the original order. The output is the same as of a single Mystem.
+    Every process is used by one thread at a time, so the pool can be shared between threads.
+    """
+
+    def __init__(self, size: int | None = None, min_shard_lines: int | None = None, **mystem_kwargs):
+        settings = MystemPoolSettings()
+        self.size = max(size or settings.size or os.cpu_count() or 1, 1)
+        self.min_shard_lines = max(min_shard_lines or settings.min_shard_lines, 1)
+
+        # процессы Mystem запускаются при первом обращении
+        self._idle: queue.SimpleQueue[Mystem] = queue.SimpleQueue()
+        self._mystems = [Mystem(**mystem_kwargs) for _ in range(self.size)]
+        for mystem in self._mystems:
+            self._idle.put(mystem)
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="mystem")
+        logger.info("Mystem pool with %i processes", self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _shards(self, text: str) -> list[str]:
+        lines = text.split("\n")
+        quantity = min(self.size, len(lines) // self.min_shard_lines)
+        if quantity < 2:
+            return [text]
+        size, rest = divmod(len(lines), quantity)
+        shards, start = [], 0
+        for i in range(quantity):
+            end = start + size + (i < rest)
+            shards.append("\n".join(lines[start:end]))
+            start = end
+        return shards
+
+    def _lemmatize_shard(self, text: str) -> list[str]:
+        mystem = self._idle.get()
+        try:
+            return mystem.lemmatize(text)
+        finally:
+            self._idle.put(mystem)
+
+    def lemmatize(self, text: str) -> list[str]:
+        """Same as Mystem.lemmatize, long texts are lemmatized by several processes"""
+        shards = self._shards(text)
+        if len(shards) == 1:
+            return self._lemmatize_shard(text)
+        futures = [self._executor.submit(self._lemmatize_shard, shard) for shard in shards]
+        return list(chain.from_iterable(future.result() for future in futures))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for mystem in self._mystems:
+            mystem.close()
@@ -0,0 +1,59 @@
+import os
+from functools import lru_cache
+
+import pandas as pd
+
+from core.settings import DATA_DIR
+
+# ключ узла префиксного дерева, означающий конец фразы
+_END = None
+
+
+@lru_cache(maxsize=None)
+def read_stopwords(file_names: tuple[str, ...]) -> tuple[str, ...]:
+    """Reads stopwords from files in DATA_DIR once per set of files"""
+    stopwords = []
+    for file_name in file_names:
+        stopwords_df = pd.read_csv(os.path.join(DATA_DIR, file_name), sep="\t")
+        stopwords.extend(stopwords_df["stopwords"].tolist())
+    return tuple(stopwords)
+
+
+class StopwordsMatcher:
+    """
+    Removes stopword phrases from lemmatized texts.
+
+    Phrases are stored in a prefix tree over lemmas, so a text is scanned once, token by token,
+    and the work per token is bounded by the length of the longest phrase. When several phrases
+    start at the same token, the longest one is removed.
+    """
+
+    def __init__(self, phrases: list[list[str]]):
+        self._trie = {}
+        for tokens in phrases:
+            if not tokens:
+                continue
+            node = self._trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[_END] = True
+
+    def __bool__(self):
+        return bool(self._trie)
+
+    def remove(self, tokens: list[str]) -> list[str]:
+        """Returns tokens without stopword phrases"""
+        result = []
+        i, length = 0, len(tokens)
+        while i < length:
+            node, j, phrase_end = self._trie, i, 0
+            while j < length and (node := node.get(tokens[j])) is not None:
+                j += 1
+                if _END in node:
+                    phrase_end = j
+            if phrase_end:
+                i = phrase_end
+            else:
+                result.append(tokens[i])
+                i += 1
+        return result
@@ -0,0 +1,99 @@
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, Counter, push_to_gateway, write_to_textfile
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = {
+    "rows_fetched": "Rows fetched from MS SQL",
+    "texts_lemmatized": "Texts sent to lemmatization",
+    "bulk_docs": "Documents sent with bulk requests",
+    "bulk_bytes": "Size of documents sent with bulk requests",
+    "bulk_errors": "Documents rejected by Elasticsearch",
+    "bulk_retries": "Bulk chunks retried after rejections",
+}
+
+
+class MetricsSettings(BaseSettings):
+    """Update job metrics export settings."""
+
+    model_config = SettingsConfigDict(env_file_encoding="utf-8", env_prefix="metrics_", extra="ignore")
+
+    # файл для textfile collector в node_exporter
+    textfile: str | None = None
+    pushgateway: str | None = None
+    job: str = "data_update"
+
+
+class UpdateMetrics:
+    """
+    Timings and counters of one update run.
+
+    Values are kept per stage and SysID. They are exported as Prometheus metrics and logged as one JSON record.
+    """
+
+    def __init__(self):
+        self.settings = MetricsSettings()
+        self.registry = CollectorRegistry()
+        self._stage_seconds = Counter(
+            "update_stage_seconds", "Time spent in update stages", ["stage", "sys_id"], registry=self.registry
+        )
+        self._counters = {
+            name: Counter(f"update_{name}", description, ["sys_id"], registry=self.registry)
+            for name, description in COUNTERS.items()
+        }
+        self._seconds = defaultdict(lambda: defaultdict(float))
+        self._counts = defaultdict(lambda: defaultdict(int))
+
+    @contextmanager
+    def span(self, stage: str, sys_id: str | int = ""):
+        """Measures time of the block, can wrap awaits as well."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, sys_id)
+
+    def observe(self, stage: str, seconds: float, sys_id: str | int = ""):
+        self._stage_seconds.labels(stage=stage, sys_id=str(sys_id)).inc(seconds)
+        self._seconds[stage][str(sys_id)] += seconds
+
+    def inc(self, name: str, value: int | float = 1, sys_id: str | int = ""):
+        self._counters[name].labels(sys_id=str(sys_id)).inc(value)
+        self._counts[name][str(sys_id)] += value
+
+    def stage_seconds(self, stage: str, sys_id: str | int = "") -> float:
+        return self._seconds[stage][str(sys_id)]
+
+    def summary(self) -> dict:
+        return {
+            "stages": {stage: round(sum(by_sys.values()), 3) for stage, by_sys in self._seconds.items()},
+            "counters": {name: sum(by_sys.values()) for name, by_sys in self._counts.items()},
+            "by_sys_id": {
+                "stages": {
+                    stage: {sys_id: round(seconds, 3) for sys_id, seconds in by_sys.items() if sys_id}
+                    for stage, by_sys in self._seconds.items()
+                },
+                "counters": {
+                    name: {sys_id: value for sys_id, value in by_sys.items() if sys_id}
+                    for name, by_sys in self._counts.items()
+                },
+            },
+        }
+
+    def export(self):
+        """Writes metrics to the textfile and/or pushes them to the pushgateway if they are configured."""
+        try:
+            if self.settings.textfile:
+                write_to_textfile(self.settings.textfile, self.registry)
+            if self.settings.pushgateway:
+                push_to_gateway(self.settings.pushgateway, job=self.settings.job, registry=self.registry)
+        except OSError as err:
+            logger.error("Failed to export update metrics: %s", err)
+
+    def log_summary(self):
+        logger.info("update summary", extra={"data": self.summary()})
@@ -1,3 +1,5 @@
+import asyncio
+import hashlib
 import json
 
 
@@ -7,7 +9,43 @@ def chunks(lst, n):
         yield lst[i : i + n]
 
 
+async def gather_or_cancel(*aws) -> list:
+    """Like asyncio.gather, but when one awaitable fails the others are cancelled instead of left running."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
 def read_json(file_path: str) -> dict:
     with open(file_path, "r", encoding="utf-8") as json_file:
         data = json.load(json_file)
     return data
+
+
+def content_hash(doc: dict) -> str:
+    """Stable hash of the document content, used as document id."""
+    dump = json.dumps(doc, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(dump.encode("utf-8")).hexdigest()
+
+
+# в компактной раскладке индекса ответов ссылка на систему подставляется в текст ответа при поиске
+URL_PLACEHOLDER = "{url}"
+
+
+def resolve_answer_text(answer: dict, pub_id: int) -> str:
+    """
+    Text of the answer for the pub.
+
+    Answers in the compact layout keep one document for all pubs of a system and a list of system urls
+    with their pubs; answers in the expanded layout already contain the final text.
+    """
+    text = str(answer["templateText"])
+    for group in answer.get("urls", []):
+        if int(pub_id) in group["pubs"]:
+            return text.replace(URL_PLACEHOLDER, group["url"])
+    return text
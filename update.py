@@ -1,21 +1,83 @@
+import asyncio
 import json
 import logging
 import os
-from collections import namedtuple
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+from typing import AsyncIterator, Literal, get_args
 
 import pandas as pd
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from pymystem3 import Mystem
 
-from core.elastic.client import ElasticClient
-from core.elastic.queries import Match
+from core.ann_index import build_etalon_indexes
+from core.elastic.client import BulkStats, ElasticClient
+from core.elastic.mappings import ANSWERS, CLUSTERS, IndexDefinition
+from core.elastic.queries import Bool, Exists, Match, Terms
+from core.exceptions import BulkLoadError, SnapshotError
 from core.mssql import SQLDataFetcher
 from core.settings import DATA_DIR
+from core.snapshot import CorpusSnapshot, SnapshotSettings
+from core.text_preprocessing.lemma_cache import LemmaCache
 from core.text_preprocessing.lemmatizer import TextLemmatizer
-from core.utils.other import chunks
+from core.text_preprocessing.mystem_pool import MystemPool
+from core.text_preprocessing.stopwords_matcher import read_stopwords
+from core.utils.metrics import UpdateMetrics
+from core.utils.other import URL_PLACEHOLDER, chunks, content_hash, gather_or_cancel
 
 logger = logging.getLogger(__name__)
 
+# из какого снимка перестраиваются индексы без MS SQL
+OfflineSource = Literal["complete", "incomplete"]
+
+ANSWER_TEXT = "Вот материал по вашему вопросу. Если это не совсем то, что нужно, я продолжу поиск "
+
+# стадии подготовки данных, время которых входит в поток документов для загрузки
+PREPARE_STAGES = ("fetch", "lemmatize", "answers", "snapshot_read", "snapshot_write")
+
+ROW_FOR_ANSWERS = namedtuple(
+    "ROW_FOR_ANSWERS",
+    "SysID, ID, ParentModuleID, ParentID, ChildBlockModuleID, ChildBlockID, ShortAnswerText",
+)
+
+
+class UpdateSettings(BaseSettings):
+    """Update service settings."""
+
+    model_config = SettingsConfigDict(env_file_encoding="utf-8", env_prefix="update_", extra="ignore")
+
+    # сколько поколений индексов хранить для каждого алиаса (включая текущее), чтобы можно было откатиться
+    keep_generations: int = 2
+    # сколько систем и групп csv файлов обрабатываются одновременно
+    concurrency: int = 4
+    # размер пачки строк из MS SQL, которая проходит лемматизацию и индексацию за один раз
+    batch_size: int = 5000
+    # expanded: документ ответа на каждую пару (pubId, templateId);
+    # compact: один документ на шаблон в системе со списком pubId, ссылка на систему подставляется при поиске.
+    # Раскладка меняется полным обновлением: новая версия индекса строится в нужной раскладке и алиас
+    # переключается на нее, классификаторы читают обе раскладки.
+    answers_layout: Literal["expanded", "compact"] = "expanded"
+    # новые версии индексов загружаются без обновлений и реплик, после загрузки настройки возвращаются
+    bulk_load_mode: bool = True
+    # сколько документов может отклонить Elasticsearch, прежде чем новая версия индексов будет отброшена
+    max_bulk_errors: int = 0
+    # строки всех систем читаются одним запросом вместо запроса на каждую систему
+    single_query: bool = False
+    # сколько последних лемматизированных текстов хранится в памяти для каждого набора стоп-слов;
+    # повторяются в основном шаблоны csv, названия документов и тексты ответов, остальное берется из LemmaCache
+    lemmas_memo_size: int = 200_000
+    # путь к модели SentenceTransformer: после обновления строятся эмбеддинги эталонов и плотные индексы
+    # для SBERT классификаторов из новых версий индексов эталонов и приветствий
+    ann_model: str | None = None
+    # раз в сколько дней дельта системы сравнивается со всеми действующими строками, а не только с окном отметки:
+    # запрос по отметке не видит строк, отредактированных без изменения дат действия; 0 - только по отметке
+    full_diff_days: int = 7
+
 
 class UpdateService:
     """
@@ -27,177 +89,648 @@ class UpdateService:
         self,
         es_client: ElasticClient,
         db_conn: SQLDataFetcher,
-        mystem: Mystem,
+        mystem: Mystem | MystemPool,
+        lemma_cache: LemmaCache | None = None,
         # first_sents_extraction: FirstSentenceExtractor,
     ):
         self.es_client = es_client
         self.db_conn = db_conn
         self.mystem = mystem
+        self.lemma_cache = lemma_cache
+        self.settings = UpdateSettings()
+        self.snapshot_settings = SnapshotSettings()
+        self.metrics = UpdateMetrics()
+
+        # запросы к MS SQL идут параллельно, у каждого свое соединение;
+        # одиночный Mystem работает через один процесс, поэтому лемматизация идет в одном потоке,
+        # с пулом процессов пачки разных систем лемматизируются одновременно
+        self._fetch_pool = ThreadPoolExecutor(max_workers=self.settings.concurrency, thread_name_prefix="mssql")
+        lemma_workers = min(getattr(mystem, "size", 1), self.settings.concurrency)
+        self._lemma_pool = ThreadPoolExecutor(max_workers=lemma_workers, thread_name_prefix="lemmatize")
+        self._limit = asyncio.Semaphore(self.settings.concurrency)
+        self._tokenizers: dict[tuple[str, ...], TextLemmatizer] = {}
+        self._tokenizers_lock = threading.Lock()
+        # в пределах одного запуска: леммы последних текстов для каждого набора стоп-слов и прочитанные csv файлы
+        self._lemmas_memo: dict[tuple[str, ...], OrderedDict[str, str]] = {}
+        self._lemmas_memo_lock = threading.Lock()
+        self._lemmatized = 0
+        # результаты загрузок текущего запуска, отклоненные документы не дают переключить алиасы
+        self._bulk_stats: list[BulkStats] = []
+        self._csv_records: dict[str, list[dict]] = {}
+
+        # эталоны и ответы из этого списка не попадают в индексы
+        self.deleted_templates = self.read_deleted_templates()
 
         # self.first_sents_extraction = first_sents_extraction
 
-    def texts_tokenize(self, texts: list[str], stopwords_roots: list[str]):
-        tokenizer = TextLemmatizer(mystem=self.mystem)
-        stopwords = []
+    def texts_tokenize(self, texts: list[str], stopwords_files: tuple[str, ...]):
+        with self._tokenizers_lock:
+            if stopwords_files not in self._tokenizers:
+                tokenizer = TextLemmatizer(mystem=self.mystem, cache=self.lemma_cache)
+                tokenizer.add_stopwords(list(read_stopwords(stopwords_files)))
+                self._tokenizers[stopwords_files] = tokenizer
+            tokenizer = self._tokenizers[stopwords_files]
+
+        # повторяющиеся тексты лемматизируются один раз, результат раздается всем строкам и системам;
+        # память ограничена lemmas_memo_size, вытесняются давно не встречавшиеся тексты
+        unique = list(dict.fromkeys(texts))
+        with self._lemmas_memo_lock:
+            memo = self._lemmas_memo.setdefault(stopwords_files, OrderedDict())
+            lemmas = {}
+            for tx in unique:
+                if tx in memo:
+                    memo.move_to_end(tx)
+                    lemmas[tx] = memo[tx]
+        missing = [tx for tx in unique if tx not in lemmas]
+        for texts_chunk in chunks(missing, 15000):
+            lm_texts = tokenizer.tokenization(texts_chunk)
+            lemmas.update(zip(texts_chunk, (" ".join(lm_text) for lm_text in lm_texts)))
+
+        with self._lemmas_memo_lock:
+            memo.update((tx, lemmas[tx]) for tx in missing)
+            while len(memo) > self.settings.lemmas_memo_size:
+                memo.popitem(last=False)
+            self._lemmatized += len(missing)
+        return [lemmas[tx] for tx in texts]
 
-        for root in stopwords_roots:
-            stopwords_df = pd.read_csv(root, sep="\t")
-            stopwords += list(stopwords_df["stopwords"])
-        tokenizer.add_stopwords(stopwords)
+    def update_data_with_lemmas(self, data_dicts: list[dict], **kwargs):
+        """Update the given data dictionaries with lemmas."""
 
-        results = []
-        for texts_chunk in chunks(texts, 15000):
-            results += [" ".join(lm_text) for lm_text in tokenizer.tokenization(texts_chunk)]
+        sws_roots = tuple(kwargs["stopwords_files"] or [])
 
-        return results
+        fields = [("Cluster", "LemCluster")]
+        if kwargs["LemDocName"]:
+            fields.append(("DocName", "LemDocName"))
+        if kwargs["LemShortAnswerText"]:
+            fields.append(("ShortAnswerText", "LemShortAnswerText"))
+
+        # тексты всех полей лемматизируются одним вызовом: названия документов и ответы повторяются у многих эталонов
+        texts = [str(x[field]) for field, _ in fields for x in data_dicts]
+        lem_texts = iter(self.texts_tokenize(texts, sws_roots))
+        for _, lem_field in fields:
+            for _dict in data_dicts:
+                _dict[lem_field] = next(lem_texts)
+
+    @staticmethod
+    def document_ids(row_tuple: ROW_FOR_ANSWERS) -> tuple:
+        """Module and id of the document the answer links to."""
+        if row_tuple.ParentModuleID == 16 and row_tuple.ChildBlockModuleID in [86, 12]:
+            return row_tuple.ChildBlockModuleID, row_tuple.ChildBlockID
+        return row_tuple.ParentModuleID, row_tuple.ParentID
+
+    @classmethod
+    def document_url(cls, sys_url: str, row_tuple: ROW_FOR_ANSWERS) -> str:
+        module_id, document_id = cls.document_ids(row_tuple)
+        return "/".join([sys_url, str(module_id), str(document_id), "actual/"])
+
+    @classmethod
+    def answer_key(cls, row_tuple: ROW_FOR_ANSWERS) -> tuple:
+        """Template and linked document, answers of a system are the same for rows with the same key."""
+        return int(row_tuple.ID), *cls.document_ids(row_tuple)
+
+    def answers_create(self, pubs_urls: list, row_tuples: list[ROW_FOR_ANSWERS]) -> list[dict]:
+        """Answers in the layout chosen in settings."""
+        if self.settings.answers_layout == "compact":
+            return self.compact_answers_create(pubs_urls, row_tuples)
+        return self.data_for_answer_create(pubs_urls, row_tuples)
+
+    @classmethod
+    def compact_answers_create(cls, pubs_urls: list, row_tuples: list[ROW_FOR_ANSWERS]) -> list[dict]:
+        """One answer for all pubs of the system, the system url is resolved by pubId at query time."""
+        urls = {}
+        for pub, sys_url in pubs_urls:
+            urls.setdefault(sys_url, []).append(int(pub))
+        urls_pubs = [{"url": url, "pubs": pubs} for url, pubs in urls.items()]
+        pubs = [int(pub) for pub, _ in pubs_urls]
+
+        answers = []
+        for row_tuple in row_tuples:
+            answer = {
+                "SysID": int(row_tuple.SysID),
+                "pubId": pubs,
+                "templateId": int(row_tuple.ID),
+                "templateText": " ".join([ANSWER_TEXT, cls.document_url(URL_PLACEHOLDER, row_tuple)]),
+                "urls": urls_pubs,
+            }
+            answer["ContentHash"] = content_hash(answer)
+            answers.append(answer)
+        return answers
+
+    @classmethod
+    def data_for_answer_create(cls, pubs_urls: list, row_tuples: list[ROW_FOR_ANSWERS]) -> list[dict]:
+        """Answers for every pub of the system: the same text with a link to the document."""
+        pubs_answers = []
+        for pub, sys_url in pubs_urls:
+            for row_tuple in row_tuples:
+                query_url = cls.document_url(sys_url, row_tuple)
+
+                """
+                # Выключение добавления первого предложения:
+                first_sentence = self.first_sents_extraction([row_tuple.ShortAnswerText])
+                first_sentence = [s for s in first_sentence if s is not None]
+                if first_sentence:
+                    variants = [
+                        "Далее см.",
+                        "Подробнее см.",
+                        "Читайте подробнее",
+                        "Ссылка по вашему вопросу",
+                        "Смотрите подробнее",
+                        "Подробнее смотрите",
+                        "Подробнее в материале",
+                        "Вот ссылка по вашему вопросу",
+                        "Далее читайте",
+                    ]
+                    answer_text = " ".join([first_sentence[0], choice(variants)])
+                else:
+                    answer_text = "Вот ссылка по вашему вопросу: "
+                """
+
+                answer_text = ANSWER_TEXT
+                answer = {
+                    "pubId": int(pub),
+                    "templateId": int(row_tuple.ID),
+                    "templateText": " ".join([answer_text, str(query_url)]),
+                }
+                answer["ContentHash"] = content_hash(answer)
+                pubs_answers.append(answer)
+        return pubs_answers
+
+    @staticmethod
+    def rows_to_dicts(rows: list, pubs: list[int]) -> list[dict]:
+        """Converts rows from MS SQL into clusters documents with content hashes."""
+        data_dicts = [nt._asdict() for nt in rows]
+        for d in data_dicts:
+            # добавление ParentPubListSys и присвоение этому элементу значений из ParentPubList
+            d["ParentPubListSys"] = d.pop("ParentPubList")
+            # добавление ParentPubList с PubIds из statistics_parameters
+            d["ParentPubList"] = pubs
+            # хеш считается до лемматизации, чтобы неизмененные строки не лемматизировать повторно
+            d["ContentHash"] = content_hash(d)
+        return data_dicts
+
+    @staticmethod
+    def read_deleted_templates() -> set[int]:
+        """Template ids from del_answers.csv"""
+        dataframe = pd.read_csv(os.path.join(DATA_DIR, "del_answers.csv"), sep="\t")
+        return {int(template_id) for template_id in dataframe["TemplateId"]}
+
+    def drop_deleted(self, rows: list) -> list:
+        """Filters out rows of templates listed in del_answers.csv before they are lemmatized and indexed."""
+        return [r for r in rows if int(r.ID) not in self.deleted_templates]
+
+    @staticmethod
+    def rows_for_answers(rows: list) -> list[ROW_FOR_ANSWERS]:
+        """Unique tuples with data for answers."""
+        rows_answers = [
+            ROW_FOR_ANSWERS(
+                r.SysID, r.ID, r.ParentModuleID, r.ParentID, r.ChildBlockModuleID, r.ChildBlockID, r.ShortAnswerText
+            )
+            for r in rows
+        ]
+        return list(set(rows_answers))
 
-    def update_data_with_lemmas(self, data_dicts: list[dict], **kwargs):
-        """Update the given data dictionaries with lemmas."""
+    async def lemmatize(self, data_dicts: list[dict], label: str = "", **kwargs):
+        """
+        Runs update_data_with_lemmas in the lemmatization worker without blocking the event loop.
 
-        sws_roots = []
-        if kwargs["stopwords_files"]:
-            for file_name in kwargs["stopwords_files"]:
-                sws_roots.append(os.path.join(DATA_DIR, file_name))
+        :param label: SysID the data belongs to, used in metrics.
+        """
+        loop = asyncio.get_running_loop()
+        with self.metrics.span("lemmatize", label):
+            await loop.run_in_executor(self._lemma_pool, partial(self.update_data_with_lemmas, data_dicts, **kwargs))
+        fields = 1 + bool(kwargs["LemDocName"]) + bool(kwargs["LemShortAnswerText"])
+        self.metrics.inc("texts_lemmatized", len(data_dicts) * fields, label)
+
+    async def fetch_rows(self, sys_id: str, today: str) -> list:
+        loop = asyncio.get_running_loop()
+        with self.metrics.span("fetch", sys_id):
+            rows = await loop.run_in_executor(self._fetch_pool, self.db_conn.get_rows, int(sys_id), today)
+        self.metrics.inc("rows_fetched", len(rows), sys_id)
+        return rows
+
+    def record_bulk(self, stats: BulkStats, label: str = ""):
+        self.metrics.inc("bulk_docs", stats.docs, label)
+        self.metrics.inc("bulk_bytes", stats.bytes, label)
+        self.metrics.inc("bulk_errors", stats.errors, label)
+        self.metrics.inc("bulk_retries", stats.retries, label)
+        self._bulk_stats.append(stats)
+
+    def check_bulk_errors(self):
+        """Raises BulkLoadError if Elasticsearch rejected more documents of the run than max_bulk_errors."""
+        errors = sum(stats.errors for stats in self._bulk_stats)
+        if errors > self.settings.max_bulk_errors:
+            failed = [item for stats in self._bulk_stats for item in stats.failed][:5]
+            raise BulkLoadError(f"{errors} documents were rejected by Elasticsearch, for example: {failed}")
+
+    async def iter_sys_batches(
+        self, sys_id: str, today: str, rows_queue: asyncio.Queue | None = None, **kwargs
+    ) -> AsyncIterator[tuple[list[dict], list[dict]]]:
+        """
+        Yields prepared clusters and answers of one system batch by batch.
 
-        clusters = [str(x["Cluster"]) for x in data_dicts]
-        lem_clusters = self.texts_tokenize(clusters, sws_roots)
-        for _dict, l_c in zip(data_dicts, lem_clusters):
-            _dict["LemCluster"] = l_c
+        Rows are read from MS SQL with fetchmany, so memory is bounded by the batch size, not by the system size.
 
-        if kwargs["LemDocName"]:
-            doc_names = [str(x["DocName"]) for x in data_dicts]
-            lem_doc_names = self.texts_tokenize(doc_names, sws_roots)
-            for _dict, l_dn in zip(data_dicts, lem_doc_names):
-                _dict["LemDocName"] = l_dn
+        :param rows_queue: batches of the system read by the query for all systems, None at the end.
+            If it is not given, the system is queried on its own.
+        """
+        loop = asyncio.get_running_loop()
+        pubs_urls = kwargs["sys_pub_url"][sys_id]
+        if rows_queue is None:
+            rows_iter = self.db_conn.iter_rows(int(sys_id), today, self.settings.batch_size)
+        # ключи уже созданных ответов системы, а не сами строки с текстами
+        seen_answers: set[tuple] = set()
+        while True:
+            with self.metrics.span("fetch", sys_id):
+                if rows_queue is None:
+                    batch = await loop.run_in_executor(self._fetch_pool, next, rows_iter, None)
+                else:
+                    batch = await rows_queue.get()
+            if isinstance(batch, Exception):
+                raise batch
+            if not batch:
+                break
+            self.metrics.inc("rows_fetched", len(batch), sys_id)
+            if not (rows := self.drop_deleted(batch)):
+                continue
+            data_dicts = self.rows_to_dicts(rows, [x[0] for x in pubs_urls])
+            await self.lemmatize(data_dicts, sys_id, **kwargs)
+
+            with self.metrics.span("answers", sys_id):
+                rows_answers = []
+                for row in self.rows_for_answers(rows):
+                    if (key := self.answer_key(row)) not in seen_answers:
+                        seen_answers.add(key)
+                        rows_answers.append(row)
+                answers = self.answers_create(pubs_urls, rows_answers)
+            yield data_dicts, answers
+
+    async def route_systems_rows(self, today: str, queues: dict[str, asyncio.Queue]):
+        """
+        Reads rows of the systems with one query and passes the batches to the queues of the systems.
 
-        if kwargs["LemShortAnswerText"]:
-            short_answers = [str(x["ShortAnswerText"]) for x in data_dicts]
-            lem_short_answers = self.texts_tokenize(short_answers, sws_roots)
-            for _dict, l_sa in zip(data_dicts, lem_clusters, lem_short_answers):
-                _dict["LemShortAnswerText"] = l_sa
-
-    async def get_msdb_data(self, **kwargs):
-        ROW_FOR_ANSWERS = namedtuple(
-            "ROW_FOR_ANSWERS",
-            "SysID, ID, ParentModuleID, ParentID, ChildBlockModuleID, ChildBlockID, ShortAnswerText",
-        )
-
-        def data_for_answer_create(pubs_urls: list, row_tuples: list[ROW_FOR_ANSWERS]):
-            pubs_answers = []
-            for pub, sys_url in pubs_urls:
-                for row_tuple in row_tuples:
-                    if row_tuple.ParentModuleID == 16 and row_tuple.ChildBlockModuleID in [86, 12]:
-                        module_id = row_tuple.ChildBlockModuleID
-                        document_id = row_tuple.ChildBlockID
-                    else:
-                        module_id = row_tuple.ParentModuleID
-                        document_id = row_tuple.ParentID
-
-                    query_url = "/".join([sys_url, str(module_id), str(document_id), "actual/"])
-
-                    """
-                    # Выключение добавления первого предложения:
-                    first_sentence = self.first_sents_extraction([row_tuple.ShortAnswerText])
-                    first_sentence = [s for s in first_sentence if s is not None]
-                    if first_sentence:
-                        variants = [
-                            "Далее см.",
-                            "Подробнее см.",
-                            "Читайте подробнее",
-                            "Ссылка по вашему вопросу",
-                            "Смотрите подробнее",
-                            "Подробнее смотрите",
-                            "Подробнее в материале",
-                            "Вот ссылка по вашему вопросу",
-                            "Далее читайте",
-                        ]
-                        answer_text = " ".join([first_sentence[0], choice(variants)])
-                    else:
-                        answer_text = "Вот ссылка по вашему вопросу: "
-                    """
-
-                    answer_text = "Вот материал по вашему вопросу. Если это не совсем то, что нужно, я продолжу поиск "
-                    pubs_answers.append(
-                        {
-                            "pubId": int(pub),
-                            "templateId": int(row_tuple.ID),
-                            "templateText": " ".join([answer_text, str(query_url)]),
-                        }
-                    )
-            return pubs_answers
+        Systems come from the server in SysID order, so a system is ended as soon as the next one starts,
+        and the systems are loaded in the same order.
+        """
+        loop = asyncio.get_running_loop()
+        order = sorted(queues, key=int)
+        batches = self.db_conn.iter_systems_rows([int(x) for x in order], today, self.settings.batch_size)
+        ended = 0
+
+        async def end_systems(before: int | None = None):
+            nonlocal ended
+            while ended < len(order) and (before is None or int(order[ended]) < before):
+                await queues[order[ended]].put(None)
+                ended += 1
+
+        try:
+            while (batch := await loop.run_in_executor(self._fetch_pool, next, batches, None)) is not None:
+                sys_id, rows = batch
+                await end_systems(sys_id)
+                await queues[str(sys_id)].put(rows)
+        except Exception as err:
+            for sys_id in order[ended:]:
+                await queues[sys_id].put(err)
+            raise
+        await end_systems()
+
+    async def iter_snapshot_batches(self, snapshot: CorpusSnapshot, sys_id: str) -> AsyncIterator[tuple[list, list]]:
+        """Yields prepared clusters and answers of one system from the snapshot."""
+        loop = asyncio.get_running_loop()
+        batches = snapshot.read(sys_id, self.settings.batch_size)
+        while True:
+            with self.metrics.span("snapshot_read", sys_id):
+                batch = await loop.run_in_executor(self._fetch_pool, next, batches, None)
+            if batch is None:
+                break
+            yield batch
+
+    async def load_msdb_data(
+        self,
+        clusters_index: str,
+        answers_index: str,
+        snapshot: CorpusSnapshot | None = None,
+        reuse: set[str] = frozenset(),
+        **kwargs,
+    ) -> tuple[int, int]:
+        """
+        Streams data from MS SQL into the indexes.
+
+        Systems go through the pipeline concurrently: while one system is fetched, another one is lemmatized
+        and a third one is indexed. Inside a system rows flow batch by batch.
 
+        :param snapshot: snapshot the prepared data is written to.
+        :param reuse: systems that are read from the snapshot instead of MS SQL.
+        :return: quantity of added clusters and answers.
+        """
+        loop = asyncio.get_running_loop()
         today = datetime.today().strftime("%Y-%m-%d")
-        result_clusters, result_answers = [], []
-        for sys_id in kwargs["sys_pub_url"]:
-            rows = self.db_conn.get_rows(int(sys_id), today)
-            data_dicts = [nt._asdict() for nt in rows]
-            
-            # добавление ParentPubListSys и присвоение этому элементу значений из ParentPubList
-            for d in data_dicts:
-                d["ParentPubListSys"] = d.pop("ParentPubList")
-                
-            # добавление ParentPubList с PubIds из statistics_parameters
-            pubs = [x[0] for x in kwargs["sys_pub_url"][sys_id]]
-            for d in data_dicts:
-                d["ParentPubList"] = pubs
-            
-            self.update_data_with_lemmas(data_dicts, **kwargs)
-            rows_answers = [
-                ROW_FOR_ANSWERS(
-                    r.SysID, r.ID, r.ParentModuleID, r.ParentID, r.ChildBlockModuleID, r.ChildBlockID, r.ShortAnswerText
+        quantities = {"clusters": 0, "answers": 0}
+
+        sys_ids = list(kwargs["sys_pub_url"])
+        queues = {}
+        if self.settings.single_query:
+            # системы загружаются в том же порядке, в котором приходят из общего запроса
+            sys_ids.sort(key=int)
+            queues = {sys_id: asyncio.Queue(maxsize=2) for sys_id in sys_ids if sys_id not in reuse}
+
+        async def docs(sys_id):
+            writer = None
+            if sys_id in reuse:
+                batches = self.iter_snapshot_batches(snapshot, sys_id)
+            else:
+                batches = self.iter_sys_batches(sys_id, today, queues.get(sys_id), **kwargs)
+                if snapshot is not None:
+                    writer = snapshot.writer(sys_id)
+            try:
+                async for data_dicts, answers in batches:
+                    if writer is not None:
+                        with self.metrics.span("snapshot_write", sys_id):
+                            await loop.run_in_executor(self._fetch_pool, writer.write, data_dicts, answers)
+                    quantities["clusters"] += len(data_dicts)
+                    quantities["answers"] += len(answers)
+                    for data_dict in data_dicts:
+                        yield clusters_index, data_dict
+                    for answer in answers:
+                        yield answers_index, answer
+            except BaseException:
+                if writer is not None:
+                    writer.discard()
+                raise
+            if writer is not None:
+                writer.commit()
+
+        async def load(sys_id):
+            async with self._limit:
+                start = time.perf_counter()
+                stats = await self.es_client.stream_docs(docs(sys_id), id_field="ContentHash")
+                # поток документов тянет за собой выборку и лемматизацию, их время вычитается
+                prepare_seconds = sum(self.metrics.stage_seconds(x, sys_id) for x in PREPARE_STAGES)
+                self.metrics.observe("bulk", time.perf_counter() - start - prepare_seconds, sys_id)
+                self.record_bulk(stats, sys_id)
+
+        loads = [load(sys_id) for sys_id in sys_ids]
+        if queues:
+            loads.append(self.route_systems_rows(today, queues))
+        await gather_or_cancel(*loads)
+        return quantities["clusters"], quantities["answers"]
+
+    async def update_sys_delta(self, sys_id: str, today: str, clusters_index: str, answers_index: str, **kwargs):
+        """
+        Applies changes of one system to live indexes.
+
+        Only new or changed clusters are lemmatized and indexed, removed ones are deleted by their content hash.
+        With a watermark only rows whose validity changed since the previous run are fetched from MS SQL.
+        Rows edited in place (Cluster, DocName, ShortAnswerText, ParentPubList) keep their validity dates
+        and are missed by the watermark window, so every full_diff_days the system is compared with all
+        active rows instead; until then such edits reach the indexes only with the full run.
+        """
+        pubs_urls = kwargs["sys_pub_url"][sys_id]
+        pubs = [x[0] for x in pubs_urls]
+        since = self.db_conn.watermarks.get(sys_id)
+        if since is not None and self.full_diff_due(sys_id, today):
+            logger.info("SysID %s: comparing with all active rows", sys_id)
+            since = None
+
+        with self.metrics.span("scan", sys_id):
+            existing_ids = await self.es_client.scan_ids(
+                clusters_index, Bool([Match("SysID", int(sys_id)), Exists("ContentHash")])
+            )
+        if since is None:
+            active_rows, expired_rows = await self.fetch_rows(sys_id, today), []
+        else:
+            loop = asyncio.get_running_loop()
+            with self.metrics.span("fetch", sys_id):
+                active_rows, expired_rows = await loop.run_in_executor(
+                    self._fetch_pool, self.db_conn.get_changed_rows, int(sys_id), today, since
                 )
-                for r in rows
-            ]
+            self.metrics.inc("rows_fetched", len(active_rows) + len(expired_rows), sys_id)
+
+        active_rows = self.drop_deleted(active_rows)
+        active_dicts = self.rows_to_dicts(active_rows, pubs)
+        active_ids = {d["ContentHash"] for d in active_dicts}
+        new_rows, new_dicts = [], []
+        for row, data_dict in zip(active_rows, active_dicts):
+            if data_dict["ContentHash"] not in existing_ids:
+                new_rows.append(row)
+                new_dicts.append(data_dict)
+
+        if since is None:
+            removed_ids = existing_ids - active_ids
+            # без отметки истекшие строки не выбираются, данные для ответов берутся из удаляемых эталонов
+            removed_rows = await self.read_clusters_rows(clusters_index, removed_ids)
+        else:
+            expired_ids = {d["ContentHash"] for d in self.rows_to_dicts(expired_rows, pubs)}
+            removed_ids = (expired_ids - active_ids) & existing_ids
+            removed_rows = expired_rows
+
+        errors = 0
+        if new_dicts:
+            await self.lemmatize(new_dicts, sys_id, **kwargs)
+            with self.metrics.span("answers", sys_id):
+                answers = self.answers_create(pubs_urls, self.rows_for_answers(new_rows))
+            with self.metrics.span("bulk", sys_id):
+                for index, docs in ((clusters_index, new_dicts), (answers_index, answers)):
+                    stats = await self.es_client.add_docs(index, docs, id_field="ContentHash")
+                    self.record_bulk(stats, sys_id)
+                    errors += stats.errors
+
+        with self.metrics.span("delete", sys_id):
+            await self.delete_removed(
+                sys_id, pubs_urls, removed_ids, removed_rows, active_rows, clusters_index, answers_index
+            )
+
+        logger.info("SysID %s: %i clusters added, %i clusters removed", sys_id, len(new_dicts), len(removed_ids))
+        if errors:
+            # отметка не сдвигается, следующее обновление снова возьмет эти строки и добавит недостающие документы
+            logger.error("SysID %s: %i documents rejected, watermark is not moved", sys_id, errors)
+            return
+        self.db_conn.set_watermark(sys_id, today)
+        if since is None:
+            self.db_conn.set_full_diff(sys_id, today)
+
+    def full_diff_due(self, sys_id: str, today: str) -> bool:
+        """Whether the delta of the system has to compare all active rows instead of the watermark window."""
+        if not self.settings.full_diff_days:
+            return False
+        if (last := self.db_conn.full_diffs.get(sys_id)) is None:
+            return True
+        return (datetime.fromisoformat(today) - datetime.fromisoformat(last)).days >= self.settings.full_diff_days
+
+    @staticmethod
+    def source_row(source: dict) -> ROW_FOR_ANSWERS:
+        """Data for answers from the source of a clusters document."""
+        return ROW_FOR_ANSWERS._make(source[field] for field in ROW_FOR_ANSWERS._fields)
+
+    async def read_clusters_rows(self, clusters_index: str, ids: set[str]) -> list[ROW_FOR_ANSWERS]:
+        """Data for answers from the clusters documents with the given ids."""
+        if not ids:
+            return []
+        docs = await self.es_client.mget(index=clusters_index, ids=list(ids), source=list(ROW_FOR_ANSWERS._fields))
+        return [self.source_row(d["_source"]) for d in docs["docs"] if d.get("found")]
+
+    async def delete_removed(
+        self,
+        sys_id: str,
+        pubs_urls: list,
+        removed_ids: set[str],
+        removed_rows: list,
+        active_rows: list,
+        clusters_index: str,
+        answers_index: str,
+    ):
+        """
+        Deletes removed clusters and their answers.
+
+        Answers are deleted by the content hashes of the answers built from the removed rows,
+        except the hashes that the active rows and the clusters left in the index still produce.
+        """
+        if removed_ids:
+            await self.es_client.delete_docs(clusters_index, list(removed_ids))
+            await self.es_client.indices.refresh(index=clusters_index)
+
+        removed_answers = self.rows_for_answers(removed_rows)
+        if not removed_answers:
+            return
+        stale_ids = {a["ContentHash"] for a in self.answers_create(pubs_urls, removed_answers)}
+
+        # в дельте активные строки - только изменившиеся, остальные эталоны шаблонов берутся из индекса
+        template_ids = sorted({int(r.ID) for r in removed_answers})
+        query = Bool([Match("SysID", int(sys_id)), Terms("ID", template_ids), Exists("ContentHash")])
+        left_docs = await self.es_client.scan_sources(clusters_index, query, list(ROW_FOR_ANSWERS._fields))
+        left_rows = [self.source_row(d) for d in left_docs]
+        left_answers = self.rows_for_answers(active_rows) + self.rows_for_answers(left_rows)
+        stale_ids -= {a["ContentHash"] for a in self.answers_create(pubs_urls, left_answers)}
+        if stale_ids:
+            await self.es_client.delete_docs(answers_index, list(stale_ids))
+
+    async def scv2es(self, targets: dict[str, str] | None = None, **kwargs):
+        """
+        Обновление данных в индексе "clusters" из csv файлов
+
+        :param targets: соответствие имени алиаса и индекса, в который идет загрузка.
+        """
+        targets = targets or {}
+
+        async def load(value, sys_id):
+            async with self._limit:
+                await self.csv_sys_to_es(value, sys_id, targets)
 
-            rows_answers_unique = list(set(rows_answers))
+        loads = [load(value, sys_id) for value in kwargs.values() for sys_id in value["sys_files_pubs"]]
+        await gather_or_cancel(*loads)
 
-            result_clusters.extend(data_dicts)
-            result_answers.extend(data_for_answer_create(kwargs["sys_pub_url"][sys_id], rows_answers_unique))
-        return result_clusters, result_answers
+    def read_csv_records(self, file_name: str) -> list[dict]:
+        """Rows of a csv file from DATA_DIR, each file is parsed once per run."""
+        if file_name not in self._csv_records:
+            dataframe = pd.read_csv(os.path.join(DATA_DIR, file_name), sep="\t")
+            self._csv_records[file_name] = dataframe.to_dict(orient="records")
+        return self._csv_records[file_name]
 
-    async def scv2es(self, **kwargs):
-        """Обновление данных в индексе "clusters" из csv файлов"""
+    async def csv_sys_to_es(self, value: dict, sys_id: str, targets: dict[str, str]):
+        """Добавление вопросов и ответов одной системы из группы csv файлов"""
         ANS = namedtuple("ANS", "pubId, templateId, templateText")
-        for _key, value in kwargs.items():
-            for sys_id in value["sys_files_pubs"]:
-                appendix = value["appendix"] * int(sys_id)
-                file_name = value["sys_files_pubs"][sys_id]["file_name"]
-                pubs = value["sys_files_pubs"][sys_id]["pubs"]
-                dataframe = pd.read_csv(str(os.path.join(DATA_DIR, file_name)), sep="\t")
-                data_dicts = dataframe.to_dict(orient="records")
-
-                clusters_for_es = [
-                    {
-                        "SysID": int(sys_id),
-                        "ID": int(appendix) + int(d["templateId"]),
-                        "Cluster": d["text"],
-                        "ParentModuleID": 0,
-                        "ParentID": 0,
-                        "ParentPubList": pubs,
-                        "ChildBlockModuleID": 0,
-                        "ChildBlockID": 0,
-                        "ModuleID": 85,
-                        "Topic": "нет",
-                        "Subtopic": "нет",
-                        "DocName": "нет",
-                        "ShortAnswerText": d["templateText"],
-                    }
-                    for d in data_dicts
-                ]
-
-                answers = [ANS(pubid, d["ID"], d["ShortAnswerText"]) for d in clusters_for_es for pubid in pubs]
-                answers_for_es = [x._asdict() for x in set(answers)]
-
-                self.update_data_with_lemmas(clusters_for_es, **value)
-
-                # добавление вопросов и ответов:
-                await self.es_client.add_docs(value["clusters_index"], clusters_for_es)
-                await self.es_client.add_docs(value["answers_index"], answers_for_es)
-
-    async def run(self):
+        appendix = value["appendix"] * int(sys_id)
+        file_name = value["sys_files_pubs"][sys_id]["file_name"]
+        pubs = value["sys_files_pubs"][sys_id]["pubs"]
+        data_dicts = self.read_csv_records(file_name)
+
+        clusters_for_es = [
+            {
+                "SysID": int(sys_id),
+                "ID": int(appendix) + int(d["templateId"]),
+                "Cluster": d["text"],
+                "ParentModuleID": 0,
+                "ParentID": 0,
+                "ParentPubList": pubs,
+                "ChildBlockModuleID": 0,
+                "ChildBlockID": 0,
+                "ModuleID": 85,
+                "Topic": "нет",
+                "Subtopic": "нет",
+                "DocName": "нет",
+                "ShortAnswerText": d["templateText"],
+            }
+            for d in data_dicts
+        ]
+
+        clusters_for_es = [d for d in clusters_for_es if d["ID"] not in self.deleted_templates]
+        if self.settings.answers_layout == "compact":
+            answers = [ANS(tuple(pubs), d["ID"], d["ShortAnswerText"]) for d in clusters_for_es]
+            answers_for_es = [{**x._asdict(), "SysID": int(sys_id), "pubId": pubs} for x in set(answers)]
+        else:
+            answers = [ANS(pubid, d["ID"], d["ShortAnswerText"]) for d in clusters_for_es for pubid in pubs]
+            answers_for_es = [x._asdict() for x in set(answers)]
+
+        label = f"{value['clusters_index']}-{sys_id}"
+        await self.lemmatize(clusters_for_es, label, **value)
+
+        # добавление вопросов и ответов:
+        clusters_index = targets.get(value["clusters_index"], value["clusters_index"])
+        answers_index = targets.get(value["answers_index"], value["answers_index"])
+        with self.metrics.span("bulk", label):
+            self.record_bulk(await self.es_client.add_docs(clusters_index, clusters_for_es), label)
+            self.record_bulk(await self.es_client.add_docs(answers_index, answers_for_es), label)
+
+    @staticmethod
+    def index_definitions(stat_prmtrs: dict) -> dict[str, IndexDefinition]:
+        """Mappings of the indexes by alias, greetings are stored as clusters."""
+        return {
+            stat_prmtrs["clusters_index_name"]: CLUSTERS,
+            stat_prmtrs["answers_index_name"]: ANSWERS,
+            stat_prmtrs["greetings_index_name"]: CLUSTERS,
+        }
+
+    def snapshot_params(self, stat_prmtrs: dict) -> dict:
+        """Parameters the prepared data depends on, a snapshot is reused only if they are the same."""
+        return {
+            "answers_layout": self.settings.answers_layout,
+            "stopwords_files": stat_prmtrs["stopwords_files"],
+            "LemDocName": stat_prmtrs["LemDocName"],
+            "LemShortAnswerText": stat_prmtrs["LemShortAnswerText"],
+            "sys_pub_url": stat_prmtrs["sys_pub_url"],
+            "deleted_templates": content_hash({"ids": sorted(self.deleted_templates)}),
+        }
+
+    def open_snapshot(
+        self, stat_prmtrs: dict, resume: bool, offline: OfflineSource | None
+    ) -> tuple[CorpusSnapshot | None, set[str]]:
+        """
+        Chooses the snapshot for the run and the systems read from it.
+
+        Offline run reads all systems from the latest complete or incomplete snapshot made with the same parameters.
+        Resumed run takes only the snapshot of the interrupted last run, reads the prepared systems and writes the rest.
+        """
+        params = self.snapshot_params(stat_prmtrs)
+        systems = set(stat_prmtrs["sys_pub_url"])
+        if offline:
+            snapshot = CorpusSnapshot.latest(params, offline == "complete", self.snapshot_settings)
+            if snapshot is None:
+                raise SnapshotError(f"No {offline} snapshot made with the current parameters")
+            if missing := systems - snapshot.systems:
+                raise SnapshotError(f"Snapshot {snapshot.path} has no data for SysIDs {sorted(missing)}")
+            logger.info("Перестроение индексов из снимка %s от %s", snapshot.path, snapshot.date)
+            return snapshot, systems
+        if resume:
+            snapshot = CorpusSnapshot.interrupted(params, self.snapshot_settings)
+            if snapshot is not None:
+                logger.info("Продолжение со снимка %s, готовы системы: %s", snapshot.path, sorted(snapshot.systems))
+                return snapshot, systems & snapshot.systems
+            logger.warning("Снимка прерванного обновления с текущими параметрами нет, обновление выполняется заново")
+        if not self.snapshot_settings.enabled:
+            return None, set()
+        return CorpusSnapshot.create(params, datetime.today().strftime("%Y-%m-%d"), self.snapshot_settings), set()
+
+    async def run(self, resume: bool = False, offline: OfflineSource | None = None):
         """
         Runs the update service.
 
+        Data is loaded into new versioned indexes while the classifiers keep reading the aliases,
+        then all aliases are switched to the new indexes at once.
+        Prepared data from MS SQL is saved to a snapshot.
+
+        :param resume: take the systems already prepared by a failed run from its snapshot.
+        :param offline: rebuild the indexes without MS SQL from the latest "complete" snapshot
+            or from the latest "incomplete" one left by a failed run. CSV files are read and lemmatized as usual.
+
         Example usage:
             update_service = UpdateService()
             await update_service.run()
@@ -208,45 +741,204 @@ class UpdateService:
         with open(os.path.join(DATA_DIR, "statistics_parameters.json"), "r", encoding="utf-8") as st_f:
             stat_prmtrs = json.load(st_f)
 
-        indexes = [
-            stat_prmtrs["clusters_index_name"],
-            stat_prmtrs["answers_index_name"],
-            stat_prmtrs["greetings_index_name"],
-        ]
+        self.start()
+        snapshot, reuse = self.open_snapshot(stat_prmtrs, resume, offline)
+
+        # созданные версии индексов удаляются при любой ошибке до переключения алиасов
+        targets = {}
+        try:
+            logger.info("0. Создание новых версий индексов")
+            with self.metrics.span("create_generations"):
+                for alias, definition in self.index_definitions(stat_prmtrs).items():
+                    targets[alias] = await self.es_client.create_generation(alias, definition)
+            clusters_index = targets[stat_prmtrs["clusters_index_name"]]
+            answers_index = targets[stat_prmtrs["answers_index_name"]]
+
+            logger.info("1. Добавление эталонов и ответов из msdb и csv файлов")
+            load_mode = nullcontext()
+            if self.settings.bulk_load_mode:
+                load_mode = self.es_client.bulk_load_mode(*targets.values())
+            with self.metrics.span("load"):
+                async with load_mode:
+                    (msdb_clusters, msdb_answers), _ = await gather_or_cancel(
+                        self.load_msdb_data(clusters_index, answers_index, snapshot, reuse, **stat_prmtrs),
+                        self.scv2es(targets, **csv_prmtrs),
+                    )
+            # неполная версия индексов не должна получить трафик
+            self.check_bulk_errors()
+            if not msdb_clusters or not msdb_answers:
+                logger.info("Данные для обновления не найдены в msdb. Завершение работы")
+                for index in targets.values():
+                    await self.es_client.delete_index(index)
+                await self.finish()
+                return
+            with self.metrics.span("refresh"):
+                await self.es_client.indices.refresh(index=",".join(targets.values()))
+        except Exception:
+            logger.exception("Ошибка загрузки данных, новые версии индексов удаляются")
+            for index in targets.values():
+                await self.es_client.delete_index(index)
+            raise
+
+        logger.info("2. Переключение алиасов на новые индексы")
+        with self.metrics.span("switch_aliases"):
+            await self.es_client.switch_aliases(targets)
+            for alias in targets:
+                await self.es_client.prune_generations(alias, self.settings.keep_generations)
+
+        # данные систем из снимка актуальны на дату снимка
+        today = datetime.today().strftime("%Y-%m-%d")
+        for sys_id in stat_prmtrs["sys_pub_url"]:
+            self.db_conn.set_watermark(sys_id, snapshot.date if sys_id in reuse else today)
+            self.db_conn.set_full_diff(sys_id, snapshot.date if sys_id in reuse else today)
+        self.db_conn.save_watermarks()
+        if snapshot is not None and not offline:
+            snapshot.mark_complete()
+            CorpusSnapshot.prune(self.snapshot_settings)
+        await self.build_dense_indexes(stat_prmtrs)
+        await self.finish()
+
+    async def run_delta(self):
+        """
+        Applies only the changes from MS SQL to the live indexes.
+
+        Data from csv files is not touched, it is reloaded by the full run.
+        If the indexes have not been built yet, the full run is made instead.
+        """
+        with open(os.path.join(DATA_DIR, "statistics_parameters.json"), "r", encoding="utf-8") as st_f:
+            stat_prmtrs = json.load(st_f)
 
-        msdb_clusters, msdb_answers = await self.get_msdb_data(**stat_prmtrs)
-        if not msdb_clusters or not msdb_answers:
-            logger.info("Данные для обновления не найдены в msdb. Завершение работы")
+        clusters_index = stat_prmtrs["clusters_index_name"]
+        answers_index = stat_prmtrs["answers_index_name"]
+        if not await self.es_client.alias_targets(clusters_index):
+            logger.info("Индексы еще не созданы, выполняется полное обновление")
+            await self.run()
             return
 
-        logger.info("0. Удаление устаревших данных")
-        for index in indexes:
-            await self.es_client.delete_index(index)
-            await self.es_client.create_index(index)
+        definitions = self.index_definitions(stat_prmtrs)
+        for alias in (clusters_index, answers_index):
+            if drift := await self.es_client.mapping_drift(alias, definitions[alias]):
+                logger.warning("Маппинги индексов отличаются от описания, выполняется полное обновление: %s", drift)
+                await self.run()
+                return
 
-        logger.info("1. Добавление эталонов и ответов")
-        await self.es_client.add_docs(stat_prmtrs["clusters_index_name"], msdb_clusters)
-        await self.es_client.add_docs(stat_prmtrs["answers_index_name"], msdb_answers)
+        self.start()
+        today = datetime.today().strftime("%Y-%m-%d")
 
-        logger.info("2. Добавление из csv файлов")
-        await self.scv2es(**csv_prmtrs)
+        async def update(sys_id):
+            async with self._limit:
+                await self.update_sys_delta(sys_id, today, clusters_index, answers_index, **stat_prmtrs)
 
-        logger.info("3. Удаление эталонов и ответов по списку")
-        dataframe = pd.read_csv(os.path.join(DATA_DIR, "del_answers.csv"), sep="\t")
-        for template_id in dataframe["TemplateId"]:
-            await self.es_client.q_delete("clusters", Match("ID", template_id))
-            await self.es_client.q_delete("answers", Match("templateId", template_id))
+        with self.metrics.span("load"):
+            await asyncio.gather(*(update(sys_id) for sys_id in stat_prmtrs["sys_pub_url"]))
+
+        with self.metrics.span("refresh"):
+            await self.es_client.indices.refresh(index=f"{clusters_index},{answers_index}")
+        await self.delete_listed(clusters_index, answers_index)
+        self.db_conn.save_watermarks()
+        await self.build_dense_indexes(stat_prmtrs)
+        await self.finish()
+
+    async def build_dense_indexes(self, stat_prmtrs: dict):
+        """
+        Builds etalon embeddings and dense indexes of the live clusters and greetings indexes if ann_model is set.
+
+        A failure doesn't fail the update: classifiers search candidates in ES until the indexes are rebuilt.
+        """
+        if not self.settings.ann_model:
+            return
+        # модель нужна только для плотных индексов, зависимость не обязательна для остального обновления
+        from sentence_transformers import SentenceTransformer
+
+        logger.info("3. Построение плотных индексов эталонов")
+        try:
+            with self.metrics.span("dense_indexes"):
+                loop = asyncio.get_running_loop()
+                model = await loop.run_in_executor(None, SentenceTransformer, self.settings.ann_model)
+                await build_etalon_indexes(
+                    self.es_client,
+                    [stat_prmtrs["clusters_index_name"], stat_prmtrs["greetings_index_name"]],
+                    os.path.basename(os.path.normpath(self.settings.ann_model)),
+                    partial(model.encode, batch_size=64, show_progress_bar=False, normalize_embeddings=True),
+                )
+        except Exception:
+            logger.exception("Плотные индексы не построены, классификаторы ищут кандидатов в ES")
+
+    def start(self):
+        """Resets the state kept within one run."""
+        self.metrics = UpdateMetrics()
+        self._lemmas_memo = {}
+        self._lemmatized = 0
+        self._csv_records = {}
+        self._bulk_stats = []
+
+    async def finish(self):
+        """Logs the run summary, exports metrics and closes the Elasticsearch connection."""
+        if self.lemma_cache is not None:
+            self.lemma_cache.log_stats()
+        logger.info("Unique texts lemmatized: %i", self._lemmatized)
+        self._lemmas_memo, self._csv_records = {}, {}
+        self.metrics.log_summary()
+        self.metrics.export()
+        await self.es_client.close()
+
+    async def delete_listed(self, clusters_index: str, answers_index: str):
+        """
+        Удаление эталонов и ответов по списку del_answers.csv из уже заполненных индексов.
+
+        При загрузке эти шаблоны отфильтровываются заранее, здесь удаляется то, что попало в индексы до
+        изменения списка: по одному запросу на индекс.
+        """
+        template_ids = sorted(self.deleted_templates)
+        await self.es_client.q_delete(clusters_index, Terms("ID", template_ids))
+        await self.es_client.q_delete(answers_index, Terms("templateId", template_ids))
+
+    async def rollback(self):
+        """Switches the aliases back to the previous generation of indexes."""
+        with open(os.path.join(DATA_DIR, "statistics_parameters.json"), "r", encoding="utf-8") as st_f:
+            stat_prmtrs = json.load(st_f)
+
+        for alias in [
+            stat_prmtrs["clusters_index_name"],
+            stat_prmtrs["answers_index_name"],
+            stat_prmtrs["greetings_index_name"],
+        ]:
+            await self.es_client.rollback_alias(alias)
 
         await self.es_client.close()
 
 
 if __name__ == "__main__":
-    import asyncio
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Обновление данных в эластике")
+    parser.add_argument("--rollback", action="store_true", help="переключить алиасы на предыдущие версии индексов")
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help=(
+            "применить только изменения к текущим индексам; строки, отредактированные без изменения дат действия, "
+            "попадают в индексы при сравнении со всеми строками (UPDATE_FULL_DIFF_DAYS) или полном обновлении"
+        ),
+    )
+    parser.add_argument("--resume", action="store_true", help="продолжить со снимка прерванного обновления")
+    parser.add_argument(
+        "--offline",
+        choices=get_args(OfflineSource),
+        help="перестроить индексы без MS SQL из последнего завершенного (complete) или прерванного (incomplete) снимка",
+    )
+    args = parser.parse_args()
 
     es = ElasticClient()
     db_con = SQLDataFetcher()
-    mystem  = Mystem()
-
-    srv = UpdateService(es, db_con, mystem)
-    asyncio.run(srv.run())
+    mystem = MystemPool()
+
+    srv = UpdateService(es, db_con, mystem, LemmaCache())
+    if args.rollback:
+        asyncio.run(srv.rollback())
+    elif args.delta:
+        asyncio.run(srv.run_delta())
+    else:
+        asyncio.run(srv.run(resume=args.resume, offline=args.offline))
+    db_con.close()
     pass
\ No newline at end of file